@@ -0,0 +1,172 @@
+"""
+Cold start benchmark: time from starting a fresh interpreter to the first recommendation.
+
+Every run starts a new Python process. The process imports mars, opens the pattern database, loads the pattern
+factories and matches an uploaded module. The parent process takes the time at which the first match is parsed and
+the time at which the process ends. Patterns are loaded from the database directly and from a pattern snapshot.
+
+    python benchmarks/cold_start.py --patterns 2000 --runs 5
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# stdlib modules the patterns are cut from and the module that is uploaded
+SOURCE_MODULES = ('argparse', 'json.decoder', 'textwrap', 'collections', 'configparser')
+UPLOADED_MODULE = 'argparse'
+
+
+def main():
+    import argparse
+    import statistics
+    import tempfile
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--patterns', type=int, default=2000, help='number of patterns in the database')
+    parser.add_argument('--runs', type=int, default=5, help='number of cold starts measured for every mode')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated patterns')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'patterns.db')
+        snapshot = os.path.join(directory, 'patterns.snapshot')
+        uploaded = os.path.join(directory, 'uploaded.py')
+        count = _create_database(database, arguments.patterns, arguments.seed)
+        with open(uploaded, 'w') as file:
+            file.write(_module_source(UPLOADED_MODULE))
+        # the first start with a snapshot path writes the snapshot, it is not measured
+        _cold_start(database, snapshot, uploaded)
+
+        print('{} patterns, {} runs per mode'.format(count, arguments.runs))
+        print('{:<10} {:>12} {:>12} {:>10} {:>10} {:>10}'.format('mode', 'first [ms]', 'total [ms]', 'import',
+                                                                   'load', 'match'))
+        for mode, snapshot_path in (('database', ''), ('snapshot', snapshot)):
+            runs = [_cold_start(database, snapshot_path, uploaded) for _ in range(arguments.runs)]
+            first = statistics.median(run['first'] for run in runs)
+            total = statistics.median(run['total'] for run in runs)
+            phases = [statistics.median(run[phase] for run in runs) for phase in ('import', 'load', 'match')]
+            print('{:<10} {:>12.1f} {:>12.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(mode, first, total, *phases))
+
+
+def _cold_start(database, snapshot, uploaded):
+    """
+    Starts a new process that matches the uploaded file and measures it.
+
+    Returns
+    -------
+    dict of (str, float)
+        Milliseconds until the first recommendation and until the process ended, and the milliseconds the process
+        spent importing, loading the patterns and matching
+    """
+
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', database, snapshot, uploaded],
+                               stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    first = time.perf_counter() - started
+    phases = json.loads(process.stdout.readline())
+    process.wait()
+    total = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError('Cold start process failed with exit code {}'.format(process.returncode))
+    return dict(phases, first=first * 1000, total=total * 1000)
+
+
+def _child(database, snapshot, uploaded):
+    """
+    Matches the uploaded file in a fresh process. Prints a line once the first match is parsed and the durations of
+    the phases when matching ends.
+    """
+
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from mars.pattern_loading import PatternFactoryLoader, PatternSet
+    from mars.pattern_parsing import PatternParser
+    from mars.pattern_storage import SqliteDbContext
+
+    class FirstMatchParser(PatternParser):
+        def __init__(self):
+            self.output = 0
+
+        def parse(self, pattern):
+            if not self.output:
+                print('first', flush=True)
+            self.output += 1
+
+    imported = time.perf_counter()
+    loader = PatternFactoryLoader(SqliteDbContext(database), snapshot_path=snapshot or None)
+    pattern_set = PatternSet(loader.get_version(), loader.load(), loader.vocabulary)
+    loaded = time.perf_counter()
+    parser = FirstMatchParser()
+    recommender = pattern_set.create_recommender(parser)
+    with open(uploaded) as file:
+        recommender.stream_recommendations(file)
+    if not parser.output:
+        print('first', flush=True)
+    matched = time.perf_counter()
+    print(json.dumps({'import': (imported - started) * 1000, 'load': (loaded - imported) * 1000,
+                      'match': (matched - loaded) * 1000}), flush=True)
+
+
+def _create_database(path, count, seed):
+    """
+    Creates a pattern database with patterns cut from the statements of the source modules. Some expressions of
+    every pattern are replaced by wildcards and the modified code renames one of its names.
+
+    Returns
+    -------
+    int
+        Number of distinct patterns saved in the database
+    """
+
+    import ast
+    import copy
+    import random
+
+    sys.path.insert(0, ROOT)
+    from mars.ast_utils import preorder
+    from mars.pattern import Pattern, Wildcard
+    from mars.pattern_creation import EditScriptGenerator, TreeDifferencer
+    from mars.pattern_storage import SqliteDbContext
+
+    generator = EditScriptGenerator(TreeDifferencer())
+    random_state = random.Random(seed)
+    statements = [node for module in SOURCE_MODULES for node in preorder(ast.parse(_module_source(module)))
+                  if isinstance(node, ast.stmt) and not isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    patterns = []
+    for _ in range(count):
+        start = random_state.randrange(len(statements) - 1)
+        original = ast.Module(body=[copy.deepcopy(statement) for statement in
+                                    statements[start:start + random_state.randint(1, 2)]], type_ignores=[])
+        modified = copy.deepcopy(original)
+        names = [node for node in ast.walk(modified) if isinstance(node, ast.Name)]
+        if names:
+            random_state.choice(names).id = 'renamed'
+        for _ in range(random_state.randint(0, 2)):
+            parents = [(parent, field) for parent in ast.walk(original) for field, value in ast.iter_fields(parent)
+                       if isinstance(value, ast.expr) and not isinstance(value, Wildcard)]
+            if parents:
+                parent, field = random_state.choice(parents)
+                setattr(parent, field, Wildcard())
+        # the script is generated once the wildcards are in place, so it transforms the pattern as it is saved
+        patterns.append(Pattern(original, modified, generator.generate(original, modified)))
+    context = SqliteDbContext(path)
+    context.save_patterns(patterns)
+    return sum(1 for _ in context.load_patterns())
+
+
+def _module_source(name):
+    import importlib
+    import inspect
+
+    return inspect.getsource(importlib.import_module(name))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        _child(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,149 @@
+"""
+Parallel matching benchmark: time to match a large uploaded module in one process and in worker processes.
+
+The uploaded module is the concatenation of the source modules, the patterns are statements cut from them with some
+expressions replaced by wildcards. Every mode is measured after a warm-up run, which starts the shared worker
+processes and lets them decode the patterns. Besides the wall time, the benchmark reports the processor time the
+parent process spends in a parallel run and matches every region in this process the way a worker does. When every
+worker has a core of its own, a parallel run takes about the time of the parent process plus the slowest region.
+
+    python benchmarks/parallel_matching.py --patterns 300 --processes 4 --runs 5
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# stdlib modules the patterns are cut from and concatenated into the uploaded module
+SOURCE_MODULES = ('argparse', 'json.decoder', 'textwrap', 'collections', 'configparser')
+
+
+def main():
+    import argparse
+    import ast
+    import statistics
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--patterns', type=int, default=300, help='number of patterns')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--runs', type=int, default=5, help='number of measured runs of every mode')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated patterns')
+    arguments = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from mars import pattern_matching, pattern_serialization
+    from mars.ast_utils import preorder_with_ends
+
+    uploaded_ast = ast.parse('\n'.join(_module_source(module) for module in SOURCE_MODULES))
+    patterns = _create_patterns(uploaded_ast, arguments.patterns, arguments.seed)
+    serial, _, serial_output = _measure(patterns, uploaded_ast, 1, arguments.runs)
+    parallel, parent, parallel_output = _measure(patterns, uploaded_ast, arguments.processes, arguments.runs)
+    if serial_output != parallel_output:
+        raise RuntimeError('Parallel matching found other matches than serial matching')
+
+    # every region matched in this process the way a worker matches it, with the patterns already decoded
+    nodes, ends = preorder_with_ends(uploaded_ast)
+    regions = pattern_matching._regions(ends, min(arguments.processes, len(uploaded_ast.body)))
+    statements = {}
+    index = 1
+    while index < len(nodes):
+        statements[index] = len(statements)
+        index = ends[index]
+    data = pattern_serialization.dumps(patterns)
+    region_times = []
+    for start, stop in regions:
+        region = pattern_serialization.dumps(ast.Module(body=uploaded_ast.body[statements[start]:statements.get(
+            stop, len(uploaded_ast.body))], type_ignores=[]))
+        pattern_matching._match_region(-1, data, region, start - 1)
+        started = time.process_time()
+        pattern_matching._match_region(-1, data, region, start - 1)
+        region_times.append(time.process_time() - started)
+
+    print('{} nodes, {} patterns, {} matches, {} cores, {} runs per mode'.format(
+        len(nodes), len(patterns), len(serial_output), os.cpu_count(), arguments.runs))
+    print('{:<28} {:>10}'.format('mode', 'time [ms]'))
+    print('{:<28} {:>10.1f}'.format('serial', statistics.median(serial) * 1000))
+    print('{:<28} {:>10.1f}'.format('{} processes'.format(arguments.processes), statistics.median(parallel) * 1000))
+    print('{:<28} {:>10.1f}'.format('parent process', statistics.median(parent) * 1000))
+    print('{:<28} {:>10.1f}'.format('slowest of {} regions'.format(len(regions)), max(region_times) * 1000))
+    print('{:<28} {:>10.1f}'.format('all regions', sum(region_times) * 1000))
+
+
+def _measure(patterns, uploaded_ast, processes, runs):
+    """
+    Matches the uploaded AST once to warm up and then the number of runs times.
+
+    Returns
+    -------
+    list of float, list of float, list of tuple
+        Seconds every measured run took, seconds of processor time this process spent in every run and the
+        matches of the last run
+    """
+
+    from mars.ast_encoding import TokenVocabulary
+    from mars.pattern_matching import PatternFactoryListener, Recommender
+    from mars.pattern_parsing import CollectingPatternParser
+
+    vocabulary = TokenVocabulary()
+    factories = [PatternFactoryListener(pattern, vocabulary=vocabulary) for pattern in patterns]
+    times = []
+    processor_times = []
+    for _ in range(runs + 1):
+        parser = CollectingPatternParser()
+        recommender = Recommender(parser, uploaded_ast, vocabulary=vocabulary, processes=processes)
+        for factory in factories:
+            recommender.subscribe(factory.bind(recommender))
+        started, processor_started = time.perf_counter(), time.process_time()
+        recommender.get_recommendations()
+        times.append(time.perf_counter() - started)
+        processor_times.append(time.process_time() - processor_started)
+    output = [(matcher.pattern.pattern_id, matcher.start, matcher.end, len(matcher.wildcard_matches))
+              for matcher in parser.output]
+    return times[1:], processor_times[1:], output
+
+
+def _create_patterns(uploaded_ast, count, seed):
+    """
+    Creates patterns from statements of the uploaded AST, some expressions of every pattern are replaced by
+    wildcards.
+
+    Returns
+    -------
+    list of Pattern
+        Created patterns
+    """
+
+    import ast
+    import copy
+    import random
+
+    from mars.ast_utils import preorder
+    from mars.pattern import EditScript, Pattern, Wildcard
+
+    random_state = random.Random(seed)
+    statements = [node for node in preorder(uploaded_ast)
+                  if isinstance(node, ast.stmt) and not isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    patterns = []
+    for pattern_id in range(count):
+        original = ast.Module(body=[copy.deepcopy(random_state.choice(statements))], type_ignores=[])
+        for _ in range(random_state.randint(0, 2)):
+            parents = [(parent, field) for parent in ast.walk(original) for field, value in ast.iter_fields(parent)
+                       if isinstance(value, ast.expr) and not isinstance(value, Wildcard)]
+            if parents:
+                parent, field = random_state.choice(parents)
+                setattr(parent, field, Wildcard())
+        pattern = Pattern(original, copy.deepcopy(original), EditScript([]))
+        pattern.pattern_id = pattern_id
+        patterns.append(pattern)
+    return patterns
+
+
+def _module_source(name):
+    import importlib
+    import inspect
+
+    return inspect.getsource(importlib.import_module(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import threading
+from array import array
+
+from .ast_utils import match_label
+from .pattern import Wildcard
+
+# Token of the pattern nodes that are wildcards and of the uploaded nodes whose label does not appear in any pattern
+WILDCARD = -1
+UNKNOWN = -2
+
+
+class TokenVocabulary:
+    """
+    This class encodes AST nodes as integer tokens. Every node label (node type, field layout, the values of the
+    fields that are not nodes, such as identifiers and constants, and the number of nodes in the fields that hold lists
+    of nodes, see match_label) is interned into a small integer, so two nodes match if and only if their tokens are
+    equal. Pattern nodes are encoded once when the patterns are loaded, uploaded nodes once per matching run, and
+    matching compares integers instead of computing and comparing labels.
+
+    Only patterns add labels to the vocabulary. Labels of uploaded nodes are only looked up and encoded as UNKNOWN if
+    no pattern contains them, so the vocabulary does not grow with the uploaded code. Tokens never change once they
+    are assigned, so one vocabulary can be shared by all pattern sets loaded by the same loader.
+
+    ...
+
+    Attributes
+    ----------
+    tokens : dict of (tuple, int)
+        Tokens of the interned node labels
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises TokenVocabulary object.
+    public int __len__(self)
+        Returns the number of interned labels.
+    public int intern(self, node)
+        Returns the token of the pattern node, interning its label if needed.
+    public int intern_label(self, label)
+        Returns the token of the pattern node label, interning it if needed.
+    public int token(self, node)
+        Returns the token of the uploaded node without interning its label.
+    public array encode_pattern(self, nodes)
+        Encodes the pattern nodes into a token array.
+    public array encode(self, nodes)
+        Encodes the uploaded nodes into a token array.
+    """
+
+    def __init__(self):
+        """
+        Initialises TokenVocabulary object.
+        """
+
+        self.tokens = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of interned labels.
+
+        Returns
+        -------
+        int
+            Number of interned labels
+        """
+
+        return len(self.tokens)
+
+    def intern(self, node):
+        """
+        Returns the token of the pattern node, interning its label if needed.
+
+        Parameters
+        ----------
+        node : ast
+            Pattern node
+
+        Returns
+        -------
+        int
+            Token of the node, WILDCARD for wildcard nodes
+        """
+
+        if isinstance(node, Wildcard):
+            return WILDCARD
+        return self.intern_label(match_label(node))
+
+    def intern_label(self, label):
+        """
+        Returns the token of the pattern node label, interning it if needed. Used for labels that were computed
+        before the patterns were loaded.
+
+        Parameters
+        ----------
+        label : tuple
+            Label of the pattern node
+
+        Returns
+        -------
+        int
+            Token of the label
+        """
+
+        token = self.tokens.get(label)
+        if token is None:
+            with self.__lock:
+                token = self.tokens.setdefault(label, len(self.tokens))
+        return token
+
+    def token(self, node):
+        """
+        Returns the token of the uploaded node without interning its label.
+
+        Parameters
+        ----------
+        node : ast
+            Uploaded node
+
+        Returns
+        -------
+        int
+            Token of the node, UNKNOWN if no pattern node has the same label
+        """
+
+        return self.tokens.get(match_label(node), UNKNOWN)
+
+    def encode_pattern(self, nodes):
+        """
+        Encodes the pattern nodes into a token array.
+
+        Parameters
+        ----------
+        nodes : list of ast
+            Nodes of the pattern in the order in which they are matched
+
+        Returns
+        -------
+        array
+            Tokens of the nodes
+        """
+
+        return array('i', [self.intern(node) for node in nodes])
+
+    def encode(self, nodes):
+        """
+        Encodes the uploaded nodes into a token array.
+
+        Parameters
+        ----------
+        nodes : list of ast
+            Uploaded nodes in preorder
+
+        Returns
+        -------
+        array
+            Tokens of the nodes
+        """
+
+        get = self.tokens.get
+        return array('i', [get(match_label(node), UNKNOWN) for node in nodes])
+
+
+def token_runs(tokens):
+    """
+    Splits the pattern tokens into the runs that are compared with the uploaded tokens at once. Consecutive nodes that
+    are not wildcards match consecutive uploaded nodes, so they are compared as a single array slice. Wildcards match
+    whole uploaded subtrees and are represented by None.
+
+    Parameters
+    ----------
+    tokens : array
+        Tokens of the pattern nodes
+
+    Returns
+    -------
+    list of array
+        Runs of the tokens, None for wildcards
+    """
+
+    runs = []
+    start = 0
+    for index, token in enumerate(tokens):
+        if token == WILDCARD:
+            if start < index:
+                runs.append(tokens[start:index])
+            runs.append(None)
+            start = index + 1
+    if start < len(tokens):
+        runs.append(tokens[start:])
+    return runs
@@ -0,0 +1,224 @@
+import ast
+import copy
+
+# Representatives of the literal classes. Literals that are singletons (None, True, False and Ellipsis) are kept.
+_LITERAL_CLASSES = {int: 0, float: 0.0, complex: 0j, str: '', bytes: b''}
+_SCOPE_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)
+_ORIGINAL_ATTRIBUTES = ('original_id', 'original_value', 'original_names')
+
+
+class ASTNormalizer:
+    """
+    This class normalizes ASTs, so code that differs only in the names of local variables or in the values of
+    literals has equal ASTs. Patterns and uploaded code need to be normalized by the same normalizer to be matched.
+
+    Local variables of every function, its parameters and the names it assigns, are renamed to _v0, _v1, ... in
+    the order of their first appearance (alpha-renaming). Names of nested functions continue the numbering of the
+    enclosing function, so the variables they share keep their names. Names outside functions, global and imported
+    names are kept, since they refer to the same objects everywhere. Literals are replaced by the representative of
+    their class, 0 for all integers, '' for all strings and so on.
+
+    The original names and values are kept in the original_id, original_value and original_names attributes of the
+    changed nodes, restore_original uses them to turn normalized nodes back into the code that was written.
+
+    ...
+
+    Attributes
+    ----------
+    rename_locals : bool
+        True if local variables are renamed
+    abstract_literals : bool
+        True if literals are replaced by the representatives of their classes
+
+    Methods
+    -------
+    public __init__(self, rename_locals, abstract_literals)
+        Initialises ASTNormalizer object.
+    public ast normalize(self, tree)
+        Normalizes the AST in place.
+    """
+
+    def __init__(self, rename_locals=True, abstract_literals=True):
+        """
+        Initialises ASTNormalizer object.
+
+        Parameters
+        ----------
+        rename_locals : bool, optional
+            True if local variables are renamed (default is True)
+        abstract_literals : bool, optional
+            True if literals are replaced by the representatives of their classes (default is True)
+        """
+
+        self.rename_locals = rename_locals
+        self.abstract_literals = abstract_literals
+
+    def normalize(self, tree):
+        """
+        Normalizes the AST in place.
+
+        Parameters
+        ----------
+        tree : ast
+            Normalized AST
+
+        Returns
+        -------
+        ast
+            The received AST
+        """
+
+        if self.abstract_literals:
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Constant) and type(node.value) in _LITERAL_CLASSES:
+                    node.original_value = node.value
+                    node.value = _LITERAL_CLASSES[type(node.value)]
+                    node.kind = None
+        if self.rename_locals:
+            _rename(tree, {})
+        return tree
+
+
+def restore_original(node):
+    """
+    Returns a copy of the normalized AST with the original names and literals restored.
+
+    Parameters
+    ----------
+    node : ast
+        Normalized AST, it is not changed
+
+    Returns
+    -------
+    ast
+        Copy of the AST as it was before normalization, the AST itself if it was not normalized
+    """
+
+    if not any(hasattr(child, name) for child in ast.walk(node) for name in _ORIGINAL_ATTRIBUTES):
+        return node
+    restored = copy.deepcopy(node)
+    for child in ast.walk(restored):
+        if hasattr(child, 'original_value'):
+            child.value = child.original_value
+        if hasattr(child, 'original_id'):
+            setattr(child, _identifier_field(child), child.original_id)
+        if hasattr(child, 'original_names'):
+            child.names = child.original_names
+    return restored
+
+
+def _rename(root, names):
+    """
+    Renames the local variables of all functions in the subtree.
+
+    Parameters
+    ----------
+    root : ast
+        Root of the subtree
+    names : dict of (str, str)
+        New names of the variables of the enclosing functions indexed by their original names
+    """
+
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            # defaults, annotations and decorators are evaluated in the enclosing scope
+            arguments = node.args
+            outer = list(arguments.defaults) + [default for default in arguments.kw_defaults if default is not None]
+            if not isinstance(node, ast.Lambda):
+                outer += node.decorator_list + ([node.returns] if node.returns is not None else [])
+                outer += [argument.annotation for argument in _arguments(arguments) if argument.annotation is not None]
+            stack.extend(reversed(outer))
+            _rename_function(node, names)
+            continue
+        if isinstance(node, ast.Name) and node.id in names:
+            _set_identifier(node, names[node.id])
+        elif isinstance(node, ast.ExceptHandler) and node.name in names:
+            _set_identifier(node, names[node.name])
+        elif isinstance(node, ast.Nonlocal):
+            node.original_names = node.names
+            node.names = [names.get(name, name) for name in node.names]
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+
+def _rename_function(function, names):
+    """
+    Renames the local variables of the function and of the functions nested in it.
+
+    Parameters
+    ----------
+    function : ast
+        FunctionDef, AsyncFunctionDef or Lambda node
+    names : dict of (str, str)
+        New names of the variables of the enclosing functions indexed by their original names
+    """
+
+    body = function.body if isinstance(function.body, list) else [function.body]
+    arguments = _arguments(function.args)
+    global_names, nonlocal_names = set(), set()
+    bound, order = {argument.arg for argument in arguments}, [argument.arg for argument in arguments]
+
+    stack = list(reversed(body))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Global):
+            global_names.update(node.names)
+        elif isinstance(node, ast.Nonlocal):
+            nonlocal_names.update(node.names)
+        elif isinstance(node, ast.Name):
+            order.append(node.id)
+            if not isinstance(node.ctx, ast.Load):
+                bound.add(node.id)
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            order.append(node.name)
+            bound.add(node.name)
+        if not isinstance(node, _SCOPE_TYPES):
+            stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+    # variables of the function shadow the ones of the enclosing functions and continue their numbering
+    own_names = {}
+    for name in order:
+        if name in bound and name not in own_names and name not in global_names and name not in nonlocal_names:
+            own_names[name] = '_v{}'.format(len(names) + len(own_names))
+    local_names = {name: new_name for name, new_name in names.items() if name not in global_names}
+    local_names.update(own_names)
+
+    for argument in arguments:
+        if argument.arg in local_names:
+            _set_identifier(argument, local_names[argument.arg])
+    for node in body:
+        _rename(node, local_names)
+
+
+def _arguments(arguments):
+    """
+    Returns all parameters of the function in the order of their declaration.
+    """
+
+    parameters = arguments.posonlyargs + arguments.args
+    if arguments.vararg is not None:
+        parameters.append(arguments.vararg)
+    parameters = parameters + arguments.kwonlyargs
+    if arguments.kwarg is not None:
+        parameters.append(arguments.kwarg)
+    return parameters
+
+
+def _identifier_field(node):
+    """
+    Returns the name of the field that holds the identifier of a Name, arg or ExceptHandler node.
+    """
+
+    return 'id' if isinstance(node, ast.Name) else 'arg' if isinstance(node, ast.arg) else 'name'
+
+
+def _set_identifier(node, identifier):
+    """
+    Renames the node and keeps its original identifier.
+    """
+
+    field = _identifier_field(node)
+    if not hasattr(node, 'original_id'):
+        node.original_id = getattr(node, field)
+    setattr(node, field, identifier)
@@ -0,0 +1,227 @@
+import ast
+
+
+def node_label(node):
+    """
+    Returns the label of the AST node. The label consists of the node type and the values of all fields that are not
+    AST nodes themselves (identifiers, constants, ...). Two nodes with equal labels are considered the same node when
+    the ASTs are compared, regardless of their position in the source code.
+
+    Parameters
+    ----------
+    node : ast
+        AST node whose label is returned
+
+    Returns
+    -------
+    tuple
+        Hashable label of the node
+    """
+
+    values = []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, ast.AST):
+            continue
+        if isinstance(value, list):
+            if any(isinstance(item, ast.AST) for item in value):
+                continue
+            value = tuple(value)
+        values.append((field, type(value).__name__, value))
+    return (type(node).__name__,) + tuple(values)
+
+
+def match_label(node):
+    """
+    Returns the label by which the AST node is matched against pattern nodes. It extends the label returned by
+    node_label with the number of nodes in every field that holds a list of nodes. Patterns are matched node by node
+    in preorder, so without the counts a pattern would also match code whose nodes have more children than the
+    pattern nodes, such as foo(a) matching foo(a, b).
+
+    Parameters
+    ----------
+    node : ast
+        AST node whose label is returned
+
+    Returns
+    -------
+    tuple
+        Hashable label of the node
+    """
+
+    counts = []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, list) and any(isinstance(item, ast.AST) for item in value):
+            counts.append((field, 'list', len(value)))
+    return node_label(node) + tuple(counts)
+
+
+def holds_nodes(value):
+    """
+    Checks if the value of an AST node field holds child nodes.
+
+    Parameters
+    ----------
+    value : object
+        Value of the field
+
+    Returns
+    -------
+    bool
+        True if the value is an AST node or a list that contains AST nodes
+    """
+
+    return isinstance(value, ast.AST) or (isinstance(value, list) and any(isinstance(item, ast.AST) for item in value))
+
+
+def preorder(tree):
+    """
+    Returns the nodes of the AST in preorder.
+
+    Parameters
+    ----------
+    tree : ast
+        Root of the AST
+
+    Returns
+    -------
+    list of ast
+        Nodes of the AST in preorder
+    """
+
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+    return nodes
+
+
+def preorder_with_ends(tree):
+    """
+    Returns the nodes of the AST in preorder together with the end of every subtree.
+
+    Parameters
+    ----------
+    tree : ast
+        Root of the AST
+
+    Returns
+    -------
+    list of ast, list of int
+        Nodes of the AST in preorder and, for every node, the preorder index that follows the last node of its subtree
+    """
+
+    nodes = []
+    ends = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, int):
+            ends[node] = len(nodes)
+            continue
+        stack.append(len(nodes))
+        nodes.append(node)
+        ends.append(None)
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+    return nodes, ends
+
+
+def postorder(tree):
+    """
+    Returns the nodes of the AST in postorder.
+
+    Parameters
+    ----------
+    tree : ast
+        Root of the AST
+
+    Returns
+    -------
+    list of ast
+        Nodes of the AST in postorder
+    """
+
+    nodes = []
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            nodes.append(node)
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(list(ast.iter_child_nodes(node))))
+    return nodes
+
+
+class SubtreeHasher:
+    """
+    This class assigns structural hashes to AST subtrees. Hashes are small integers interned per hasher, so two subtrees
+    have the same hash if and only if they have equal labels and equal children in the same order.
+
+    ...
+
+    Attributes
+    ----------
+    labels : dict of (tuple, int)
+        Interned node labels
+    subtrees : dict of (tuple, int)
+        Interned subtrees, a subtree is described by its label and the hashes of its children
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises SubtreeHasher object.
+    public int label_id(self, node)
+        Returns the interned identifier of the node label.
+    public dict of (int, int) hash_tree(self, tree)
+        Returns the structural hashes of all subtrees in the AST.
+    """
+
+    def __init__(self):
+        """
+        Initialises SubtreeHasher object.
+        """
+
+        self.labels = {}
+        self.subtrees = {}
+
+    def label_id(self, node):
+        """
+        Returns the interned identifier of the node label.
+
+        Parameters
+        ----------
+        node : ast
+            AST node
+
+        Returns
+        -------
+        int
+            Identifier of the node label
+        """
+
+        return self.labels.setdefault(node_label(node), len(self.labels))
+
+    def hash_tree(self, tree):
+        """
+        Returns the structural hashes of all subtrees in the AST.
+
+        Parameters
+        ----------
+        tree : ast
+            Root of the AST
+
+        Returns
+        -------
+        dict of (int, int)
+            Hashes of the subtrees indexed by id() of their root nodes
+        """
+
+        hashes = {}
+        for node in postorder(tree):
+            key = (self.label_id(node), tuple(hashes[id(child)] for child in ast.iter_child_nodes(node)))
+            hashes[id(node)] = self.subtrees.setdefault(key, len(self.subtrees))
+        return hashes
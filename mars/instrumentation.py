@@ -0,0 +1,414 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+
+# Instrumented code checks this flag before measuring anything, so instrumentation costs a single attribute lookup
+# when no sink is registered and no RequestTrace is active.
+enabled = False
+
+_sinks = ()
+_lock = threading.Lock()
+_active_traces = 0
+_current_trace = contextvars.ContextVar('mars_request_trace', default=None)
+
+
+class MetricsSink(ABC):
+    """
+    This interface represents the destinations of instrumentation measurements.
+
+    ...
+
+    Methods
+    -------
+    public void count(self, name, value)
+        Records an increment of the counter.
+    public void timing(self, name, seconds)
+        Records a single duration measurement.
+    """
+
+    @abstractmethod
+    def count(self, name, value):
+        """
+        Records an increment of the counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter
+        value : int
+            Increment of the counter
+        """
+        pass
+
+    @abstractmethod
+    def timing(self, name, seconds):
+        """
+        Records a single duration measurement.
+
+        Parameters
+        ----------
+        name : str
+            Name of the measured operation
+        seconds : float
+            Duration of the operation in seconds
+        """
+        pass
+
+
+class InMemoryAggregator(MetricsSink):
+    """
+    This class aggregates all measurements in memory.
+
+    ...
+
+    Attributes
+    ----------
+    counters : dict of (str, int)
+        Values of the counters
+    timings : dict of (str, list of float)
+        Number of measurements, total, minimum and maximum duration of every measured operation
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises InMemoryAggregator object.
+    public void count(self, name, value)
+        Records an increment of the counter.
+    public void timing(self, name, seconds)
+        Records a single duration measurement.
+    public dict snapshot(self)
+        Returns a copy of the aggregated measurements.
+    public void reset(self)
+        Removes all aggregated measurements.
+    """
+
+    def __init__(self):
+        """
+        Initialises InMemoryAggregator object.
+        """
+
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value):
+        """
+        Records an increment of the counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter
+        value : int
+            Increment of the counter
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        """
+        Records a single duration measurement.
+
+        Parameters
+        ----------
+        name : str
+            Name of the measured operation
+        seconds : float
+            Duration of the operation in seconds
+        """
+
+        with self._lock:
+            stats = self.timings.get(name)
+            if stats is None:
+                self.timings[name] = [1, seconds, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = min(stats[2], seconds)
+                stats[3] = max(stats[3], seconds)
+
+    def snapshot(self):
+        """
+        Returns a copy of the aggregated measurements.
+
+        Returns
+        -------
+        dict
+            Dictionary with counters and timings, every timing is described by its count, total, min and max
+        """
+
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timings': {name: dict(zip(('count', 'total', 'min', 'max'), stats))
+                                for name, stats in self.timings.items()}}
+
+    def reset(self):
+        """
+        Removes all aggregated measurements.
+        """
+
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+class PrometheusFileSink(InMemoryAggregator):
+    """
+    This class aggregates the measurements in memory and dumps them to a file in the Prometheus text format, so they
+    can be collected by the node exporter textfile collector. Counters are exported as counters, timings as summaries
+    with their count and sum.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the file the measurements are dumped to
+    prefix : str
+        Prefix of all exported metric names
+
+    Methods
+    -------
+    public __init__(self, path, prefix)
+        Initialises PrometheusFileSink object.
+    public str render(self)
+        Returns the aggregated measurements in the Prometheus text format.
+    public void dump(self)
+        Atomically writes the aggregated measurements to the file.
+    """
+
+    def __init__(self, path, prefix='mars_'):
+        """
+        Initialises PrometheusFileSink object.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file the measurements are dumped to
+        prefix : str, optional
+            Prefix of all exported metric names (default is 'mars_')
+        """
+
+        super().__init__()
+        self.path = path
+        self.prefix = prefix
+
+    def render(self):
+        """
+        Returns the aggregated measurements in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            Measurements in the Prometheus text format
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self.__metric_name(name) + '_total'
+            lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+        for name, stats in sorted(snapshot['timings'].items()):
+            metric = self.__metric_name(name) + '_seconds'
+            lines += ['# TYPE {} summary'.format(metric),
+                      '{}_count {}'.format(metric, stats['count']),
+                      '{}_sum {!r}'.format(metric, stats['total'])]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """
+        Atomically writes the aggregated measurements to the file.
+        """
+
+        # imported lazily, the module is imported by every process but only few of them dump measurements
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                file.write(self.render())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def __metric_name(self, name):
+        return self.prefix + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class RequestTrace(MetricsSink):
+    """
+    This class records the measurements of a single request. It is activated for the current thread or task with the
+    with statement, measurements made in other requests are not recorded.
+
+    ...
+
+    Attributes
+    ----------
+    counters : dict of (str, int)
+        Values of the counters in the request
+    spans : list of (str, float, float)
+        Name, start offset from the beginning of the trace and duration of every measured operation, in the order in
+        which the operations finished
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises RequestTrace object.
+    public void count(self, name, value)
+        Records an increment of the counter.
+    public void timing(self, name, seconds)
+        Records a single duration measurement.
+    public dict of (str, float) totals(self)
+        Returns the total time spent in every measured operation.
+    """
+
+    def __init__(self):
+        """
+        Initialises RequestTrace object.
+        """
+
+        self.counters = {}
+        self.spans = []
+        self.__started = None
+        self.__token = None
+
+    def count(self, name, value):
+        """
+        Records an increment of the counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter
+        value : int
+            Increment of the counter
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        """
+        Records a single duration measurement.
+
+        Parameters
+        ----------
+        name : str
+            Name of the measured operation
+        seconds : float
+            Duration of the operation in seconds
+        """
+
+        self.spans.append((name, time.perf_counter() - seconds - self.__started, seconds))
+
+    def totals(self):
+        """
+        Returns the total time spent in every measured operation.
+
+        Returns
+        -------
+        dict of (str, float)
+            Total duration of every measured operation in seconds
+        """
+
+        totals = {}
+        for name, _, seconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def __enter__(self):
+        global _active_traces
+        self.__started = time.perf_counter()
+        self.__token = _current_trace.set(self)
+        with _lock:
+            _active_traces += 1
+            _refresh()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_traces
+        _current_trace.reset(self.__token)
+        with _lock:
+            _active_traces -= 1
+            _refresh()
+        return False
+
+
+def add_sink(sink):
+    """
+    Registers the sink and enables instrumentation.
+
+    Parameters
+    ----------
+    sink : MetricsSink
+        Sink that receives all measurements
+    """
+
+    global _sinks
+    with _lock:
+        _sinks = _sinks + (sink,)
+        _refresh()
+
+
+def remove_sink(sink):
+    """
+    Unregisters the sink. Instrumentation is disabled when no sink is registered and no trace is active.
+
+    Parameters
+    ----------
+    sink : MetricsSink
+        Registered sink
+    """
+
+    global _sinks
+    with _lock:
+        _sinks = tuple(registered for registered in _sinks if registered is not sink)
+        _refresh()
+
+
+def count(name, value=1):
+    """
+    Sends an increment of the counter to all sinks. Callers should check enabled first.
+
+    Parameters
+    ----------
+    name : str
+        Name of the counter
+    value : int, optional
+        Increment of the counter (default is 1)
+    """
+
+    for sink in _sinks:
+        sink.count(name, value)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def timing(name, seconds):
+    """
+    Sends a duration measurement to all sinks. Callers should check enabled first.
+
+    Parameters
+    ----------
+    name : str
+        Name of the measured operation
+    seconds : float
+        Duration of the operation in seconds
+    """
+
+    for sink in _sinks:
+        sink.timing(name, seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.timing(name, seconds)
+
+
+def _refresh():
+    global enabled
+    enabled = bool(_sinks) or _active_traces > 0
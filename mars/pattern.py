@@ -1,5 +1,13 @@
+import ast
+import copy
+import math
 from abc import ABC, abstractmethod
 
+from .ast_utils import holds_nodes
+
+# score lost by every wildcard of a pattern in recommendation_score
+WILDCARD_PENALTY = 0.25
+
 
 class Pattern:
     """
@@ -15,13 +23,22 @@ class Pattern:
         AST of modified code
     edit_script : EditScript
         EditScript object that describes how to transform the original AST to modified AST
+    pattern_id : int
+        Identifier of the pattern in the database, None if the pattern has not been saved yet
+    occurrences : int
+        Number of times the pattern was mined, duplicates are merged into a single pattern by summing their
+        occurrences
 
     Methods
     -------
-    __init__(self, original, modified, edit_script)
+    __init__(self, original, modified, edit_script, pattern_id=None, occurrences=1)
         Initialises Pattern object.
     """
-    def __init__(self, original, modified, edit_script):
+
+    # default for patterns serialized before occurrences were counted
+    occurrences = 1
+
+    def __init__(self, original, modified, edit_script, pattern_id=None, occurrences=1):
         """
         Initialises Pattern object
 
@@ -33,17 +50,162 @@ class Pattern:
             AST of modified code
         edit_script : EditScript
             EditScript object that describes how to transform the original AST to modified AST
+        pattern_id : int, optional
+            Identifier of the pattern in the database (default is None)
+        occurrences : int, optional
+            Number of times the pattern was mined (default is 1)
         """
 
         self.original = original
         self.modified = modified
         self.edit_script = edit_script
+        self.pattern_id = pattern_id
+        self.occurrences = occurrences
+
+
+class Wildcard(ast.AST):
+    """
+    A class that represents a wildcard node in the pattern AST. Wildcards are created in the refinement process and
+    they match any node, together with its whole subtree, in the code that is checked for matches.
+    """
+
+    _fields = ()
+
+
+def root_node_type(pattern):
+    """
+    Returns the name of the node type the pattern starts with.
+
+    Patterns are usually created from parsed modules, so the module node itself is skipped and the type of its first
+    statement is used instead.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose root node type is returned
+
+    Returns
+    -------
+    str
+        Name of the AST node type of the pattern root, None if the pattern has no original AST
+    """
+
+    root = pattern.original
+    if isinstance(root, ast.Module):
+        root = root.body[0] if root.body else None
+    return type(root).__name__ if root is not None else None
+
+
+def recommendation_score(pattern):
+    """
+    Returns the score by which the recommendations of the pattern are ranked. Frequency, the occurrences of the
+    pattern, and specificity, the number of its nodes that are not wildcards, add up on a logarithmic scale, so
+    neither of them dominates. Every wildcard lowers the score by WILDCARD_PENALTY, since a pattern generalised by
+    wildcards matches code that is less similar to the code it was created from.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose score is returned
+
+    Returns
+    -------
+    float
+        Score of the pattern, higher scores are ranked first
+    """
+
+    roots = pattern.original.body if isinstance(pattern.original, ast.Module) else [pattern.original]
+    wildcards = concrete = 0
+    for root in roots:
+        for node in ast.walk(root):
+            if isinstance(node, Wildcard):
+                wildcards += 1
+            else:
+                concrete += 1
+    return math.log1p(pattern.occurrences) + math.log1p(concrete) - WILDCARD_PENALTY * wildcards
+
+
+def edit_signature(pattern):
+    """
+    Returns the signature of the pattern's EditScript, the names of its change operations in execution order.
+
+    Patterns with equal signatures transform the code in the same way, so the signature is used for finding patterns
+    that describe similar changes.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose signature is returned
+
+    Returns
+    -------
+    str
+        Comma-separated names of the change operation types, empty if the pattern has no change operations
+    """
+
+    changes = pattern.edit_script.materialize() if pattern.edit_script is not None else None
+    return ','.join(type(change).__name__ for change in changes or ())
+
+
+def canonical_hash(pattern):
+    """
+    Returns the canonical hash of the pattern. Patterns with structurally equal original and modified ASTs and equal
+    EditScripts have equal hashes, positions of the nodes in the source code, identifiers and occurrences of the
+    patterns are ignored. The hash covers every operation, so a lazily produced EditScript is materialized.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose hash is returned
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-256 digest of the canonical form of the pattern
+    """
+
+    # imported lazily, hashes are computed only when patterns are saved
+    import hashlib
+
+    changes = pattern.edit_script.materialize() if pattern.edit_script is not None else None
+    parts = (_canonical_form(pattern.original), _canonical_form(pattern.modified), _canonical_form(list(changes or ())))
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _canonical_form(value):
+    """
+    Returns the string that describes the structure of the AST, change operation or a list of them.
+
+    Parameters
+    ----------
+    value : object
+        AST, ChangeOperation, list of them or a constant
+
+    Returns
+    -------
+    str
+        Canonical form of the value
+    """
+
+    if isinstance(value, ast.AST):
+        return ast.dump(value, include_attributes=False)
+    if isinstance(value, ChangeOperation):
+        return '{}({})'.format(type(value).__name__, ', '.join(
+            '{}={}'.format(name, _canonical_form(attribute)) for name, attribute in sorted(vars(value).items())))
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(_canonical_form(item) for item in value))
+    return repr(value)
 
 
 class EditScript:
     """
     A class that represents a collection of operations which, when executed, change the original AST to modified AST
 
+    Operations can be produced lazily by an iterator, such as a generator of EditScriptGenerator. They are then taken
+    from it only when they are needed by __next__ or get, so a consumer that stops after the first few operations never
+    pays for the rest of the script. The changes attribute holds the operations produced so far, materialize returns
+    all of them.
+
     ...
 
     Attributes
@@ -51,11 +213,12 @@ class EditScript:
     changes : list of ChangeOperation
         List  that  contains  all  change operations  that  need  to  be  executed  on  original  AST  to transform
         it to modified AST. Change operations are ordered by their execution priority (it is not guaranteed that the
-        different execution order of change operations  will result with the correct modified AST)
+        different execution order of change operations  will result with the correct modified AST). If the operations
+        are produced lazily, only the ones produced so far.
 
     Methods
     -------
-    __init__(self, original, modified, edit_script)
+    __init__(self, changes, operations)
         Initialises EditScript object
     __iter__(self)
         Creates the Iterator object
@@ -65,8 +228,16 @@ class EditScript:
         Returns ChangeOperation object at the specified index in changes
     add(self, change)
         Adds the specified ChangeOperation in changes
+    materialize(self)
+        Produces all pending operations and returns the complete list of changes
     """
-    def __init__(self, changes=None):
+
+    # position of the next change returned by __next__, default for scripts serialized without it
+    __position = 0
+    # iterator of the operations that were not produced yet, None if all of them are in changes
+    __operations = None
+
+    def __init__(self, changes=None, operations=None):
         """
         Initialises EditScript object
 
@@ -74,9 +245,15 @@ class EditScript:
         ----------
         changes : list of ChangeOperation
             List that contains change operations(default is None)
+        operations : iterable of ChangeOperation
+            Operations that follow the changes and are produced only when they are needed (default is None)
         """
 
         self.changes = changes
+        if operations is not None:
+            if self.changes is None:
+                self.changes = []
+            self.__operations = iter(operations)
 
     def __iter__(self):
         """
@@ -88,7 +265,8 @@ class EditScript:
             Iterator object that iterates through changes
         """
 
-        pass
+        self.__position = 0
+        return self
 
     def __next__(self):
         """
@@ -98,9 +276,27 @@ class EditScript:
         -------
         ChangeOperation
             The next ChangeOperation in changes list
+
+        Raises
+        ------
+        StopIteration
+            If all change operations were returned
         """
 
-        pass
+        if self.__produce(self.__position + 1) <= self.__position:
+            raise StopIteration
+        self.__position += 1
+        return self.changes[self.__position - 1]
+
+    def __getstate__(self):
+        """
+        Produces all pending operations before the script is serialized or copied, since the iterator can be neither.
+        The position of the iteration is not part of the state, a restored script starts from its first change.
+        """
+
+        self.materialize()
+        return {name: value for name, value in self.__dict__.items()
+                if name not in ('_EditScript__position', '_EditScript__operations')}
 
     def get(self, index):
         """
@@ -122,7 +318,13 @@ class EditScript:
             If the specified index is out of range
         """
 
-        pass
+        if index < 0:
+            self.materialize()
+        elif self.__produce(index + 1) <= index:
+            raise IndexError('EditScript index out of range')
+        if self.changes is None:
+            raise IndexError('EditScript index out of range')
+        return self.changes[index]
 
     def add(self, change):
         """
@@ -134,13 +336,50 @@ class EditScript:
             ChangeOperation to be added in changes
         """
 
-        pass
+        self.materialize()
+        if self.changes is None:
+            self.changes = []
+        self.changes.append(change)
+
+    def materialize(self):
+        """
+        Produces all pending operations and returns the complete list of changes
+
+        Returns
+        -------
+        list of ChangeOperation
+            All change operations, None if the script has none
+        """
+
+        self.__produce(None)
+        return self.changes
+
+    def __produce(self, count):
+        """
+        Takes operations from the pending iterator until there are count changes or no operations are left, None
+        takes all of them. Returns the number of changes.
+        """
+
+        if self.__operations is not None:
+            if count is not None and len(self.changes) >= count:
+                return len(self.changes)
+            for change in self.__operations:
+                self.changes.append(change)
+                if count is not None and len(self.changes) >= count:
+                    return len(self.changes)
+            # the exhausted iterator is dropped, so the script is serialized like any other
+            del self.__operations
+        return len(self.changes) if self.changes is not None else 0
 
 
 class ChangeOperation(ABC):
     """
     A class that represents the operations used to transform the original code to modified code.
 
+    Nodes are addressed by their preorder index (the order of ast.iter_child_nodes, starting with 0 at the root) in
+    the AST the operation is applied to, so every operation of an EditScript refers to the AST as it is after the
+    preceding operations were applied.
+
     ...
 
     Methods
@@ -186,6 +425,9 @@ class Insert(ChangeOperation):
     A class that implements the insert change operation logic. It contains index of the node in the original AST where
     insert operation should be applied. It also contains AST that should be inserted at that position.
 
+    The AST is inserted as a child of the node at index, into the received field at the received position if the
+    field holds a list of nodes. Inserting into a field that holds a single node replaces the node that is there.
+
     ...
 
     Attributes
@@ -194,16 +436,20 @@ class Insert(ChangeOperation):
         Index of the node where insert operation should be applied
     change : ast
         AST of inserted code
+    field : str
+        Name of the field of the node at index the AST is inserted into, None if the AST replaces the node at index
+    position : int
+        Position in the list held by the field, None if the field holds a single node
 
     Methods
     -------
-    __init__(self, index, change)
+    __init__(self, index, change, field, position)
         Initialises Insert object.
     make_change(self, ast)
         Applies the insert operation to the received AST.
     """
 
-    def __init__(self, index, change):
+    def __init__(self, index, change, field=None, position=None):
         """
         Initialises Insert object.
 
@@ -213,14 +459,20 @@ class Insert(ChangeOperation):
             Index of the node
         change : ast
             AST of inserted code
+        field : str, optional
+            Name of the field the AST is inserted into (default is None, the AST replaces the node at index)
+        position : int, optional
+            Position in the list held by the field (default is None, the field holds a single node)
         """
 
         self.index = index
         self.change = change
+        self.field = field
+        self.position = position
 
     def make_change(self, original):
         """
-        Applies the insert operation to the received AST.
+        Applies the insert operation to the received AST. The AST is changed in place, the inserted AST is copied.
 
         Parameters
         ----------
@@ -236,7 +488,13 @@ class Insert(ChangeOperation):
         IndexError
             If the specified index is out of range
         """
-        pass
+
+        node, parent, field = _locate(original, self.index)
+        change = copy.deepcopy(self.change)
+        if self.field is None:
+            return _replace(original, node, parent, field, change)
+        _attach(node, self.field, self.position, change)
+        return original
 
     def __str__(self):
         """
@@ -247,12 +505,16 @@ class Insert(ChangeOperation):
         string
             Human-readable interpretation of Insert
         """
-        pass
+
+        if self.field is None:
+            return 'Insert {} at {}'.format(_describe(self.change), self.index)
+        return 'Insert {} into {}'.format(_describe(self.change), _target(self.index, self.field, self.position))
 
 
 class Delete(ChangeOperation):
     """
     A class that implements the delete change operation logic. It deletes the node from AST at the specified index.
+    The whole subtree of the node is deleted.
 
     ...
 
@@ -283,7 +545,7 @@ class Delete(ChangeOperation):
 
     def make_change(self, original):
         """
-        Applies the delete operation to the received AST.
+        Applies the delete operation to the received AST. The AST is changed in place.
 
         Parameters
         ----------
@@ -299,7 +561,10 @@ class Delete(ChangeOperation):
         IndexError
             If the specified index is out of range
         """
-        pass
+
+        node, parent, field = _locate(original, self.index)
+        _detach(node, parent, field)
+        return original
 
     def __str__(self):
         """
@@ -310,13 +575,15 @@ class Delete(ChangeOperation):
         string
             Human-readable interpretation of Delete
         """
-        pass
+
+        return 'Delete {}'.format(self.index)
 
 
 class Update(ChangeOperation):
     """
     A class that implements the update change operation logic. It wraps a combination of an Insert operation and Delete
-    operation into one.
+    operation into one. The label of the node (the values of its fields that are not nodes, such as identifiers and
+    constants) is replaced by the label of the inserted node, the children of the node are kept.
 
     ...
 
@@ -344,14 +611,15 @@ class Update(ChangeOperation):
         index : int
             Index of the node that should be updated
         change : ast
-            AST of updated code
+            AST of updated code, only the values of its fields that are not nodes are used
         """
 
-        pass
+        self.insert_operation = Insert(index, change)
+        self.delete_operation = Delete(index)
 
     def make_change(self, original):
         """
-        Applies the update operation to the received AST.
+        Applies the update operation to the received AST. The AST is changed in place.
 
         Parameters
         ----------
@@ -367,7 +635,14 @@ class Update(ChangeOperation):
         IndexError
             If the specified index is out of range
         """
-        pass
+
+        node, _, _ = _locate(original, self.delete_operation.index)
+        change = self.insert_operation.change
+        for field in node._fields:
+            value = getattr(change, field, None)
+            if not holds_nodes(value) and not holds_nodes(getattr(node, field, None)):
+                setattr(node, field, copy.deepcopy(value))
+        return original
 
     def __str__(self):
         """
@@ -378,7 +653,8 @@ class Update(ChangeOperation):
         string
             Human-readable interpretation of Update
         """
-        pass
+
+        return 'Update {} to {}'.format(self.delete_operation.index, _describe(self.insert_operation.change))
 
 
 class Move(ChangeOperation):
@@ -386,6 +662,9 @@ class Move(ChangeOperation):
     A  class  that  implements  the  move  change  operation  logic.  It  combines  the  delete  and  insert operation
     in a way that it deletes the AST node at first index and then inserts the deleted AST node at the second index.
 
+    Both indexes refer to the AST before the node is moved. The node is moved together with its subtree into the field
+    of the node at insert index, the position in a list field is the position after the node was removed.
+
     ...
 
     Attributes
@@ -397,13 +676,13 @@ class Move(ChangeOperation):
 
     Methods
     -------
-    __init__(self, insert_index, delete_index)
+    __init__(self, insert_index, delete_index, field, position)
         Initialises Move object. It creates Insert and Delete operations which combined implement move logic.
     make_change(self, ast)
         Applies the move operation to the received AST.
     """
 
-    def __init__(self, insert_index, delete_index):
+    def __init__(self, insert_index, delete_index, field=None, position=None):
         """
         Initialises Move object. It creates Insert and Delete operations which combined implement move logic.
 
@@ -413,13 +692,19 @@ class Move(ChangeOperation):
             The position in the AST to which node needs to be moved
         delete_index : ast
             The position of the AST node that needs to be moved
+        field : str, optional
+            Name of the field of the node at insert index the node is moved into (default is None, the moved node
+            replaces the node at insert index)
+        position : int, optional
+            Position in the list held by the field (default is None, the field holds a single node)
         """
 
-        pass
+        self.insert_operation = Insert(insert_index, None, field, position)
+        self.delete_operation = Delete(delete_index)
 
     def make_change(self, original):
         """
-        Applies the move operation to the received AST.
+        Applies the move operation to the received AST. The AST is changed in place.
 
         Parameters
         ----------
@@ -435,7 +720,15 @@ class Move(ChangeOperation):
         IndexError
             If the specified index is out of range
         """
-        pass
+
+        insert = self.insert_operation
+        target, target_parent, target_field = _locate(original, insert.index)
+        node, parent, field = _locate(original, self.delete_operation.index)
+        _detach(node, parent, field)
+        if insert.field is None:
+            return _replace(original, target, target_parent, target_field, node)
+        _attach(target, insert.field, insert.position, node)
+        return original
 
     def __str__(self):
         """
@@ -446,4 +739,111 @@ class Move(ChangeOperation):
         string
             Human-readable interpretation of Move
         """
-        pass
+
+        insert = self.insert_operation
+        if insert.field is None:
+            return 'Move {} to {}'.format(self.delete_operation.index, insert.index)
+        return 'Move {} into {}'.format(self.delete_operation.index,
+                                        _target(insert.index, insert.field, insert.position))
+
+
+def _locate(tree, index):
+    """
+    Returns the node at the preorder index together with its parent and the field of the parent that holds it.
+
+    Parameters
+    ----------
+    tree : ast
+        Root of the AST
+    index : int
+        Preorder index of the node
+
+    Returns
+    -------
+    ast, ast, str
+        The node, its parent and the name of the field, None for the parent and the field of the root
+
+    Raises
+    ------
+    IndexError
+        If the AST has fewer nodes than the index
+    """
+
+    if index >= 0:
+        stack = [(tree, None, None)]
+        while stack:
+            node, parent, field = stack.pop()
+            if index == 0:
+                return node, parent, field
+            index -= 1
+            for name in reversed(node._fields):
+                value = getattr(node, name, None)
+                if isinstance(value, ast.AST):
+                    stack.append((value, node, name))
+                elif isinstance(value, list):
+                    stack.extend((item, node, name) for item in reversed(value) if isinstance(item, ast.AST))
+    raise IndexError('AST node index out of range')
+
+
+def _detach(node, parent, field):
+    """
+    Removes the node from the field of its parent.
+    """
+
+    if parent is None:
+        raise IndexError('The root of the AST can not be removed')
+    value = getattr(parent, field)
+    if isinstance(value, list):
+        del value[next(position for position, item in enumerate(value) if item is node)]
+    else:
+        setattr(parent, field, None)
+
+
+def _attach(parent, field, position, node):
+    """
+    Inserts the node into the field of the parent, a node in a single node field is replaced.
+    """
+
+    value = getattr(parent, field, None)
+    if position is None:
+        setattr(parent, field, node)
+    elif not 0 <= position <= len(value):
+        raise IndexError('Position {} is out of range of field {}'.format(position, field))
+    else:
+        value.insert(position, node)
+
+
+def _replace(tree, node, parent, field, replacement):
+    """
+    Puts the replacement in place of the node and returns the root of the AST.
+    """
+
+    if parent is None:
+        return replacement
+    value = getattr(parent, field)
+    if isinstance(value, list):
+        value[next(position for position, item in enumerate(value) if item is node)] = replacement
+    else:
+        setattr(parent, field, replacement)
+    return tree
+
+
+def _describe(node):
+    """
+    Returns the source code of the AST, or its node type and label if the AST is not complete.
+    """
+
+    try:
+        return ast.unparse(node) or type(node).__name__
+    except AttributeError:
+        values = ('{}={!r}'.format(field, getattr(node, field)) for field in node._fields
+                  if getattr(node, field, None) is not None and not holds_nodes(getattr(node, field)))
+        return '{}({})'.format(type(node).__name__, ', '.join(values))
+
+
+def _target(index, field, position):
+    """
+    Returns the human-readable location in the field of the node at index.
+    """
+
+    return '{}.{}'.format(index, field) if position is None else '{}.{}[{}]'.format(index, field, position)
@@ -0,0 +1,246 @@
+import ast
+import threading
+
+from .pattern import Wildcard
+
+
+class PatternCompiler:
+    """
+    This class compiles pattern nodes into checks, functions that receive an uploaded node and return True if it
+    matches the pattern node. A check compares the uploaded node with the values precomputed from the pattern node,
+    the type name, the fields that are not nodes and the number of nodes in the lists of nodes, field by field and
+    stops at the first difference. The label of the uploaded node is never built, so the pattern is not interpreted
+    again on every comparison. A node matches if and only if its label equals the label of the pattern node, see
+    match_label.
+
+    Checks are cached by the shape of the pattern node, its type name, the values of the fields that are not nodes and
+    the fields that hold nodes with the number of nodes in every list. Nodes with equal shapes, which are common
+    across patterns, share a single check and a compiler shared by the loader compiles only the nodes of new patterns
+    when the pattern set is reloaded.
+
+    ...
+
+    Attributes
+    ----------
+    checks : dict of (tuple, callable)
+        Compiled checks indexed by the shapes of the pattern nodes
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises PatternCompiler object.
+    public int __len__(self)
+        Returns the number of compiled checks.
+    public callable compile_node(self, node)
+        Returns the check of the pattern node, compiling it if needed.
+    public callable compile_shape(self, shape)
+        Returns the check of the pattern nodes with the shape, compiling it if needed.
+    public list of callable compile(self, nodes)
+        Returns the checks of the pattern nodes.
+    """
+
+    def __init__(self):
+        """
+        Initialises PatternCompiler object.
+        """
+
+        self.checks = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of compiled checks.
+
+        Returns
+        -------
+        int
+            Number of compiled checks
+        """
+
+        return len(self.checks)
+
+    def compile_node(self, node):
+        """
+        Returns the check of the pattern node, compiling it if needed.
+
+        Parameters
+        ----------
+        node : ast
+            Pattern node
+
+        Returns
+        -------
+        callable
+            Check of the node, None for wildcard nodes
+        """
+
+        if isinstance(node, Wildcard):
+            return None
+        return self.compile_shape(node_shape(node))
+
+    def compile_shape(self, shape):
+        """
+        Returns the check of the pattern nodes with the shape, compiling it if needed. Used for shapes that were
+        computed before the patterns were loaded.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the pattern nodes, see node_shape
+
+        Returns
+        -------
+        callable
+            Check of the nodes
+        """
+
+        check = self.checks.get(shape)
+        if check is None:
+            with self.__lock:
+                check = self.checks.setdefault(shape, _compile_shape(*shape))
+        return check
+
+    def compile(self, nodes):
+        """
+        Returns the checks of the pattern nodes.
+
+        Parameters
+        ----------
+        nodes : list of ast
+            Nodes of the pattern in the order in which they are matched
+
+        Returns
+        -------
+        list of callable
+            Checks of the nodes, None for wildcard nodes
+        """
+
+        return [self.compile_node(node) for node in nodes]
+
+
+def compile_node(node):
+    """
+    Compiles the pattern node into a check without caching it.
+
+    Parameters
+    ----------
+    node : ast
+        Pattern node
+
+    Returns
+    -------
+    callable
+        Check of the node, None for wildcard nodes
+    """
+
+    return None if isinstance(node, Wildcard) else _compile_shape(*node_shape(node))
+
+
+def node_shape(node):
+    """
+    Returns the shape of the pattern node. The shape describes the fields the same way match_label does, the fields
+    that hold a single node are described by their names instead of being left out.
+
+    Parameters
+    ----------
+    node : ast
+        Pattern node
+
+    Returns
+    -------
+    str, tuple, tuple, tuple
+        Type name of the node, (field, type name, value) of every field that does not hold nodes, names of the fields
+        that hold a single node and (field, number of nodes) of every field that holds a list of nodes
+    """
+
+    values = []
+    children = []
+    lists = []
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, ast.AST):
+            children.append(field)
+            continue
+        if isinstance(value, list):
+            if any(isinstance(item, ast.AST) for item in value):
+                lists.append((field, len(value)))
+                continue
+            value = tuple(value)
+        values.append((field, type(value).__name__, value))
+    return type(node).__name__, tuple(values), tuple(children), tuple(lists)
+
+
+def shape_label(shape):
+    """
+    Returns the label of the pattern nodes with the shape, equal to the label returned by match_label.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the pattern nodes, see node_shape
+
+    Returns
+    -------
+    tuple
+        Label of the nodes
+    """
+
+    return (shape[0],) + shape[1] + tuple((field, 'list', count) for field, count in shape[3])
+
+
+def _compile_shape(type_name, values, children, lists):
+    """
+    Creates the check of the pattern nodes with the received shape. The most common shapes, nodes without fields and
+    nodes with a single value and at most one child, get checks without loops.
+    """
+
+    if not values and not lists and not children:
+        def check(node):
+            return type(node).__name__ == type_name
+        return check
+
+    if len(values) == 1 and not lists and len(children) <= 1:
+        (field, value_type, expected), = values
+        child = children[0] if children else None
+
+        def check(node):
+            if type(node).__name__ != type_name:
+                return False
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if _holds_nodes(value):
+                    return False
+                value = tuple(value)
+            if type(value).__name__ != value_type or value != expected:
+                return False
+            return child is None or isinstance(getattr(node, child, None), ast.AST)
+        return check
+
+    def check(node):
+        if type(node).__name__ != type_name:
+            return False
+        for field, value_type, expected in values:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if _holds_nodes(value):
+                    return False
+                value = tuple(value)
+            if type(value).__name__ != value_type or value != expected:
+                return False
+        for field in children:
+            if not isinstance(getattr(node, field, None), ast.AST):
+                return False
+        for field, count in lists:
+            value = getattr(node, field, None)
+            if not isinstance(value, list) or len(value) != count or not _holds_nodes(value):
+                return False
+        return True
+    return check
+
+
+def _holds_nodes(values):
+    """
+    Checks if the list of field values holds any AST node.
+    """
+
+    return any(isinstance(item, ast.AST) for item in values)
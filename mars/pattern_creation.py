@@ -1,3 +1,16 @@
+import ast
+import bisect
+import copy
+import itertools
+import os
+import time
+from collections import defaultdict, deque
+
+from . import instrumentation, pattern_serialization
+from .ast_utils import SubtreeHasher, holds_nodes, preorder, preorder_with_ends
+from .pattern import Delete, EditScript, Insert, Move, Pattern, Update
+
+
 class PatternCreator:
     """
     A class that  is responsible for creating basic patterns from
@@ -20,8 +33,12 @@ class PatternCreator:
         Initialises PatternCreator object.
     public Pattern create_pattern(self, original, modified)
         Creates a pattern from original and modified code files.
-    public void save_pattern(self, created_pattern)
-        Saves a pattern to a database in context attribute.
+    public list of Pattern create_method_patterns(self, original, modified)
+        Creates a pattern for every method changed between original and modified code files.
+    public Pattern save_pattern(self, created_pattern)
+        Saves a pattern to a database in context attribute, merging it with a saved duplicate.
+    public list of Pattern save_patterns(self, patterns)
+        Saves the patterns to a database in context attribute in bulk, merging duplicates.
     """
     def __init__(self, context, ast_parser, script_generator):
         """
@@ -37,7 +54,9 @@ class PatternCreator:
             Object used to generate EditScript from original and modified code
         """
 
-        pass
+        self.context = context
+        self.ast_parser = ast_parser
+        self.script_generator = script_generator
 
     def create_pattern(self, original_file, modified_file):
         """
@@ -55,18 +74,101 @@ class PatternCreator:
         Pattern
             Pattern object created from original and modified code
         """
-        pass
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        original = self.ast_parser.parse(original_file.read())
+        modified = self.ast_parser.parse(modified_file.read())
+        if self.__shares_trees():
+            original, modified = _copy_tree(original), _copy_tree(modified)
+        if started is not None:
+            instrumentation.timing('pattern_creator.parse', time.perf_counter() - started)
+        return Pattern(original, modified, self.script_generator.generate(original, modified))
+
+    def create_method_patterns(self, original_file, modified_file):
+        """
+        Creates a pattern for every method changed between original and modified code files. Functions defined at the
+        top level of the modules and in their classes are paired by their qualified names, the remaining ones by their
+        parameters and bodies, so a renamed function is paired as well. Pairs with equal subtree hashes are skipped and
+        only the changed methods are diffed, every one into its own pattern whose ASTs are modules that contain just
+        the method. Functions that are only in one of the files are not paired and produce no pattern.
+
+        Parameters
+        ----------
+        original_file : File
+            File in which the original code is written
+        modified_file : File
+            File in which the modified code is written
+
+        Returns
+        -------
+        list of Pattern
+            Patterns of the changed methods in the order of their definitions in the original file
+        """
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        original = self.ast_parser.parse(original_file.read())
+        modified = self.ast_parser.parse(modified_file.read())
+        if started is not None:
+            instrumentation.timing('pattern_creator.parse', time.perf_counter() - started)
+
+        patterns = []
+        shared = self.__shares_trees()
+        for original_method, modified_method, changed in _pair_methods(original, modified):
+            if not changed:
+                continue
+            if shared:
+                original_method, modified_method = _copy_tree(original_method), _copy_tree(modified_method)
+            original_module = ast.Module(body=[original_method], type_ignores=[])
+            modified_module = ast.Module(body=[modified_method], type_ignores=[])
+            edit_script = self.script_generator.generate(original_module, modified_module)
+            patterns.append(Pattern(original_module, modified_module, edit_script))
+        if instrumentation.enabled:
+            instrumentation.count('pattern_creator.changed_methods', len(patterns))
+        return patterns
 
     def save_pattern(self, pattern):
         """
-        Saves a pattern to a database in context attribute.
+        Saves a pattern to a database in context attribute. If a structurally equal pattern is already saved, the
+        pattern is merged into it by increasing its occurrences instead of being saved again.
 
         Parameters
         ----------
-        created_pattern : Pattern
+        pattern : Pattern
             Pattern that is going to be saved in the pattern database
+
+        Returns
+        -------
+        Pattern
+            Pattern as it is saved in the database, the received pattern or the one it was merged into
+        """
+
+        return self.context.merge_patterns([pattern])[0]
+
+    def save_patterns(self, patterns):
+        """
+        Saves the patterns to a database in context attribute in bulk. Duplicates among the patterns and of the saved
+        patterns are merged like in save_pattern.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the pattern database
+
+        Returns
+        -------
+        list of Pattern
+            For every received pattern, the pattern it is saved as in the database
         """
-        pass
+
+        return self.context.merge_patterns(patterns)
+
+    def __shares_trees(self):
+        """
+        Returns True if the ASTs returned by the parser are shared with other users, like the ones of a
+        CachingASTParser. Patterns are changed in place by refinement, so they are created from copies of them.
+        """
+
+        return getattr(self.ast_parser, 'parse_source', None) is not None
 
 
 class EditScriptGenerator:
@@ -74,25 +176,42 @@ class EditScriptGenerator:
     A class that is responsible for generating the EditScript object
     from ASTs of original and modified codes.
 
+    The script is generated in the style of Chawathe et al. The modified AST is visited in preorder and every node is
+    inserted, moved or updated in a working copy of the original AST, so it ends up at the place of its partner.
+    Children that keep their relative order are found as the longest increasing subsequence of their positions and
+    stay in place, only the others are moved. Whole unmatched subtrees are inserted and deleted by a single operation.
+    Every operation refers to the AST as it is after the preceding operations were applied.
+
+    With more than one process, methods of the modules that are paired by their names anchor independent subtrees.
+    The changed ones are connected and scripted in worker processes, the rest of the modules with every paired method
+    replaced by a placeholder in this process. The partial mappings and scripts are shifted by the preorder indexes of
+    the methods and stitched into the result.
+
     ...
 
     Attributes
     ----------
     tree_differencer : TreeDifferencer
         Object that is responsible for connecting the same nodes in
-        original and modified code ASTs
+        original and modified code ASTs, it needs to be picklable for more than one process
+    processes : int
+        Maximum number of worker processes, 1 if the ASTs are compared in this process
+    min_methods : int
+        Minimum number of changed methods for which the worker processes are used
 
     Methods
     -------
-    public __init__(self, tree_differencer)
+    public __init__(self, tree_differencer, processes, min_methods)
         Initialises EditScriptGenerator object.
     public EditScript generate(self, original, modified)
         Generates an EditScript object from original and modified
         code ASTs that describes the modifications necessary to transform
         the original AST to modified AST.
+    public EditScript generate_script(self, original, modified, mapping)
+        Generates an EditScript object from the ASTs and the mapping of their corresponding nodes.
 
     """
-    def __init__(self, tree_differencer):
+    def __init__(self, tree_differencer, processes=1, min_methods=2):
         """
         Initialises EditScriptGenerator object
 
@@ -101,8 +220,16 @@ class EditScriptGenerator:
         tree_differencer : TreeDifferencer
             Object that is responsible for connecting the same nodes in
             original and modified code ASTs
+        processes : int, optional
+            Maximum number of worker processes (default is 1, the ASTs are compared in this process), None for the
+            number of available cores
+        min_methods : int, optional
+            Minimum number of changed methods for which the worker processes are used (default is 2)
         """
-        pass
+
+        self.tree_differencer = tree_differencer
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.min_methods = min_methods
 
     def generate(self, first_ast, second_ast):
         """
@@ -121,9 +248,310 @@ class EditScriptGenerator:
         -------
         EditScript
             Generated EditScript object that describes the modifications
-            necessary to transform the original AST to modified AST
+            necessary to transform the original AST to modified AST. Its
+            operations are produced lazily, the ASTs must not be changed
+            until they are all produced.
+        """
+
+        if self.processes > 1:
+            edit_script = self.__generate_parallel(first_ast, second_ast)
+            if edit_script is not None:
+                return edit_script
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        mapping = self.tree_differencer.connect_nodes(first_ast, second_ast)
+        if started is not None:
+            instrumentation.timing('pattern_creator.diff', time.perf_counter() - started)
+        return self.__generate_script(first_ast, second_ast, mapping)
+
+    def generate_script(self, first_ast, second_ast, mapping):
+        """
+        Generates an EditScript object from the ASTs and the mapping of their corresponding nodes, as computed by
+        TreeDifferencer.connect_nodes.
+
+        Parameters
+        ----------
+        first_ast : ast
+            AST of original code
+        second_ast : ast
+            AST of modified code
+        mapping : dict of (int, int)
+            Dictionary of corresponding AST node indexes, the roots need to be connected
+
+        Returns
+        -------
+        EditScript
+            Generated EditScript object whose operations are produced lazily
+        """
+
+        return self.__generate_script(first_ast, second_ast, mapping)
+
+    def __generate_parallel(self, first_ast, second_ast):
+        """
+        Generates an EditScript object by comparing the changed methods in worker processes.
+
+        Parameters
+        ----------
+        first_ast : ast
+            AST of original code
+        second_ast : ast
+            AST of modified code
+
+        Returns
+        -------
+        EditScript
+            Generated EditScript object, None if there are too few changed methods
+        """
+
+        if not isinstance(first_ast, ast.Module) or not isinstance(second_ast, ast.Module):
+            return None
+        pairs = _pair_methods(first_ast, second_ast)
+        changed = [(method, partner) for method, partner, differs in pairs if differs]
+        if len(changed) < self.min_methods:
+            return None
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        chunks = min(self.processes, len(changed))
+        ordered = sorted(range(len(changed)), key=lambda pair: -_size(changed[pair][0]) - _size(changed[pair][1]))
+        batches = [ordered[chunk::chunks] for chunk in range(chunks)]
+        with ProcessPoolExecutor(max_workers=chunks) as executor:
+            results = executor.map(_diff_methods, [pattern_serialization.dumps([changed[pair] for pair in batch])
+                                                   for batch in batches], [self.tree_differencer] * chunks)
+            diffs = [None] * len(changed)
+            for batch, result in zip(batches, results):
+                for pair, diff in zip(batch, pattern_serialization.loads(result)):
+                    diffs[pair] = diff
+
+        # the rest of the modules, every paired method is replaced by a placeholder
+        placeholders = {}
+        for method, partner, _ in pairs:
+            placeholders[id(method)] = ast.Pass()
+            placeholders[id(partner)] = ast.Pass()
+        sizes = {id(placeholders[id(method)]): _size(method) for pair in pairs for method in pair[:2]}
+        first_skeleton = _substitute(first_ast, placeholders)
+        second_skeleton = _substitute(second_ast, placeholders)
+        first_nodes, first_indexes = _expanded_indexes(first_skeleton, sizes)
+        second_nodes, second_indexes = _expanded_indexes(second_skeleton, sizes)
+        mapping = {}
+        for first, second in self.tree_differencer.connect_nodes(first_skeleton, second_skeleton).items():
+            if id(first_nodes[first]) not in sizes and id(second_nodes[second]) not in sizes:
+                mapping[first_indexes[first]] = second_indexes[second]
+        bases = {}
+        for nodes, indexes in ((first_nodes, first_indexes), (second_nodes, second_indexes)):
+            bases.update((id(node), index) for node, index in zip(nodes, indexes) if id(node) in sizes)
+
+        scripts = []
+        substituted = {}
+        diffs = iter(diffs)
+        for method, partner, differs in pairs:
+            first_base, second_base = bases[id(placeholders[id(method)])], bases[id(placeholders[id(partner)])]
+            if differs:
+                local_mapping, local_script = next(diffs)
+                scripts.append((first_base, local_script))
+                substituted[id(partner)] = (_size(method), second_base, _size(partner))
+            else:
+                local_mapping = [(index, index) for index in range(_size(method))]
+            for first, second in local_mapping:
+                mapping[first_base + first] = second_base + second
+
+        # the methods are scripted first, starting with the last one, so the indexes of the others do not change
+        shifted = (_shifted(change, base) for base, local_script in sorted(scripts, key=lambda script: -script[0])
+                   for change in local_script.materialize())
+        # then the rest is scripted in the module whose changed methods are already equal to the modified ones
+        intermediate = _substitute(first_ast, {id(method): partner for method, partner in changed})
+        nodes = preorder(intermediate)
+        intermediate_mapping = {}
+        index = offset = 0
+        while index < len(nodes):
+            if id(nodes[index]) in substituted:
+                first_size, second_base, second_size = substituted[id(nodes[index])]
+                intermediate_mapping.update((index + local, second_base + local) for local in range(second_size))
+                index += second_size
+                offset += first_size - second_size
+                continue
+            if index + offset in mapping:
+                intermediate_mapping[index] = mapping[index + offset]
+            index += 1
+        rest = self.__generate_script(intermediate, second_ast, intermediate_mapping)
+
+        if started is not None:
+            instrumentation.timing('pattern_creator.parallel_diff', time.perf_counter() - started)
+            instrumentation.count('pattern_creator.parallel_methods', len(changed))
+        return EditScript(operations=itertools.chain(shifted, rest))
+
+    def __generate_script(self, first_ast, second_ast, mapping):
+        """
+        Generates an EditScript object from the ASTs and the mapping of their corresponding nodes.
+
+        Parameters
+        ----------
+        first_ast : ast
+            AST of original code
+        second_ast : ast
+            AST of modified code
+        mapping : dict of (int, int)
+            Dictionary of corresponding AST node indexes
+
+        Returns
+        -------
+        EditScript
+            Generated EditScript object whose operations are produced lazily
+
+        Raises
+        ------
+        ValueError
+            If the roots of the ASTs are not connected
+        """
+
+        if mapping.get(0) != 0:
+            raise ValueError('The roots of the original and modified AST must be connected')
+        # the working copy is made right away, so the original AST may change once the script is created
+        operations = self.__operations(_WorkingTree(first_ast), _IndexedTree(second_ast), mapping)
+        if instrumentation.enabled:
+            operations = _timed_operations(operations)
+        return EditScript(operations=operations)
+
+    def __operations(self, working, second, mapping):
+        """
+        Yields the operations of the EditScript one by one. Every operation is yielded before it is applied to the
+        working copy of the original AST, so the generation stops where the consumer of the script does.
         """
-        pass
+
+        produced = 0
+        partners = {index: working.nodes[first_index] for first_index, index in mapping.items()}
+        partner_ids = {id(node): index for index, node in partners.items()}
+        in_order = set()
+        # the last child placed in every list field, by the modified parent and field, and its position in the list
+        placed = {}
+
+        def unmap(subtree):
+            # the subtree is replaced in a single node field, its partners need to be inserted again
+            for node in preorder(subtree):
+                index = partner_ids.pop(id(node), None)
+                if index is not None:
+                    del partners[index]
+
+        if _label_differs(working.root, second.nodes[0]):
+            produced += 1
+            yield Update(0, _shell(second.nodes[0]))
+            _update_label(working.root, second.nodes[0])
+        self.__align_children(working.root, 0, second, partners, in_order)
+        index = 1
+        while index < len(second.nodes):
+            node = second.nodes[index]
+            parent = partners[second.parents[index]]
+            field, position = second.fields[index]
+            partner = partners.get(index)
+            current = None
+            if position is not None:
+                position, current = self.__find_position(working, parent, field, partner,
+                                                         placed.get((second.parents[index], field)), index)
+            occupant = getattr(parent, field, None) if position is None else None
+
+            if partner is None:
+                # a subtree whose only partners are in the replaced node is inserted whole
+                displaced = {partner_ids.get(id(item)) for item in preorder(occupant)} if occupant is not None else ()
+                complete = not any(descendant in partners and descendant not in displaced
+                                   for descendant in range(index + 1, second.ends[index]))
+                change = _copy_tree(node) if complete else _shell(node)
+                produced += 1
+                yield Insert(working.index_of(parent), change, field, position)
+                if occupant is not None:
+                    unmap(occupant)
+                partner = working.insert(parent, field, position, _copy_tree(change))
+                in_order.add(id(partner))
+                if position is not None:
+                    placed[(second.parents[index], field)] = partner, position
+                if complete:
+                    for offset, inserted in enumerate(preorder(partner)):
+                        partners[index + offset], partner_ids[id(inserted)] = inserted, index + offset
+                    index = second.ends[index]
+                    continue
+                partners[index], partner_ids[id(partner)] = partner, index
+            else:
+                if _label_differs(partner, node):
+                    produced += 1
+                    yield Update(working.index_of(partner), _shell(node))
+                    _update_label(partner, node)
+                if working.parents[id(partner)] is not parent or working.fields[id(partner)] != field \
+                        or id(partner) not in in_order:
+                    produced += 1
+                    yield Move(working.index_of(parent), working.index_of(partner), field, position)
+                    # the partner may be in the replaced node, it is detached before the rest is unmapped
+                    working.move(partner, parent, field, position, current)
+                    if occupant is not None and occupant is not partner:
+                        unmap(occupant)
+                    in_order.add(id(partner))
+                    current = position
+                if position is not None:
+                    placed[(second.parents[index], field)] = partner, current
+            self.__align_children(partner, index, second, partners, in_order)
+            index += 1
+
+        # unmatched subtrees are deleted from the last one, so the indexes of the others do not change
+        nodes, ends = preorder_with_ends(working.root)
+        deleted = []
+        index = 0
+        while index < len(nodes):
+            if id(nodes[index]) in partner_ids:
+                index += 1
+            else:
+                deleted.append(index)
+                index = ends[index]
+        for index in reversed(deleted):
+            produced += 1
+            yield Delete(index)
+        if instrumentation.enabled:
+            instrumentation.count('pattern_creator.script_operations', produced)
+
+    def __align_children(self, partner, index, second, partners, in_order):
+        """
+        Marks the children of the working node that are children of its partner in the same field and keep their
+        relative order as in order. They are found as the longest increasing subsequence of their current positions.
+        """
+
+        for field, children in second.children(index):
+            value = getattr(partner, field, None)
+            if not isinstance(value, list):
+                child = partners.get(children[0])
+                if child is not None and child is value:
+                    in_order.add(id(child))
+                continue
+            current = {id(node): position for position, node in enumerate(value)}
+            positions = [current.get(id(partners[child]), -1) if child in partners else -1 for child in children]
+            for position in _increasing_subsequence([position for position in positions if position >= 0]):
+                in_order.add(id(value[position]))
+
+    def __find_position(self, working, parent, field, partner, left, index):
+        """
+        Returns the position in the list held by the field of the working parent at which the partner of the
+        modified node belongs: right after the partner of its left sibling, which is already in place. The position
+        is counted without the partner itself, as if it was already removed from the list. Returns the current
+        position of the partner in the list as well, None if it is not in the list.
+
+        The left sibling is the last child placed in the list, it is looked up from the position it was placed at.
+        Children are placed from left to right, so the nodes before it are only ever moved out of the list and it
+        is found by a scan over the removed nodes. The partner of an unchanged child is found next to it.
+        """
+
+        values = getattr(parent, field)
+        left_position = -1
+        if left is not None:
+            left_partner, left_position = left
+            left_position = min(left_position, len(values) - 1)
+            while left_position >= 0 and values[left_position] is not left_partner:
+                left_position -= 1
+            if left_position < 0:
+                raise ValueError('Left sibling of node {} is not in place'.format(index))
+        position = left_position + 1
+        current = None
+        if partner is not None and working.parents.get(id(partner)) is parent and working.fields[id(partner)] == field:
+            current = _find_near(values, partner, position)
+            if current < position:
+                position -= 1
+        return position, current
 
 
 class TreeDifferencer:
@@ -134,22 +562,45 @@ class TreeDifferencer:
     can create accurate EditScripts using not only insert, delete and update
     operations but also the move operation.
 
+    Nodes are connected in three phases, similar to GumTree. Identical subtrees are connected top-down by their
+    structural hashes, larger subtrees first. Nodes whose descendants were mostly connected to the descendants of a
+    node of the same type are connected to it bottom-up. Finally the remaining children of the connected nodes are
+    aligned field by field with the longest common subsequence of their subtree hashes, then of their labels and
+    then of their node types.
+
     ...
 
+    Attributes
+    ----------
+    min_size : int
+        Minimal size of the subtrees connected in the top-down phase, smaller subtrees are connected only as children
+        of connected nodes
+    min_similarity : float
+        Minimal share of connected descendants for connecting two nodes in the bottom-up phase
+
     Methods
     -------
-    public __init__(self)
+    public __init__(self, min_size, min_similarity)
         Initialises TreeDifferencer object.
     public dict of (int, int) connect_nodes(self, original, modified)
         Generates a dictionary of AST node indexes that describes which AST nodes
         are corresponding in original and modified ASTs.
 
     """
-    def __init__(self):
+    def __init__(self, min_size=3, min_similarity=0.5):
         """
         Initialises TreeDifferencer object.
+
+        Parameters
+        ----------
+        min_size : int, optional
+            Minimal size of the subtrees connected in the top-down phase (default is 3)
+        min_similarity : float, optional
+            Minimal share of connected descendants for connecting two nodes in the bottom-up phase (default is 0.5)
         """
-        pass
+
+        self.min_size = min_size
+        self.min_similarity = min_similarity
 
     def connect_nodes(self, first_ast, second_ast):
         """
@@ -170,7 +621,591 @@ class TreeDifferencer:
             corresponding in original and modified ASTs.
             The keys of the dictionary are original AST node indexes and values are
             modified AST node indexes.
+            Indexes are preorder indexes in the order of ast.iter_child_nodes.
+        """
+
+        hasher = SubtreeHasher()
+        first, second = _IndexedTree(first_ast, hasher), _IndexedTree(second_ast, hasher)
+        first_partners, second_partners = [-1] * len(first.nodes), [-1] * len(second.nodes)
+
+        def connect(first_index, second_index, size=1):
+            for offset in range(size):
+                first_partners[first_index + offset] = second_index + offset
+                second_partners[second_index + offset] = first_index + offset
+
+        self.__connect_identical(first, second, first_partners, second_partners, connect)
+        self.__connect_containers(first, second, first_partners, second_partners, connect)
+        if first_partners[0] < 0 and second_partners[0] < 0 and type(first_ast) is type(second_ast):
+            connect(0, 0)
+
+        # children of connected nodes are aligned top-down, nodes connected on the way are aligned as well
+        for first_index in range(len(first.nodes)):
+            second_index = first_partners[first_index]
+            if second_index >= 0:
+                self.__recover(first, second, first_index, second_index, first_partners, second_partners, connect)
+        return {first_index: second_index for first_index, second_index in enumerate(first_partners)
+                if second_index >= 0}
+
+    def __connect_identical(self, first, second, first_partners, second_partners, connect):
+        """
+        Connects identical subtrees top-down. Among several identical candidates, the one whose parent is connected
+        to the parent of the subtree is preferred, otherwise the first one that is not connected yet.
+        """
+
+        # candidates are queued in preorder by their hash and by their hash and parent, connections are never
+        # undone, so candidates that are no longer free are dropped from the front of the queues
+        candidates = defaultdict(deque)
+        for index in range(len(second.nodes)):
+            if second.ends[index] - index >= self.min_size:
+                candidates[second.hashes[index]].append(index)
+                candidates[(second.hashes[index], second.parents[index])].append(index)
+
+        def first_free(found, size):
+            while found and any(partner >= 0 for partner in second_partners[found[0]:found[0] + size]):
+                found.popleft()
+            return found[0] if found else None
+
+        index = 0
+        while index < len(first.nodes):
+            size = first.ends[index] - index
+            if size >= self.min_size and first.hashes[index] in candidates:
+                parent = first.parents[index]
+                parent_partner = first_partners[parent] if parent >= 0 else -1
+                match = None
+                if parent_partner >= 0 and (first.hashes[index], parent_partner) in candidates:
+                    match = first_free(candidates[(first.hashes[index], parent_partner)], size)
+                if match is None:
+                    match = first_free(candidates[first.hashes[index]], size)
+                if match is not None:
+                    connect(index, match, size)
+                    index += size
+                    continue
+            index += 1
+
+    def __connect_containers(self, first, second, first_partners, second_partners, connect):
+        """
+        Connects nodes bottom-up to the nodes of the same type that contain most of the partners of their
+        descendants. Connected descendants are counted by the connected subtrees they belong to.
+        """
+
+        for index in range(len(first.nodes) - 1, -1, -1):
+            if first_partners[index] >= 0 or first.ends[index] - index == 1:
+                continue
+            node_type = type(first.nodes[index])
+            common = defaultdict(int)
+            descendant = index + 1
+            while descendant < first.ends[index]:
+                partner = first_partners[descendant]
+                if partner < 0:
+                    descendant += 1
+                    continue
+                # the connected subtree is counted for every unconnected ancestor of its partner of the same type
+                size = first.ends[descendant] - descendant
+                ancestor = second.parents[partner]
+                while ancestor >= 0:
+                    if second_partners[ancestor] < 0 and type(second.nodes[ancestor]) is node_type:
+                        common[ancestor] += size
+                    ancestor = second.parents[ancestor]
+                descendant = first.ends[descendant]
+            best, best_similarity = -1, 0.0
+            for candidate, count in common.items():
+                similarity = 2.0 * count / (first.ends[index] - index - 1 + second.ends[candidate] - candidate - 1)
+                if similarity > best_similarity:
+                    best, best_similarity = candidate, similarity
+            if best >= 0 and (best_similarity >= self.min_similarity or (index == 0 and best == 0)):
+                connect(index, best)
+
+    def __recover(self, first, second, first_index, second_index, first_partners, second_partners, connect):
+        """
+        Connects the unconnected children of two connected nodes field by field, first the identical subtrees, then
+        the nodes with equal labels and then the nodes of the same type, keeping their relative order.
+        """
+
+        second_children = dict(second.children(second_index))
+        keys = ((first.hashes, second.hashes, True), (first.labels, second.labels, False),
+                (first.types, second.types, False))
+        for field, first_children in first.children(first_index):
+            second_field_children = second_children.get(field)
+            if not second_field_children:
+                continue
+            for first_key, second_key, subtrees in keys:
+                unconnected = [child for child in first_children if first_partners[child] < 0]
+                second_unconnected = [child for child in second_field_children if second_partners[child] < 0]
+                if not unconnected or not second_unconnected:
+                    break
+                pairs = _longest_common_subsequence([first_key[child] for child in unconnected],
+                                                    [second_key[child] for child in second_unconnected])
+                for first_position, second_position in pairs:
+                    child, second_child = unconnected[first_position], second_unconnected[second_position]
+                    size = first.ends[child] - child
+                    # identical subtrees are connected whole unless some of their nodes are already connected
+                    if subtrees and all(partner < 0 for partner in first_partners[child:child + size]) \
+                            and all(partner < 0 for partner in second_partners[second_child:second_child + size]):
+                        connect(child, second_child, size)
+                    else:
+                        connect(child, second_child)
+
+
+class _IndexedTree:
+    """
+    Preorder representation of an AST with the parent, the field and the structural hash of every node. Context nodes
+    such as ast.Load are shared between parents, so nodes are identified by their positions instead of node ids.
+    """
+
+    def __init__(self, tree, hasher=None):
+        self.nodes, self.ends = preorder_with_ends(tree)
+        count = len(self.nodes)
+        self.parents = [-1] * count
+        # name of the parent field that holds the node and its position, None if the field holds a single node
+        self.fields = [(None, None)] * count
+        for index, node in enumerate(self.nodes):
+            child = index + 1
+            for field in node._fields:
+                value = getattr(node, field, None)
+                if isinstance(value, ast.AST):
+                    self.parents[child], self.fields[child] = index, (field, None)
+                    child = self.ends[child]
+                elif isinstance(value, list):
+                    for position, item in enumerate(value):
+                        if isinstance(item, ast.AST):
+                            self.parents[child], self.fields[child] = index, (field, position)
+                            child = self.ends[child]
+        if hasher is None:
+            return
+
+        self.types = [type(node).__name__ for node in self.nodes]
+        self.labels = [hasher.label_id(node) for node in self.nodes]
+        self.hashes = [0] * count
+        for index in range(count - 1, -1, -1):
+            children = []
+            child = index + 1
+            while child < self.ends[index]:
+                children.append(self.hashes[child])
+                child = self.ends[child]
+            self.hashes[index] = hasher.subtrees.setdefault((self.labels[index], tuple(children)), len(hasher.subtrees))
+
+    def children(self, index):
+        """
+        Returns the preorder indexes of the children of the node grouped by the fields that hold them.
+        """
+
+        grouped = {}
+        child = index + 1
+        while child < self.ends[index]:
+            grouped.setdefault(self.fields[child][0], []).append(child)
+            child = self.ends[child]
+        return list(grouped.items())
+
+
+def _pair_methods(original, modified):
+    """
+    Pairs the methods of the original and modified modules. Only methods of the same type are paired, so the roots
+    of every pair can be connected.
+
+    Parameters
+    ----------
+    original : ast
+        AST of original code
+    modified : ast
+        AST of modified code
+
+    Returns
+    -------
+    list of (ast, ast, bool)
+        Original and modified methods and whether they differ, in the order of the original methods
+    """
+
+    hasher = SubtreeHasher()
+    original_hashes = hasher.hash_tree(original)
+    modified_hashes = hasher.hash_tree(modified)
+    original_methods = _methods(original)
+    modified_methods = _methods(modified)
+
+    pairs = {}
+    unpaired = []
+    for key, method in original_methods.items():
+        partner = modified_methods.get(key)
+        if partner is None or type(partner) is not type(method):
+            unpaired.append((key, method))
+        else:
+            pairs[key] = (method, modified_methods.pop(key))
+
+    # renamed or moved methods keep their parameters and body
+    def signature(method, hashes):
+        return hashes[id(method.args)], tuple(hashes[id(statement)] for statement in method.body)
+
+    renamed = defaultdict(list)
+    for method in modified_methods.values():
+        renamed[signature(method, modified_hashes)].append(method)
+    for key, method in unpaired:
+        candidates = [candidate for candidate in renamed.get(signature(method, original_hashes), ())
+                      if type(candidate) is type(method)]
+        if candidates:
+            partner = candidates[0]
+            renamed[signature(method, original_hashes)].remove(partner)
+            pairs[key] = (method, partner)
+
+    order = {id(method): position for position, method in enumerate(original_methods.values())}
+    return [(method, partner, original_hashes[id(method)] != modified_hashes[id(partner)])
+            for method, partner in sorted(pairs.values(), key=lambda pair: order[id(pair[0])])]
+
+
+def _methods(tree):
+    """
+    Returns the functions defined at the top level of the module and in its classes indexed by their qualified names.
+    Functions with the same qualified name, like property accessors, are told apart by the number of their
+    predecessors with that name.
+    """
+
+    methods = {}
+    counts = defaultdict(int)
+
+    def visit(body, prefix):
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                name = prefix + node.name
+                methods[(name, counts[name])] = node
+                counts[name] += 1
+            elif isinstance(node, ast.ClassDef):
+                visit(node.body, prefix + node.name + '.')
+
+    visit(tree.body, '')
+    return methods
+
+
+def _substitute(tree, substitutes):
+    """
+    Returns a copy of the module in which the methods are replaced by their substitutes. Only the module and its
+    classes are copied, the other nodes are shared with the module.
+    """
+
+    copied = copy.copy(tree)
+    copied.body = []
+    for node in tree.body:
+        if id(node) in substitutes:
+            copied.body.append(substitutes[id(node)])
+        elif isinstance(node, ast.ClassDef):
+            copied.body.append(_substitute(node, substitutes))
+        else:
+            copied.body.append(node)
+    return copied
+
+
+def _expanded_indexes(tree, sizes):
+    """
+    Returns the nodes of the AST with placeholders in preorder and, for every node, its preorder index in the AST in
+    which the placeholders are expanded to subtrees of the given sizes. Indexes are positional, since context nodes
+    like Load are shared by the whole AST.
+    """
+
+    nodes = preorder(tree)
+    indexes = []
+    offset = 0
+    for index, node in enumerate(nodes):
+        indexes.append(index + offset)
+        offset += sizes.get(id(node), 1) - 1
+    return nodes, indexes
+
+
+def _shifted(change, offset):
+    """
+    Returns a copy of the operation whose indexes are shifted by the offset.
+    """
+
+    if isinstance(change, Insert):
+        return Insert(change.index + offset, change.change, change.field, change.position)
+    if isinstance(change, Delete):
+        return Delete(change.index + offset)
+    if isinstance(change, Update):
+        return Update(change.insert_operation.index + offset, change.insert_operation.change)
+    insert = change.insert_operation
+    return Move(insert.index + offset, change.delete_operation.index + offset, insert.field, insert.position)
+
+
+def _size(tree):
+    """
+    Returns the number of nodes in the AST.
+    """
+
+    return sum(1 for _ in ast.walk(tree))
+
+
+def _diff_methods(pairs, tree_differencer):
+    """
+    Connects and scripts the pairs of methods, executed in a worker process. Methods and scripts are exchanged with
+    the worker in the format of pattern_serialization.
+
+    Parameters
+    ----------
+    pairs : bytes
+        Serialized list of original and modified methods
+    tree_differencer : TreeDifferencer
+        Object used for connecting the nodes of the methods
+
+    Returns
+    -------
+    bytes
+        Serialized list of the mappings, as lists of index pairs, and edit scripts of the methods
+    """
+
+    generator = EditScriptGenerator(tree_differencer)
+    diffs = []
+    for method, partner in pattern_serialization.loads(pairs):
+        mapping = tree_differencer.connect_nodes(method, partner)
+        diffs.append((sorted(mapping.items()), generator.generate_script(method, partner, mapping)))
+    return pattern_serialization.dumps(diffs)
+
+
+class _WorkingTree:
+    """
+    Copy of the original AST that is changed while the EditScript is generated. Parents, the fields that hold the nodes
+    and subtree sizes of the nodes are maintained, so the preorder index of a node is computed along its path to the
+    root instead of by traversing the whole AST after every change.
+    """
+
+    def __init__(self, tree):
+        self.root = _copy_tree(tree)
+        self.nodes, ends = preorder_with_ends(self.root)
+        self.parents = {}
+        self.fields = {}
+        self.sizes = {}
+        for index, node in enumerate(self.nodes):
+            self.sizes[id(node)] = ends[index] - index
+            self.__link_children(node)
+
+    def index_of(self, node):
+        """
+        Returns the preorder index of the node.
+        """
+
+        index = 0
+        while node is not self.root:
+            parent = self.parents[id(node)]
+            index += 1
+            for sibling in ast.iter_child_nodes(parent):
+                if sibling is node:
+                    break
+                index += self.sizes[id(sibling)]
+            node = parent
+        return index
+
+    def insert(self, parent, field, position, subtree):
+        """
+        Inserts the subtree into the field of the parent like Insert.make_change and returns it.
+        """
+
+        nodes, ends = preorder_with_ends(subtree)
+        for index, node in enumerate(nodes):
+            self.sizes[id(node)] = ends[index] - index
+            self.__link_children(node)
+        self.__attach(parent, field, position, subtree)
+        return subtree
+
+    def move(self, node, parent, field, position, current_position=None):
+        """
+        Moves the node into the field of the parent like Move.make_change. The current position of the node in the
+        list that holds it is searched for unless it is received.
         """
-        pass
 
+        current = self.parents[id(node)]
+        current_field = self.fields[id(node)]
+        value = getattr(current, current_field)
+        if isinstance(value, list):
+            if current_position is None:
+                current_position = next(index for index, item in enumerate(value) if item is node)
+            del value[current_position]
+        else:
+            setattr(current, current_field, None)
+        self.__resize(current, -self.sizes[id(node)])
+        self.__attach(parent, field, position, node)
+
+    def __attach(self, parent, field, position, node):
+        if position is None:
+            occupant = getattr(parent, field, None)
+            setattr(parent, field, node)
+            change = self.sizes[id(node)] - (self.sizes[id(occupant)] if occupant is not None else 0)
+        else:
+            getattr(parent, field).insert(position, node)
+            change = self.sizes[id(node)]
+        self.parents[id(node)] = parent
+        self.fields[id(node)] = field
+        self.__resize(parent, change)
+
+    def __link_children(self, node):
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                self.parents[id(value)], self.fields[id(value)] = node, field
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        self.parents[id(item)], self.fields[id(item)] = node, field
+
+    def __resize(self, node, change):
+        while True:
+            self.sizes[id(node)] += change
+            if node is self.root:
+                return
+            node = self.parents[id(node)]
+
+
+def _timed_operations(operations):
+    """
+    Yields the lazily produced operations and records the time spent producing them, without the time the consumer
+    of the script spends between them, once all of them are produced.
+    """
+
+    elapsed = 0.0
+    while True:
+        started = time.perf_counter()
+        try:
+            operation = next(operations)
+        except StopIteration:
+            instrumentation.timing('pattern_creator.script', elapsed + time.perf_counter() - started)
+            return
+        elapsed += time.perf_counter() - started
+        yield operation
+
+
+def _copy_tree(tree):
+    """
+    Returns a copy of the AST in which no node is shared between parents, unlike in ASTs created by ast.parse.
+    """
+
+    copied = copy.copy(tree)
+    for field in tree._fields:
+        value = getattr(tree, field, None)
+        if isinstance(value, ast.AST):
+            setattr(copied, field, _copy_tree(value))
+        elif isinstance(value, list):
+            setattr(copied, field, [_copy_tree(item) if isinstance(item, ast.AST) else item for item in value])
+    return copied
+
+
+def _shell(node):
+    """
+    Returns a copy of the node without its children, fields that hold nodes are empty.
+    """
+
+    shell = copy.copy(node)
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, ast.AST):
+            setattr(shell, field, None)
+        elif isinstance(value, list):
+            setattr(shell, field, [item for item in value if not isinstance(item, ast.AST)]
+                    if not any(isinstance(item, ast.AST) for item in value) else [])
+    return shell
+
+
+def _update_label(node, source):
+    """
+    Copies the values of the fields that do not hold nodes from the source node, like Update.make_change.
+    """
+
+    for field in node._fields:
+        value = getattr(source, field, None)
+        if not holds_nodes(value) and not holds_nodes(getattr(node, field, None)):
+            setattr(node, field, copy.deepcopy(value))
+
+
+def _label_differs(first, second):
+    """
+    Returns True if the nodes differ in the values of the fields that do not hold nodes.
+    """
+
+    for field in first._fields:
+        first_value, second_value = getattr(first, field, None), getattr(second, field, None)
+        if holds_nodes(first_value) or holds_nodes(second_value):
+            continue
+        if type(first_value) is not type(second_value) or first_value != second_value:
+            return True
+    return False
+
+
+def _find_near(values, node, start):
+    """
+    Returns the position of the node in the list, which is searched from the start position outwards.
+    """
+
+    for distance in range(len(values) + 1):
+        for position in (start + distance, start - distance - 1):
+            if 0 <= position < len(values) and values[position] is node:
+                return position
+    raise ValueError('Node is not in the list')
+
+
+def _increasing_subsequence(values):
+    """
+    Returns a longest strictly increasing subsequence of the values in O(n log n) time.
+    """
+
+    tails, tail_indexes, previous = [], [], [-1] * len(values)
+    for index, value in enumerate(values):
+        position = bisect.bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[position] = value
+            tail_indexes[position] = index
+        previous[index] = tail_indexes[position - 1] if position > 0 else -1
+    subsequence = []
+    index = tail_indexes[-1] if tail_indexes else -1
+    while index >= 0:
+        subsequence.append(values[index])
+        index = previous[index]
+    subsequence.reverse()
+    return subsequence
+
+
+def _longest_common_subsequence(first, second):
+    """
+    Returns the pairs of positions of a longest common subsequence of the sequences, computed by the Myers
+    algorithm in O((n + m) d) time, where d is the number of differences.
+    """
+
+    first_length, second_length = len(first), len(second)
+    limit = first_length + second_length
+    offset = limit + 1
+    furthest = [0] * (2 * limit + 3)
+    trace = []
+    for differences in range(limit + 1):
+        trace.append(furthest[:])
+        for diagonal in range(-differences, differences + 1, 2):
+            if diagonal == -differences or (diagonal != differences and
+                                            furthest[offset + diagonal - 1] < furthest[offset + diagonal + 1]):
+                x = furthest[offset + diagonal + 1]
+            else:
+                x = furthest[offset + diagonal - 1] + 1
+            y = x - diagonal
+            while x < first_length and y < second_length and first[x] == second[y]:
+                x, y = x + 1, y + 1
+            furthest[offset + diagonal] = x
+            if x >= first_length and y >= second_length:
+                return _backtrack(trace, first_length, second_length, offset)
+    return []
+
+
+def _backtrack(trace, x, y, offset):
+    """
+    Returns the matched pairs of positions found by the Myers algorithm, in increasing order.
+    """
 
+    pairs = []
+    for differences in range(len(trace) - 1, -1, -1):
+        furthest = trace[differences]
+        diagonal = x - y
+        if diagonal == -differences or (diagonal != differences and
+                                        furthest[offset + diagonal - 1] < furthest[offset + diagonal + 1]):
+            previous_diagonal = diagonal + 1
+        else:
+            previous_diagonal = diagonal - 1
+        previous_x = furthest[offset + previous_diagonal]
+        previous_y = previous_x - previous_diagonal
+        while x > previous_x and y > previous_y:
+            x, y = x - 1, y - 1
+            pairs.append((x, y))
+        if differences > 0:
+            x, y = previous_x, previous_y
+    pairs.reverse()
+    return pairs
@@ -0,0 +1,226 @@
+import ast
+from collections import Counter, OrderedDict
+
+from .ast_utils import SubtreeHasher, postorder
+
+
+class TreeEditDistance:
+    """
+    This class computes the tree edit distance between ASTs using the Zhang-Shasha algorithm with unit costs for
+    insert, delete and rename operations. Computed distances are memoized over pairs of subtree hashes, so a
+    memoized pair of trees is not compared again. Every computation can be bounded by a maximum distance; the
+    computation is abandoned as soon as a lower bound shows that the distance exceeds it and the dynamic programming
+    tables are restricted to the band in which distances below the bound can exist. The memo keeps only the max_memo
+    most recently used pairs.
+
+    ...
+
+    Attributes
+    ----------
+    hasher : SubtreeHasher
+        Object used for hashing the compared subtrees
+    max_memo : int
+        Maximum number of memoized pairs of trees, the least recently used pair is forgotten first
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises TreeEditDistance object.
+    public int distance(self, first_ast, second_ast, max_distance)
+        Computes the tree edit distance between two ASTs.
+    public int pattern_distance(self, first_pattern, second_pattern, max_distance)
+        Computes the distance between two patterns.
+    private void __remember(self, key, entry)
+        Memoizes the distance of a pair of trees.
+    """
+
+    max_memo = 65536
+
+    def __init__(self):
+        """
+        Initialises TreeEditDistance object.
+        """
+
+        self.hasher = SubtreeHasher()
+        self.__memo = OrderedDict()
+
+    def distance(self, first_ast, second_ast, max_distance=float('inf')):
+        """
+        Computes the tree edit distance between two ASTs.
+
+        Parameters
+        ----------
+        first_ast : ast
+            First compared AST
+        second_ast : ast
+            Second compared AST
+        max_distance : int, optional
+            Upper bound of the distances that are of interest (default is inf)
+
+        Returns
+        -------
+        int
+            Tree edit distance between the ASTs, inf if it is greater than max_distance
+        """
+
+        first = _PostorderTree(first_ast, self.hasher)
+        second = _PostorderTree(second_ast, self.hasher)
+        key = (first.root_hash, second.root_hash)
+
+        if key in self.__memo:
+            self.__memo.move_to_end(key)
+            value, exact = self.__memo[key]
+            if exact:
+                return value if value <= max_distance else float('inf')
+            if max_distance < value:
+                return float('inf')
+
+        if first.root_hash == second.root_hash:
+            self.__remember(key, (0, True))
+            return 0
+
+        lower_bound = max(sum((first.histogram - second.histogram).values()),
+                          sum((second.histogram - first.histogram).values()))
+        if lower_bound > max_distance:
+            self.__remember(key, (lower_bound, False))
+            return float('inf')
+
+        cap = len(first.labels) + len(second.labels) + 1
+        if max_distance < cap - 1:
+            cap = int(max_distance) + 1
+        value = _zhang_shasha(first, second, cap)
+        if value >= cap:
+            self.__remember(key, (cap, False))
+            return float('inf')
+        self.__remember(key, (value, True))
+        return value
+
+    def pattern_distance(self, first_pattern, second_pattern, max_distance=float('inf')):
+        """
+        Computes the distance between two patterns as the sum of tree edit distances between their original and
+        modified ASTs.
+
+        Parameters
+        ----------
+        first_pattern : Pattern
+            First compared pattern
+        second_pattern : Pattern
+            Second compared pattern
+        max_distance : int, optional
+            Upper bound of the distances that are of interest (default is inf)
+
+        Returns
+        -------
+        int
+            Distance between the patterns, inf if it is greater than max_distance
+        """
+
+        original_distance = self.distance(first_pattern.original, second_pattern.original, max_distance)
+        if original_distance > max_distance:
+            return float('inf')
+        return original_distance + self.distance(first_pattern.modified, second_pattern.modified,
+                                                 max_distance - original_distance)
+
+    def __remember(self, key, entry):
+        """
+        Memoizes the distance of a pair of trees and forgets the least recently used pair if the memo is full.
+
+        Parameters
+        ----------
+        key : (int, int)
+            Hashes of the compared trees
+        entry : (int, bool)
+            Distance of the trees and whether it is exact or only a lower bound
+        """
+
+        self.__memo[key] = entry
+        self.__memo.move_to_end(key)
+        if len(self.__memo) > self.max_memo:
+            self.__memo.popitem(last=False)
+
+
+class _PostorderTree:
+    """
+    Postorder representation of an AST used by the Zhang-Shasha algorithm.
+    """
+
+    def __init__(self, tree, hasher):
+        nodes = postorder(tree)
+        hashes = hasher.hash_tree(tree)
+
+        self.labels = [hasher.label_id(node) for node in nodes]
+        self.hashes = [hashes[id(node)] for node in nodes]
+        self.root_hash = self.hashes[-1]
+        self.histogram = Counter(self.labels)
+
+        # context nodes such as ast.Load are shared between parents, so positions are tracked instead of node ids
+        self.leftmost = []
+        pending = []
+        for position, node in enumerate(nodes):
+            children = sum(1 for _ in ast.iter_child_nodes(node))
+            if children:
+                leftmost = pending[-children]
+                del pending[-children:]
+            else:
+                leftmost = position
+            self.leftmost.append(leftmost)
+            pending.append(leftmost)
+
+        seen = set()
+        self.keyroots = []
+        for position in range(len(nodes) - 1, -1, -1):
+            if self.leftmost[position] not in seen:
+                seen.add(self.leftmost[position])
+                self.keyroots.append(position)
+        self.keyroots.reverse()
+
+
+def _zhang_shasha(first, second, cap):
+    """
+    Zhang-Shasha tree edit distance restricted to values lower than cap. Cells of the forest distance tables whose
+    forests differ in size by at least cap can not hold a smaller value and are skipped.
+
+    Returns
+    -------
+    int
+        Tree edit distance, or cap if the distance is greater or equal to cap
+    """
+
+    first_labels, second_labels = first.labels, second.labels
+    first_leftmost, second_leftmost = first.leftmost, second.leftmost
+    first_hashes, second_hashes = first.hashes, second.hashes
+    tree_distance = [[cap] * len(second_labels) for _ in first_labels]
+
+    for x in first.keyroots:
+        x_leftmost = first_leftmost[x]
+        rows = x - x_leftmost + 2
+        for y in second.keyroots:
+            y_leftmost = second_leftmost[y]
+            columns = y - y_leftmost + 2
+            forest = [[cap] * columns for _ in range(rows)]
+            for j in range(min(columns, cap)):
+                forest[0][j] = j
+            for i in range(1, min(rows, cap)):
+                forest[i][0] = i
+
+            for i in range(1, rows):
+                node = x_leftmost + i - 1
+                node_leftmost = first_leftmost[node]
+                previous_row, row = forest[i - 1], forest[i]
+                for j in range(max(1, i - cap + 1), min(columns, i + cap)):
+                    other = y_leftmost + j - 1
+                    other_leftmost = second_leftmost[other]
+                    value = min(previous_row[j], row[j - 1]) + 1
+                    if node_leftmost == x_leftmost and other_leftmost == y_leftmost:
+                        if first_hashes[node] == second_hashes[other]:
+                            value = 0
+                        else:
+                            value = min(value, previous_row[j - 1] + (first_labels[node] != second_labels[other]))
+                        value = min(value, cap)
+                        tree_distance[node][other] = value
+                    else:
+                        value = min(value, forest[node_leftmost - x_leftmost][other_leftmost - y_leftmost]
+                                    + tree_distance[node][other])
+                    row[j] = min(value, cap)
+
+    return tree_distance[-1][-1]
@@ -1,5 +1,10 @@
+import threading
 from abc import ABC, abstractmethod
 
+from .ast_encoding import TokenVocabulary
+from .pattern_compilation import PatternCompiler
+from .pattern_matching import PatternFactoryListener, PatternListener, Recommender
+
 
 class IPatternLoader(ABC):
     """
@@ -35,16 +40,18 @@ class PatternLoader(IPatternLoader):
     ----------
     context : DbContext
         Database where all the patterns are saved
+    filters : dict
+        Keyword arguments of DbContext.iter_patterns that select the loaded patterns, None to load all patterns
 
     Methods
     -------
-    public __init__(self, context)
+    public __init__(self, context, filters)
         Initialises PatternLoader object.
     public list of IPatternMatcher load(self)
         Loads all the patterns available in the database and returns them
         as a list of IPatternMatcher objects.
     """
-    def __init__(self, context):
+    def __init__(self, context, filters=None):
         """
         Initialises PatternLoader object.
 
@@ -52,8 +59,13 @@ class PatternLoader(IPatternLoader):
         ----------
         context : DbContext
             Database where all the patterns are saved
+        filters : dict, optional
+            Keyword arguments of DbContext.iter_patterns that select the loaded patterns, for example
+            {'root_type': 'FunctionDef'} (default is None, all patterns are loaded)
         """
-        pass
+
+        self.context = context
+        self.filters = filters
 
     def load(self):
         """
@@ -65,7 +77,8 @@ class PatternLoader(IPatternLoader):
         list of IPatternMatcher
             List of all loaded patterns
         """
-        pass
+
+        return [PatternListener(pattern, None) for pattern in _load_patterns(self.context, self.filters)]
 
 
 class PatternFactoryLoader(IPatternLoader):
@@ -79,17 +92,30 @@ class PatternFactoryLoader(IPatternLoader):
     ----------
     context : DbContext
         Database where all the patterns are saved
+    filters : dict
+        Keyword arguments of DbContext.iter_patterns that select the loaded patterns, None to load all patterns
+    vocabulary : TokenVocabulary
+        Vocabulary the patterns are encoded by, shared by all loaded pattern sets
+    compiler : PatternCompiler
+        Compiler the patterns are compiled by, shared by all loaded pattern sets
+    snapshot_path : str
+        Path of the PatternSnapshot the patterns are loaded from while it holds the current version, None if the
+        patterns are always loaded from the database
 
     Methods
     -------
-    public __init__(self, context)
+    public __init__(self, context, filters, vocabulary, compiler, snapshot_path)
         Initialises PatternFactoryLoader object.
     public list of IPatternMatcher load(self)
         Loads factories for all the patterns available
         in the database and returns them as a list of
         IPatternMatcher objects.
+    public int get_version(self)
+        Returns the version of the pattern set in the database.
+    public SharedPatternTable publish(self, name)
+        Publishes all the patterns available in the database to shared memory.
     """
-    def __init__(self, context):
+    def __init__(self, context, filters=None, vocabulary=None, compiler=None, snapshot_path=None):
         """
         Initialises PatternFactoryLoader object.
 
@@ -97,17 +123,419 @@ class PatternFactoryLoader(IPatternLoader):
         ----------
         context : DbContext
             Database where all the patterns are saved
+        filters : dict, optional
+            Keyword arguments of DbContext.iter_patterns that select the loaded patterns, for example
+            {'root_type': 'FunctionDef'} (default is None, all patterns are loaded)
+        vocabulary : TokenVocabulary, optional
+            Vocabulary the patterns are encoded by (default is None, a new vocabulary is created)
+        compiler : PatternCompiler, optional
+            Compiler that caches the compiled pattern nodes (default is None, a new compiler is created)
+        snapshot_path : str, optional
+            Path of the PatternSnapshot the patterns are loaded from, it is written whenever it is missing or holds
+            an older version (default is None, the patterns are always loaded from the database)
         """
-        pass
+
+        self.context = context
+        self.filters = filters
+        self.vocabulary = vocabulary if vocabulary is not None else TokenVocabulary()
+        self.compiler = compiler if compiler is not None else PatternCompiler()
+        self.snapshot_path = snapshot_path
 
     def load(self):
         """
         Loads factories for all the patterns available in the
         database and returns them as a list of IPatternMatcher objects.
+        The factories are not bound to any Recommender, their patterns
+        are encoded by the vocabulary and compiled by the compiler of the
+        loader, so the nodes already compiled for a previously loaded
+        pattern set are not compiled again. If the loader has a snapshot
+        path, the patterns are loaded from the snapshot while it holds the
+        current version of the pattern set, otherwise the snapshot is
+        written after the patterns are loaded from the database.
 
         Returns
         -------
         list of IPatternMatcher
             List of all loaded pattern factories
         """
-        pass
+
+        if self.snapshot_path is None:
+            return [PatternFactoryListener(pattern, vocabulary=self.vocabulary, compiler=self.compiler)
+                    for pattern in _load_patterns(self.context, self.filters)]
+
+        # imported lazily, loaders without a snapshot do not need it
+        from .pattern_snapshot import PatternSnapshot
+
+        version = self.context.get_version()
+        try:
+            snapshot = PatternSnapshot.load(self.snapshot_path)
+        except (OSError, ValueError):
+            snapshot = None
+        if snapshot is None or snapshot.version != version or snapshot.filters != (self.filters or {}):
+            snapshot = PatternSnapshot(_load_patterns(self.context, self.filters), version, self.filters)
+            try:
+                snapshot.save(self.snapshot_path)
+            except OSError:
+                _logger().warning('Writing the pattern snapshot %s failed', self.snapshot_path, exc_info=True)
+        return snapshot.factories(self.vocabulary, self.compiler)
+
+    def get_version(self):
+        """
+        Returns the version of the pattern set in the database.
+
+        Returns
+        -------
+        int
+            Version of the pattern set
+        """
+
+        return self.context.get_version()
+
+    def publish(self, name=None):
+        """
+        Publishes all the patterns available in the database to shared memory, so worker processes can load them
+        with SharedPatternLoader instead of reading the database. Workers still decode local copies of the patterns
+        they need. The caller owns the returned table and needs to unlink it once all workers are stopped. Workers
+        started by multiprocessing attach with the default track, processes started independently pass track=False.
+
+        Parameters
+        ----------
+        name : str, optional
+            Name of the shared memory block (default is None, a unique name is generated)
+
+        Returns
+        -------
+        SharedPatternTable
+            Published pattern table
+        """
+
+        # imported lazily, the shared memory support is needed only by processes that share the patterns
+        from .pattern_sharing import SharedPatternTable
+
+        version = self.context.get_version()
+        return SharedPatternTable.create(list(_load_patterns(self.context, self.filters)), version, name)
+
+
+class SharedPatternLoader(IPatternLoader):
+    """
+    This class is responsible for loading pattern factories from a pattern table published to shared memory by
+    PatternFactoryLoader. The factories decode their patterns from the shared table only when they are needed.
+
+    ...
+
+    Attributes
+    ----------
+    table : SharedPatternTable
+        Attached pattern table
+    compiler : PatternCompiler
+        Compiler the decoded patterns are compiled by, shared by all loaded factories
+
+    Methods
+    -------
+    public __init__(self, name, compiler, track)
+        Initialises SharedPatternLoader object and attaches to the pattern table.
+    public list of IPatternMatcher load(self)
+        Loads factories for all the patterns in the shared table.
+    public int get_version(self)
+        Returns the version of the pattern set in the shared table.
+    """
+    def __init__(self, name, compiler=None, track=True):
+        """
+        Initialises SharedPatternLoader object and attaches to the pattern table.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block the table was published to
+        compiler : PatternCompiler, optional
+            Compiler that caches the compiled pattern nodes (default is None, a new compiler is created)
+        track : bool, optional
+            False if the process was not started by the publisher through multiprocessing and has a resource tracker
+            of its own (default is True), see SharedPatternTable.attach
+        """
+
+        from .pattern_sharing import SharedPatternTable
+
+        self.table = SharedPatternTable.attach(name, track)
+        self.compiler = compiler if compiler is not None else PatternCompiler()
+
+    def load(self):
+        """
+        Loads factories for all the patterns in the shared table. The factories are not bound to any Recommender.
+
+        Returns
+        -------
+        list of IPatternMatcher
+            List of all loaded pattern factories
+        """
+
+        from .pattern_sharing import SharedPatternFactoryListener
+
+        return [SharedPatternFactoryListener(self.table, index, compiler=self.compiler)
+                for index in range(len(self.table))]
+
+    def get_version(self):
+        """
+        Returns the version of the pattern set in the shared table.
+
+        Returns
+        -------
+        int
+            Version of the pattern set
+        """
+
+        return self.table.version
+
+
+class PatternSet:
+    """
+    This class is an immutable snapshot of the loaded pattern factories. Every Recommender
+    run uses a single PatternSet from start to end, even if a newer version is loaded in
+    the meantime.
+
+    ...
+
+    Attributes
+    ----------
+    version : int
+        Version of the pattern set in the database
+    factories : tuple of PatternFactoryListener
+        Loaded pattern factories that are not bound to any Recommender
+    vocabulary : TokenVocabulary
+        Vocabulary the patterns of the factories are encoded by, None if they are not encoded
+
+    Methods
+    -------
+    public __init__(self, version, factories, vocabulary)
+        Initialises PatternSet object.
+    public Recommender create_recommender(self, parser, uploaded_ast, profiler, top_k, scorer, processes)
+        Creates a Recommender with all the factories of the pattern set subscribed to it.
+    public PatternSet exclude(self, pattern_ids)
+        Returns a pattern set without the patterns with received identifiers.
+    """
+
+    def __init__(self, version, factories, vocabulary=None):
+        """
+        Initialises PatternSet object.
+
+        Parameters
+        ----------
+        version : int
+            Version of the pattern set in the database
+        factories : list of PatternFactoryListener
+            Loaded pattern factories
+        vocabulary : TokenVocabulary, optional
+            Vocabulary the patterns of the factories are encoded by (default is None)
+        """
+
+        self.version = version
+        self.factories = tuple(factories)
+        self.vocabulary = vocabulary
+
+    def create_recommender(self, parser, uploaded_ast=None, profiler=None, top_k=None, scorer=None, processes=1):
+        """
+        Creates a Recommender with all the factories of the pattern set subscribed to it.
+
+        Parameters
+        ----------
+        parser : IPatternParser
+            Parser object for parsing matches
+        uploaded_ast : ast, optional
+            AST of the code that needs to be matched (default is None)
+        profiler : PatternProfiler, optional
+            Profiler that collects per-pattern matching times (default is None)
+        top_k : int, optional
+            Number of the best matches parsed for every method (default is None, all matches are parsed)
+        scorer : callable, optional
+            Function that maps a Pattern to the score by which its matches are ranked (default is None,
+            recommendation_score)
+        processes : int, optional
+            Maximum number of worker processes used for matching large uploaded modules (default is 1)
+
+        Returns
+        -------
+        Recommender
+            Recommender ready for matching
+        """
+
+        recommender = Recommender(parser, uploaded_ast, profiler, self.vocabulary, top_k, scorer, processes)
+        for factory in self.factories:
+            recommender.subscribe(factory.bind(recommender))
+        return recommender
+
+    def exclude(self, pattern_ids):
+        """
+        Returns a pattern set without the patterns with received identifiers. Used for quarantining
+        patterns that are too expensive to match.
+
+        Parameters
+        ----------
+        pattern_ids : iterable of int
+            Identifiers of the excluded patterns
+
+        Returns
+        -------
+        PatternSet
+            Pattern set of the same version without the excluded patterns
+        """
+
+        pattern_ids = set(pattern_ids)
+        return PatternSet(self.version, [factory for factory in self.factories
+                                         if factory.pattern.pattern_id not in pattern_ids], self.vocabulary)
+
+
+class PatternSetHandle:
+    """
+    This class is a versioned handle around PatternFactoryLoader that allows serving
+    workers to pick up new patterns without restarting. It can watch the database for
+    new versions of the pattern set, loads them in a background thread and atomically
+    replaces the current PatternSet once the new one is ready. Requests that already
+    took the current PatternSet keep using it until they finish.
+
+    ...
+
+    Attributes
+    ----------
+    loader : PatternFactoryLoader
+        Loader used for loading the pattern factories
+
+    Methods
+    -------
+    public __init__(self, loader)
+        Initialises PatternSetHandle object and loads the current pattern set.
+    public PatternSet current(self)
+        Returns the most recently loaded PatternSet.
+    public bool reload(self)
+        Loads the pattern set if its version in the database changed.
+    public void watch(self, interval)
+        Starts a background thread that periodically reloads the pattern set.
+    public void stop(self)
+        Stops the background thread started by watch().
+    """
+
+    def __init__(self, loader):
+        """
+        Initialises PatternSetHandle object and loads the current pattern set.
+
+        Parameters
+        ----------
+        loader : PatternFactoryLoader
+            Loader used for loading the pattern factories
+        """
+
+        self.loader = loader
+        self.__current = None
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__watcher = None
+        self.reload()
+
+    def current(self):
+        """
+        Returns the most recently loaded PatternSet. The returned PatternSet should be used for
+        the whole request.
+
+        Returns
+        -------
+        PatternSet
+            Most recently loaded pattern set
+        """
+
+        return self.__current
+
+    def reload(self):
+        """
+        Loads the pattern set if its version in the database changed. The current PatternSet is
+        replaced only after the new one is completely loaded.
+
+        Returns
+        -------
+        bool
+            True if a new version of the pattern set was loaded
+        """
+
+        with self.__lock:
+            version = self.loader.get_version()
+            if self.__current is not None and self.__current.version == version:
+                return False
+            self.__current = PatternSet(version, self.loader.load(), getattr(self.loader, 'vocabulary', None))
+            return True
+
+    def watch(self, interval=5.0):
+        """
+        Starts a background thread that periodically reloads the pattern set.
+
+        Parameters
+        ----------
+        interval : float, optional
+            Number of seconds between two checks of the pattern set version (default is 5.0)
+        """
+
+        if self.__watcher is not None and self.__watcher.is_alive():
+            return
+        self.__stopped.clear()
+        self.__watcher = threading.Thread(target=self.__watch, args=(interval,), name='PatternSetHandle',
+                                          daemon=True)
+        self.__watcher.start()
+
+    def stop(self):
+        """
+        Stops the background thread started by watch().
+        """
+
+        self.__stopped.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
+            self.__watcher = None
+
+    def __watch(self, interval):
+        """
+        Reloads the pattern set every interval seconds until the handle is stopped.
+
+        Parameters
+        ----------
+        interval : float
+            Number of seconds between two checks of the pattern set version
+        """
+
+        while not self.__stopped.wait(interval):
+            try:
+                self.reload()
+            except Exception:
+                _logger().exception('Reloading the pattern set failed, keeping version %s', self.__current.version)
+
+
+def _load_patterns(context, filters):
+    """
+    Loads the patterns selected by the filters from the database.
+
+    Parameters
+    ----------
+    context : DbContext
+        Database where all the patterns are saved
+    filters : dict
+        Keyword arguments of DbContext.iter_patterns, None to load all patterns
+
+    Returns
+    -------
+    iterable of Pattern
+        Selected patterns
+    """
+
+    return context.iter_patterns(**filters) if filters else context.load_patterns()
+
+
+def _logger():
+    """
+    Returns the logger of the module. The logging package is imported only when something is logged, it is not
+    needed for serving recommendations.
+
+    Returns
+    -------
+    Logger
+        Logger of the module
+    """
+
+    import logging
+
+    return logging.getLogger(__name__)
@@ -1,5 +1,34 @@
+import ast
+import copy
+import gc
+import heapq
+import os
+import threading
+import time
+import tokenize
 from abc import ABC, abstractmethod
-from .pattern import Pattern
+
+from . import instrumentation, pattern_serialization
+from .ast_encoding import WILDCARD, TokenVocabulary, token_runs
+from .ast_utils import match_label, preorder, preorder_with_ends
+from .pattern import Pattern, Wildcard, recommendation_score
+from .pattern_compilation import compile_node
+from .pattern_parsing import CollectingPatternParser
+
+# minimum number of uploaded nodes for which the regions of the uploaded AST are matched in worker processes
+MIN_PARALLEL_NODES = 5000
+
+# keywords of the clauses that continue a compound statement at the same indentation instead of starting a new one
+_CONTINUATION_KEYWORDS = frozenset(('elif', 'else', 'except', 'finally'))
+
+# worker processes shared by all Recommender objects of this process with their number, created on first use
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+# patterns last sent to the worker processes, their serialized form and the generation the workers cache them by
+_sent_patterns = ((), None, 0)
+# patterns decoded by this worker process as the generation, their factories and the vocabulary of the factories
+_worker_patterns = (None, None, None)
 
 
 class Reader(ABC):
@@ -31,7 +60,12 @@ class Reader(ABC):
         """
         Notifies all subscribed listeners about change
         """
-        pass
+
+        if instrumentation.enabled:
+            instrumentation.count('reader.notify')
+            instrumentation.count('listener.update', len(self.listeners))
+        for listener in list(self.listeners):
+            listener.update()
 
     def subscribe(self, listener):
         """
@@ -42,7 +76,8 @@ class Reader(ABC):
         listener : IListener
             IListener to subscribe
         """
-        pass
+
+        self.listeners.append(listener)
 
     def unsubscribe(self, listener):
         """
@@ -53,7 +88,8 @@ class Reader(ABC):
         listener: IListener
             IListener to unsubscribe
         """
-        pass
+
+        self.listeners.remove(listener)
 
 
 class Recommender(Reader):
@@ -64,6 +100,22 @@ class Recommender(Reader):
     matches. Once all the nodes have been visited it returns the found recommendations. The found patterns can be parsed
     into arbitrary format by providing appropriate IPatternParser object when instantiating Recommender object.
 
+    In the top-k mode only the k best matches of every method are parsed. A match belongs to the innermost function
+    that contains the node at which it started, matches outside functions form a group of their own. Completed
+    matches are ranked by the score of their pattern in a bounded heap per method and parsed when the run ends, in
+    the order in which they would be parsed without ranking. Matches with equal scores are ranked by the order of
+    their completion. Scores do not change during matching, so factories and listeners whose pattern scores cannot
+    enter the heap of their method are skipped.
+
+    A large uploaded module can be matched in worker processes. It is split into regions, runs of consecutive
+    top-level statements with similar numbers of nodes, and every worker receives only the statements of its region
+    and looks for the matches that start in it. The module node itself is matched in this process. A match may
+    continue beyond the end of its region, the worker returns the matches still in progress and this process follows
+    them until they are completed or abandoned. The worker processes are shared by all Recommender objects and keep
+    the decoded patterns between runs, so a run sends the patterns again, but a worker decodes them only when the
+    pattern set changes. The matches of all regions are parsed in the order in which a single process parses them,
+    so the output does not depend on the number of processes.
+
     ...
 
     Attributes
@@ -74,24 +126,63 @@ class Recommender(Reader):
         AST of the code that needs to be matched
     parser : IPatternParser
         Parser used for parsing found matches into understandable format
+    current_node : ast
+        Node of the uploaded AST that is currently visited
+    current_index : int
+        Preorder index of the currently visited node
+    current_end : int
+        Preorder index that follows the last node in the subtree of the currently visited node
+    profiler : PatternProfiler
+        Profiler that collects per-pattern matching times, None if profiling is disabled
+    profile : dict of (int, list)
+        Number of match attempts and cumulative check_match time indexed by pattern identifiers, collected during the
+        current run if it was sampled for profiling, None otherwise
+    parsed_source : ParsedSource
+        Parsed source of the uploaded AST whose node table is reused for matching, None if the AST was set directly
+    vocabulary : TokenVocabulary
+        Vocabulary the patterns of the subscribed factories were encoded by, None if the uploaded nodes are not encoded
+    current_token : int
+        Token of the currently visited node, None if the uploaded nodes are not encoded
+    top_k : int
+        Number of the best matches parsed for every method, None if all matches are parsed
+    scorer : callable
+        Function that maps a Pattern to the score by which its matches are ranked
+    current_method : int
+        Preorder index of the innermost function that contains the currently visited node, -1 outside functions
+        or if matches are not ranked
+    processes : int
+        Maximum number of worker processes, 1 if the uploaded AST is matched in this process
 
     Methods
     -------
-    public __init__(self, parser)
+    public __init__(self, parser, uploaded_ast, profiler, vocabulary, top_k, scorer, processes)
         Initialises Recommender object.
     public void notify(self)
-        Notifies all subscribed listeners about change.
+        Notifies the subscribed listeners that can match the current node about change.
     public void subscribe(self, listener)
-        Adds the received IListener object to the list of subscribed listeners.
+        Adds the received IListener object to the subscribed listeners.
     public void unsubscribe(self,listener)
-        Removes the received IListener object from the list of subscribed listeners.
+        Removes the received IListener object from the subscribed listeners.
+    public void load_source(self, source, ast_parser)
+        Parses the source code and sets it as the uploaded code.
     public File get_recommendations(self)
         Finds the matches for uploaded code block and returns file with recommendations.
+    public void match_region(self, start, stop)
+        Finds the matches that start in the region of the uploaded AST and parses them.
+    public File stream_recommendations(self, source_file, ast_parser)
+        Finds the matches for the code read from the file one top-level definition at a time.
+    public bool matches_ahead(self, runs)
+        Checks if the encoded pattern can match the uploaded AST starting at the current node.
     public void parse(self, pattern_matcher)
         Parses the IPatternMatcher object into the format determined by the parser.
+    public float score(self, pattern)
+        Returns the score of the pattern.
+    public bool can_rank(self, pattern, method)
+        Checks if a match of the pattern can still be among the best matches of the method.
     """
 
-    def __init__(self, parser):
+    def __init__(self, parser, uploaded_ast=None, profiler=None, vocabulary=None, top_k=None, scorer=None,
+                 processes=1):
         """
         Initialises Recommender object
 
@@ -99,9 +190,133 @@ class Recommender(Reader):
         ----------
         parser : IPatternParser
             Parser object for parsing matches
+        uploaded_ast : ast, optional
+            AST of the code that needs to be matched (default is None)
+        profiler : PatternProfiler, optional
+            Profiler that collects per-pattern matching times of sampled runs (default is None)
+        vocabulary : TokenVocabulary, optional
+            Vocabulary the patterns of the subscribed factories were encoded by, the uploaded nodes are encoded by it
+            so the listeners can compare tokens (default is None)
+        top_k : int, optional
+            Number of the best matches parsed for every method (default is None, all matches are parsed)
+        scorer : callable, optional
+            Function that maps a Pattern to the score by which its matches are ranked (default is None,
+            recommendation_score)
+        processes : int, optional
+            Maximum number of worker processes used by get_recommendations for uploaded modules with at least
+            MIN_PARALLEL_NODES nodes (default is 1, the uploaded AST is matched in this process), None for the
+            number of available cores
         """
         super().__init__()
         self.parser = parser
+        self.uploaded_ast = uploaded_ast
+        self.current_node = None
+        self.current_index = -1
+        self.current_end = -1
+        self.profiler = profiler
+        self.profile = None
+        self.parsed_source = None
+        self.vocabulary = vocabulary
+        self.current_token = None
+        # tokens and subtree ends of the visited subtree and the preorder index of its root
+        self.__tokens = None
+        self.__ends = None
+        self.__first_index = 0
+        # factories that compare tokens indexed by the token of their first node, with their subscription order
+        self.__dispatched = {}
+        self.__subscriptions = 0
+        self.top_k = top_k
+        self.scorer = scorer if scorer is not None else recommendation_score
+        self.current_method = -1
+        # functions that contain the current node as (preorder index, end), ranked matches as heaps of
+        # (score, -completion, matcher) indexed by method, number of completed matches and scores of the patterns
+        self.__methods = []
+        self.__ranked = {}
+        self.__completed = 0
+        self.__scores = {}
+        self.processes = processes if processes is not None else os.cpu_count()
+
+    def notify(self):
+        """
+        Notifies the subscribed listeners that can match the current node about change. Factories that compare tokens
+        are notified only about the nodes with the token of their first node, or about all nodes if their pattern
+        starts with a wildcard. They are notified in the order of subscription, before the other listeners.
+        """
+
+        if not self.__dispatched:
+            super().notify()
+            return
+        factories = self.__dispatched.get(self.current_token, ())
+        wildcard_factories = self.__dispatched.get(WILDCARD, ())
+        if factories and wildcard_factories:
+            factories = sorted(factories + wildcard_factories)
+        elif wildcard_factories:
+            factories = wildcard_factories
+        listeners = list(self.listeners)
+        if instrumentation.enabled:
+            instrumentation.count('reader.notify')
+            instrumentation.count('listener.update', len(factories) + len(listeners))
+        for _, factory in factories:
+            factory.update()
+        for listener in listeners:
+            listener.update()
+
+    def subscribe(self, listener):
+        """
+        Adds the received IListener object to the subscribed listeners. Factories bound to this Recommender that
+        compare tokens are indexed by the token of their first node.
+
+        Parameters
+        ----------
+        listener : IListener
+            IListener to subscribe
+        """
+
+        if isinstance(listener, PatternFactoryListener) and listener.tokens and listener.recommender is self:
+            self.__subscriptions += 1
+            self.__dispatched.setdefault(listener.tokens[0], []).append((self.__subscriptions, listener))
+        else:
+            super().subscribe(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Removes the received IListener object from the subscribed listeners.
+
+        Parameters
+        ----------
+        listener: IListener
+            IListener to unsubscribe
+        """
+
+        if isinstance(listener, PatternFactoryListener) and listener.tokens and listener.recommender is self:
+            factories = self.__dispatched[listener.tokens[0]]
+            factories.remove(next(entry for entry in factories if entry[1] is listener))
+            if not factories:
+                del self.__dispatched[listener.tokens[0]]
+        else:
+            super().unsubscribe(listener)
+
+    def load_source(self, source, ast_parser):
+        """
+        Parses the source code and sets it as the uploaded code. If the parser is a CachingASTParser, the preorder
+        node table of the cached source is reused, so matching a repeatedly uploaded source does not parse or
+        flatten it again.
+
+        Parameters
+        ----------
+        source : str
+            Source code that needs to be matched
+        ast_parser : ASTParser
+            Parser used for transforming the source code into AST
+        """
+
+        parse_source = getattr(ast_parser, 'parse_source', None)
+        if parse_source is None:
+            self.parsed_source = None
+            self.uploaded_ast = ast_parser.parse(source)
+        else:
+            self.parsed_source = parse_source(source)
+            self.uploaded_ast = self.parsed_source.tree
 
     def get_recommendations(self):
         """
@@ -112,18 +327,497 @@ class Recommender(Reader):
         File
             File with found recommendations
         """
-        pass
+
+        started = self.__begin()
+        node_count = None
+        if self.processes > 1 and self.top_k is None and self.profile is None:
+            node_count = self.__visit_parallel(self.uploaded_ast)
+        if node_count is None:
+            node_count = self.__visit(self.uploaded_ast, 0)
+        self.__finish(started, node_count)
+        return self.parser.output
+
+    def match_region(self, start, stop):
+        """
+        Finds the matches that start in the region of the uploaded AST and parses them. The nodes that follow the
+        region are visited only while a match started in the region is in progress. Used by the worker processes
+        that match the regions of a large uploaded AST.
+
+        Parameters
+        ----------
+        start : int
+            Preorder index of the first node of the region
+        stop : int
+            Preorder index that follows the last node of the region
+        """
+
+        nodes, ends = preorder_with_ends(self.uploaded_ast)
+        tokens = self.vocabulary.encode(nodes) if self.vocabulary is not None else None
+        self.__tokens, self.__ends, self.__first_index = tokens, ends, 0
+        for index in range(start, len(nodes)):
+            if index == stop:
+                # no match starts beyond the region, only the matches in progress are followed
+                self.__dispatched = {}
+                self.listeners = [listener for listener in self.listeners if isinstance(listener, PatternListener)]
+            if index >= stop and not self.listeners:
+                break
+            self.current_node, self.current_index, self.current_end = nodes[index], index, ends[index]
+            if tokens is not None:
+                self.current_token = tokens[index]
+            self.notify()
+        self.__tokens, self.__ends, self.current_token = None, None, None
+        self.current_node, self.current_index, self.current_end = None, -1, -1
+
+    def stream_recommendations(self, source_file, ast_parser=None):
+        """
+        Finds the matches for the code read from the file one top-level definition at a time.
+        Every top-level statement is parsed only when the previous one has been matched and its
+        AST is released afterwards, so the memory needed for matching is bounded by the largest
+        top-level definition instead of the whole file.
+
+        The module node of the file is never built, so unlike get_recommendations, the listeners
+        are not notified about it. The found matches are the matches get_recommendations finds
+        for the whole file except the ones that start at the module node, which are the matches
+        of patterns that consist of a single wildcard. Such a match would hold the AST of the
+        whole file.
+
+        Parameters
+        ----------
+        source_file : File
+            File with the code that needs to be matched
+        ast_parser : ASTParser, optional
+            Parser used for transforming every top-level definition into AST, it needs to normalize the ASTs the
+            same way as the parser of the patterns (default is None, ast.parse is used)
+
+        Returns
+        -------
+        File
+            File with found recommendations
+        """
+
+        started = self.__begin()
+        # index 0 belongs to the module node, which is not visited
+        next_index = 1
+        for first_line, source in iter_top_level_sources(source_file.readline):
+            tree = ast_parser.parse(source) if ast_parser is not None else ast.parse(source)
+            ast.increment_lineno(tree, first_line - 1)
+            for statement in tree.body:
+                next_index = self.__visit(statement, next_index)
+            del tree
+        self.__finish(started, next_index)
+        return self.parser.output
+
+    def __begin(self):
+        """
+        Prepares profiling and instrumentation of a matching run.
+
+        Returns
+        -------
+        float
+            Start time of the run if instrumentation is enabled, None otherwise
+        """
+
+        if self.profiler is not None and self.profiler.sample():
+            self.profile = {}
+        self.current_method = -1
+        self.__methods, self.__ranked, self.__completed = [], {}, 0
+        return time.perf_counter() if instrumentation.enabled else None
+
+    def __visit(self, root, first_index):
+        """
+        Visits all nodes of the subtree in preorder and notifies the listeners about every one of them.
+
+        Parameters
+        ----------
+        root : ast
+            Root of the visited subtree
+        first_index : int
+            Preorder index of the root in the uploaded AST
+
+        Returns
+        -------
+        int
+            Preorder index that follows the last node of the subtree
+        """
+
+        parsed = self.parsed_source is not None and self.parsed_source.tree is root
+        if parsed:
+            nodes, ends = self.parsed_source.nodes, self.parsed_source.ends
+        else:
+            nodes, ends = preorder_with_ends(root)
+        ranked = self.top_k is not None
+        if self.vocabulary is None:
+            for index, node in enumerate(nodes):
+                self.current_node, self.current_index, self.current_end = \
+                    node, first_index + index, first_index + ends[index]
+                if ranked:
+                    self.__enter_method(node)
+                self.notify()
+            return first_index + len(nodes)
+
+        tokens = self.parsed_source.tokens(self.vocabulary) if parsed else self.vocabulary.encode(nodes)
+        self.__tokens, self.__ends, self.__first_index = tokens, ends, first_index
+        for index, node in enumerate(nodes):
+            self.current_node, self.current_index, self.current_end, self.current_token = \
+                node, first_index + index, first_index + ends[index], tokens[index]
+            if ranked:
+                self.__enter_method(node)
+            self.notify()
+        self.__tokens, self.__ends, self.current_token = None, None, None
+        return first_index + len(nodes)
+
+    def __visit_parallel(self, root):
+        """
+        Visits the regions of the uploaded module in worker processes and parses the found matches in the order in
+        which __visit would parse them.
+
+        Parameters
+        ----------
+        root : ast
+            Uploaded AST
+
+        Returns
+        -------
+        int
+            Number of nodes of the uploaded AST, None if it is too small or not a module and needs to be visited in
+            this process
+        """
+
+        factories = self.__factories()
+        if not isinstance(root, ast.Module) or len(root.body) < 2 or not factories:
+            return None
+        if self.parsed_source is not None and self.parsed_source.tree is root:
+            nodes, ends = self.parsed_source.nodes, self.parsed_source.ends
+        else:
+            nodes, ends = preorder_with_ends(root)
+        if len(nodes) < MIN_PARALLEL_NODES:
+            return None
+
+        # imported lazily, most runs never start worker processes
+        from concurrent.futures.process import BrokenProcessPool
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        regions = _regions(ends, min(self.processes, len(root.body)))
+        # position of every top-level statement in the module body by its preorder index
+        statements = {}
+        index = 1
+        while index < len(nodes):
+            statements[index] = len(statements)
+            index = ends[index]
+        generation, patterns = _serialized_patterns([factory.pattern for factory in factories])
+        sources = [pattern_serialization.dumps(ast.Module(body=root.body[statements[start]:statements.get(
+            stop, len(root.body))], type_ignores=[])) for start, stop in regions]
+        executor = _process_pool(len(regions))
+        try:
+            futures = [executor.submit(_match_region, generation, patterns, source, start - 1)
+                       for source, (start, _) in zip(sources, regions)]
+            matches, pending = self.__visit_module(root, ends[0], factories)
+            for future, (_, stop) in zip(futures, regions):
+                completed, in_progress = pattern_serialization.loads(future.result())
+                matches.extend(completed)
+                pending.extend((max(resume_at, stop), rank, start, index, wildcard_indexes)
+                               for rank, start, index, resume_at, wildcard_indexes in in_progress)
+        except BrokenProcessPool:
+            _discard_process_pool(executor)
+            raise
+        matches.extend(self.__follow(pending, nodes, ends, factories))
+        # the matches of every region are sorted and end before the matches of the following regions, so sorting
+        # mostly merges the matches followed in this process into them
+        matches.sort()
+
+        # a matcher is created for every match at once, none of them is part of a reference cycle, so the cyclic
+        # garbage collector is paused meanwhile
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            parse = self.parse
+            for end, _, start, rank, wildcard_indexes in matches:
+                factory = factories[rank]
+                matcher = PatternListener(factory.pattern, self, factory.nodes, factory.labels)
+                matcher.index, matcher.start, matcher.end = len(factory.nodes), start, end
+                if wildcard_indexes:
+                    matcher.wildcard_matches = [nodes[index] for index in wildcard_indexes]
+                parse(matcher)
+        finally:
+            if enabled:
+                gc.enable()
+        if started is not None:
+            instrumentation.timing('recommender.parallel_match', time.perf_counter() - started)
+            instrumentation.count('recommender.regions', len(regions))
+        return len(nodes)
+
+    def __visit_module(self, root, end, factories):
+        """
+        Notifies the factories about the module node, which does not belong to any region.
+
+        Parameters
+        ----------
+        root : ast
+            Uploaded module
+        end : int
+            Preorder index that follows the last node of the module
+        factories : list of PatternFactoryListener
+            Subscribed factories in the order in which they are notified
+
+        Returns
+        -------
+        list of tuple, list of tuple
+            Matches completed at the module node as their match_order_key followed by the preorder indexes of the
+            wildcard matches, and the matches in progress as (next index, rank, start, index, wildcard indexes)
+        """
+
+        ranks = _pattern_ranks(factories)
+        parser, listeners = self.parser, list(self.listeners)
+        self.parser = CollectingPatternParser()
+        self.current_node, self.current_index, self.current_end = root, 0, end
+        if self.vocabulary is not None:
+            self.current_token = self.vocabulary.token(root)
+        try:
+            self.notify()
+            # the module node is the only node visited so far, it is the only node a wildcard can have matched
+            completed = [match_order_key(matcher.start, matcher.end, ranks[id(matcher.pattern)]) +
+                         ([0] * len(matcher.wildcard_matches),) for matcher in self.parser.output]
+            pending = [(max(listener.resume_at, 1), ranks[id(listener.pattern)], listener.start, listener.index,
+                        [0] * len(listener.wildcard_matches)) for listener in self.listeners
+                       if isinstance(listener, PatternListener)]
+        finally:
+            self.parser, self.listeners, self.current_token = parser, listeners, None
+        return completed, pending
+
+    def __follow(self, pending, nodes, ends, factories):
+        """
+        Follows the matches that were in progress at the ends of their regions until they are completed or
+        abandoned. The followed matches compare the nodes by their checks.
+
+        Parameters
+        ----------
+        pending : list of tuple
+            Matches in progress as (next index, rank, start, index, wildcard indexes)
+        nodes : list of ast
+            Nodes of the uploaded AST in preorder
+        ends : list of int
+            Preorder index that follows the last node of the subtree of every uploaded node
+        factories : list of PatternFactoryListener
+            Subscribed factories in the order in which they are notified
+
+        Returns
+        -------
+        list of tuple
+            Completed matches as their match_order_key followed by the preorder indexes of the wildcard matches
+        """
+
+        follower = Recommender(CollectingPatternParser(), self.uploaded_ast)
+        # rank and wildcard indexes of every followed listener, preorder indexes of the visited nodes
+        states = {}
+        visited = {}
+        pending.sort(key=lambda state: state[0])
+        position = 0
+        index = pending[0][0] if pending else len(nodes)
+        while index < len(nodes):
+            while position < len(pending) and pending[position][0] <= index:
+                _, rank, start, matched, wildcard_indexes = pending[position]
+                factory = factories[rank]
+                listener = PatternListener(factory.pattern, follower, factory.nodes, factory.labels,
+                                           checks=factory.checks)
+                listener.index, listener.start = matched, start
+                listener.wildcard_matches = [nodes[index] for index in wildcard_indexes]
+                states[id(listener)] = (rank, wildcard_indexes)
+                follower.subscribe(listener)
+                position += 1
+            if not follower.listeners:
+                if position == len(pending):
+                    break
+                index = pending[position][0]
+                continue
+            follower.current_node, follower.current_index, follower.current_end = nodes[index], index, ends[index]
+            visited[id(nodes[index])] = index
+            follower.notify()
+            index += 1
+
+        completed = []
+        for matcher in follower.parser.output:
+            rank, wildcard_indexes = states[id(matcher)]
+            completed.append(match_order_key(matcher.start, matcher.end, rank) + (
+                wildcard_indexes + [visited[id(node)] for node in matcher.wildcard_matches[len(wildcard_indexes):]],))
+        return completed
+
+    def __factories(self):
+        """
+        Returns the subscribed factories in the order in which they are notified about a node, None if other
+        listeners are subscribed.
+        """
+
+        factories = [factory for _, factory in sorted(entry for entries in self.__dispatched.values()
+                                                      for entry in entries)]
+        for listener in self.listeners:
+            if not isinstance(listener, PatternFactoryListener):
+                return None
+            factories.append(listener)
+        return factories
+
+    def __enter_method(self, node):
+        """
+        Updates the innermost function that contains the current node.
+        """
+
+        methods = self.__methods
+        while methods and methods[-1][1] <= self.current_index:
+            methods.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            methods.append((self.current_index, self.current_end))
+        self.current_method = methods[-1][0] if methods else -1
+
+    def matches_ahead(self, runs):
+        """
+        Checks if the encoded pattern can match the uploaded AST starting at the current node. Runs of pattern tokens
+        are compared with the tokens of the uploaded nodes as array slices and wildcards skip whole uploaded subtrees,
+        the same way a PatternListener advances through the nodes. Used by factories to avoid creating listeners
+        that would be abandoned.
+
+        Parameters
+        ----------
+        runs : list of array
+            Runs of the pattern tokens created by token_runs, None for wildcards
+
+        Returns
+        -------
+        bool
+            False if the pattern cannot match at the current node, True if it matches or if the match continues
+            beyond the visited subtree and is left to the listener
+        """
+
+        tokens, ends = self.__tokens, self.__ends
+        if tokens is None:
+            return True
+        position, length = self.current_index - self.__first_index, len(tokens)
+        for run in runs:
+            if position >= length:
+                return True
+            if run is None:
+                position = ends[position]
+                continue
+            end = position + len(run)
+            if end > length:
+                return tokens[position:] == run[:length - position]
+            if tokens[position:end] != run:
+                return False
+            position = end
+        return True
+
+    def __finish(self, started, node_count):
+        """
+        Finishes profiling and instrumentation of a matching run.
+
+        Parameters
+        ----------
+        started : float
+            Start time of the run if instrumentation is enabled, None otherwise
+        node_count : int
+            Number of visited nodes
+        """
+
+        if self.top_k is not None:
+            # retained matches are parsed in the order of their completion
+            ranked = [entry for heap in self.__ranked.values() for entry in heap]
+            ranked.sort(key=lambda entry: -entry[1])
+            for _, _, matcher in ranked:
+                self.__parse(matcher)
+            self.__methods, self.__ranked = [], {}
+        self.current_node, self.current_index, self.current_end, self.current_method = None, -1, -1, -1
+        if self.profile is not None:
+            self.profiler.merge(self.profile)
+            self.profile = None
+        if started is not None:
+            instrumentation.timing('recommender.get_recommendations', time.perf_counter() - started)
+            instrumentation.count('recommender.nodes', node_count)
 
     def parse(self, pattern_matcher):
         """
-        Parses the IPatternMatcher object into the format determined by the parser
+        Parses the IPatternMatcher object into the format determined by the parser. In the top-k mode the match is
+        ranked instead and parsed at the end of the run if it is among the best matches of its method.
 
         Parameters
         ----------
         pattern_matcher: IPatternMatcher
             IPatternMatcher to be parsed
         """
-        pass
+
+        if self.top_k is not None:
+            self.__rank(pattern_matcher)
+            return
+        self.__parse(pattern_matcher)
+
+    def score(self, pattern):
+        """
+        Returns the score of the pattern. Scores are computed by the scorer once per recommender.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Scored pattern
+
+        Returns
+        -------
+        float
+            Score of the pattern
+        """
+
+        score = self.__scores.get(id(pattern))
+        if score is None:
+            score = self.__scores[id(pattern)] = self.scorer(pattern)
+        return score
+
+    def can_rank(self, pattern, method=None):
+        """
+        Checks if a match of the pattern can still be among the best matches of the method. Matches that complete
+        later lose ties, so the score needs to be strictly greater than the lowest retained score.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern of the match
+        method : int, optional
+            Preorder index of the function the match belongs to (default is None, the current method)
+
+        Returns
+        -------
+        bool
+            False if the match would not be parsed, True otherwise or if matches are not ranked
+        """
+
+        if self.top_k is None:
+            return True
+        heap = self.__ranked.get(self.current_method if method is None else method, ())
+        return len(heap) < self.top_k or (len(heap) > 0 and self.score(pattern) > heap[0][0])
+
+    def __rank(self, pattern_matcher):
+        """
+        Adds the completed match to the heap of its method, replacing the worst retained match if the heap is full.
+        """
+
+        method = getattr(pattern_matcher, 'method', -1)
+        heap = self.__ranked.setdefault(method, [])
+        entry = (self.score(pattern_matcher.pattern), -self.__completed, pattern_matcher)
+        self.__completed += 1
+        if len(heap) < self.top_k:
+            heapq.heappush(heap, entry)
+            return
+        if instrumentation.enabled:
+            instrumentation.count('recommender.matches_dropped')
+        if heap and entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    def __parse(self, pattern_matcher):
+        """
+        Parses the IPatternMatcher object with the parser and records the time spent in it.
+        """
+
+        if not instrumentation.enabled:
+            self.parser.parse(pattern_matcher)
+            return
+        started = time.perf_counter()
+        self.parser.parse(pattern_matcher)
+        instrumentation.timing('recommender.parse', time.perf_counter() - started)
 
 
 class IListener(ABC):
@@ -238,11 +932,28 @@ class PatternFactoryListener(IPatternFactory, IPatternMatcher, IListener):
     wildcard_matches: list of ast
         List of ASTs that were matched to wildcard nodes in the IPatternMatcher Pattern object. Used later in parsing of
         the matched patterns.
+    nodes : list of ast
+        Nodes of the Pattern in the order in which they are matched
+    labels : list of tuple
+        Labels of the Pattern nodes, see match_label, None for wildcard nodes
+    checks : list of callable
+        Checks the Pattern nodes are compiled into, None for wildcard nodes. Factories that compare tokens compile
+        them on first access, which happens only if nodes are compared outside of the runs of their Recommender
+    compiler : PatternCompiler
+        Compiler that caches the checks of the Pattern nodes, None if they are compiled without caching
+    vocabulary : TokenVocabulary
+        Vocabulary the Pattern nodes are encoded by, None if they are not encoded
+    tokens : array
+        Tokens of the Pattern nodes, None if they are not encoded or the bound Recommender uses another vocabulary
+    runs : list of array
+        Runs of the tokens compared with the uploaded tokens at once, None for wildcards
 
     Methods
     -------
-    public __init__(self, pattern, recommender)
+    public __init__(self, pattern, recommender, vocabulary, compiler, labels, tokens, checks)
         Initialises PatternFactoryListener
+    public PatternFactoryListener bind(self, recommender)
+        Returns a copy of the factory that listens to the received Recommender.
     public void update(self)
         Method called by the Reader class. When this method is called PatternFactoryListener object retrieves the
         current node from Recommender and checks for match, if the node matches then the PatternFactoryListener creates
@@ -253,7 +964,8 @@ class PatternFactoryListener(IPatternFactory, IPatternMatcher, IListener):
         Check if the input node matches the IPatternMatcher node that is next in the pattern.
     """
 
-    def __init__(self, pattern, recommender):
+    def __init__(self, pattern, recommender=None, vocabulary=None, compiler=None, labels=None, tokens=None,
+                 checks=None):
         """
         Initialises PatternFactoryListener.
 
@@ -261,18 +973,108 @@ class PatternFactoryListener(IPatternFactory, IPatternMatcher, IListener):
         ----------
         pattern : Pattern
             Pattern it is creating
+        recommender : Recommender, optional
+            Recommender object that the listener is listening to. Factories loaded from the database are not bound to
+            any Recommender, they are bound with bind() (default is None)
+        vocabulary : TokenVocabulary, optional
+            Vocabulary used for encoding the Pattern nodes, nodes are matched by their tokens in Recommenders that
+            use the same vocabulary (default is None)
+        compiler : PatternCompiler, optional
+            Compiler that caches the checks of the Pattern nodes (default is None, the nodes are compiled without
+            caching)
+        labels : list of tuple, optional
+            Prepared labels of the Pattern nodes, they are computed from the Pattern if not provided (default is None)
+        tokens : array, optional
+            Prepared tokens of the Pattern nodes encoded by the vocabulary, they are computed from the Pattern if not
+            provided (default is None)
+        checks : list of callable, optional
+            Prepared checks of the Pattern nodes, they are compiled from the Pattern if not provided, only once they
+            are needed if the factory compares tokens (default is None)
+        """
+        super().__init__(pattern)
+        self.recommender = recommender
+        self.wildcard_matches = []
+        self.nodes = pattern_nodes(pattern)
+        self.labels = labels if labels is not None else \
+            [None if isinstance(node, Wildcard) else match_label(node) for node in self.nodes]
+        self.compiler = compiler
+        self.vocabulary = vocabulary
+        encoded = vocabulary is not None and (recommender is None or recommender.vocabulary is vocabulary)
+        if encoded and tokens is None:
+            tokens = vocabulary.encode_pattern(self.nodes)
+        self.tokens = tokens if encoded else None
+        self.runs = token_runs(self.tokens) if self.tokens is not None else None
+        # shared with bound copies, holds the checks once they are compiled
+        self.__checks = [checks]
+        if self.tokens is None:
+            self.__compile()
+
+    @property
+    def checks(self):
+        """
+        Returns the checks the Pattern nodes are compiled into, compiling them on first access.
+
+        Returns
+        -------
+        list of callable
+            Checks of the Pattern nodes, None for wildcard nodes
+        """
+
+        return self.__compile()
+
+    def bind(self, recommender):
+        """
+        Returns a copy of the factory that listens to the received Recommender. The copy shares the prepared pattern
+        nodes with this factory, so binding is cheap and the factory itself can be shared between Recommender runs.
+        The copy compares tokens only if the Recommender encodes the uploaded nodes by the vocabulary of the factory.
+
+        Parameters
+        ----------
         recommender : Recommender
-            Recommender object that the listener is listening to.s
+            Recommender object that the copy will listen to
+
+        Returns
+        -------
+        PatternFactoryListener
+            Factory bound to the Recommender
         """
-        pass
+
+        factory = copy.copy(self)
+        factory.recommender = recommender
+        factory.wildcard_matches = []
+        if self.vocabulary is None or recommender.vocabulary is not self.vocabulary:
+            factory.tokens = factory.runs = None
+        return factory
 
     def update(self):
         """
         Method called by the Reader class. When this method is called PatternFactoryListener object retrieves the
         current node from Recommender and checks for match, if the node matches then the PatternFactoryListener creates
-        a designated PatternListener.
+        a designated PatternListener. In the top-k mode the node is not checked if the matches of the pattern can no
+        longer be among the best matches of the current method.
         """
-        pass
+
+        if self.recommender.top_k is not None and not self.recommender.can_rank(self.pattern):
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_pruned')
+            return
+        node = self.recommender.current_node
+        if instrumentation.enabled:
+            instrumentation.count('listener.check_match')
+        if self.recommender.profile is None:
+            matched = self.check_match(node)
+        else:
+            matched = _profiled_check_match(self, node)
+        if matched and self.runs is not None and not self.recommender.matches_ahead(self.runs):
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_rejected')
+            return
+        if matched:
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_created')
+            listener = self.create_pattern()
+            self.recommender.subscribe(listener)
+            listener.advance(node)
 
     def create_pattern(self):
         """
@@ -283,7 +1085,9 @@ class PatternFactoryListener(IPatternFactory, IPatternMatcher, IListener):
         IPatternMatcher
             IPatternMatcher that contains a Pattern that the concrete factory is responsible for creating
         """
-        pass
+
+        return PatternListener(self.pattern, self.recommender, self.nodes, self.labels, self.tokens,
+                               self.__checks[0] if self.tokens is not None else self.checks)
 
     def check_match(self, node):
         """
@@ -299,7 +1103,20 @@ class PatternFactoryListener(IPatternFactory, IPatternMatcher, IListener):
         bool
             True if the nodes match, false otherwise
         """
-        pass
+
+        if not self.nodes:
+            return False
+        if self.tokens is not None and node is self.recommender.current_node:
+            return self.tokens[0] == WILDCARD or self.tokens[0] == self.recommender.current_token
+        check = self.checks[0]
+        return check is None or check(node)
+
+    def __compile(self):
+        checks = self.__checks[0]
+        if checks is None:
+            checks = self.__checks[0] = self.compiler.compile(self.nodes) if self.compiler is not None else \
+                [compile_node(node) for node in self.nodes]
+        return checks
 
 
 class PatternListener(IListener, IPatternMatcher):
@@ -322,10 +1139,29 @@ class PatternListener(IListener, IPatternMatcher):
         the matched patterns
     index : int
         Index of the last checked node
+    nodes : list of ast
+        Nodes of the Pattern in the order in which they are matched
+    labels : list of tuple
+        Labels of the Pattern nodes, see match_label, None for wildcard nodes
+    tokens : array
+        Tokens of the Pattern nodes encoded by the vocabulary of the Recommender, None if they are not encoded
+    checks : list of callable
+        Checks the Pattern nodes are compiled into, None for wildcard nodes. Listeners that compare tokens compile
+        them on first access, which happens only if nodes are compared outside of the run of their Recommender
+    start : int
+        Preorder index of the uploaded AST node at which the match started
+    end : int
+        Preorder index of the uploaded AST node at which the match was completed, -1 while matching
+    resume_at : int
+        Preorder index of the next uploaded AST node that is checked, nodes inside subtrees matched to wildcards are
+        skipped
+    method : int
+        Preorder index of the innermost function that contains the node at which the match started, -1 outside
+        functions or if the Recommender does not rank matches
 
     Methods
     -------
-    public __init__(self, pattern, recommender)
+    public __init__(self, pattern, recommender, nodes, labels, tokens, checks)
         Initialises PatternListener
     public void update(self)
         Method called by the Reader class. When this method is called PatternListener object retrieves the current node
@@ -340,11 +1176,13 @@ class PatternListener(IListener, IPatternMatcher):
         Creates and returns IPatternMatcher object for the detected pattern.
     public bool check_match(self, node)
         Check if the input node matches the IPatternMatcher node that is next in the pattern.
+    public void advance(self, node)
+        Moves to the next node in the pattern after the input node was matched.
     public void unsubscribe(self)
         Removes itself from the list of listeners in the associated Reader object.
     """
 
-    def __init__(self, pattern, recommender):
+    def __init__(self, pattern, recommender, nodes=None, labels=None, tokens=None, checks=None):
         """
         Initialises PatternListener.
 
@@ -354,8 +1192,30 @@ class PatternListener(IListener, IPatternMatcher):
             Pattern it is matching
         recommender : Recommender
             Recommender object that the listener is listening to.s
+        nodes : list of ast, optional
+            Prepared nodes of the Pattern, they are computed from the Pattern if not provided (default is None)
+        labels : list of tuple, optional
+            Prepared labels of the Pattern nodes, they are computed from the Pattern if not provided (default is None)
+        tokens : array, optional
+            Tokens of the Pattern nodes encoded by the vocabulary of the Recommender, the nodes are compared by their
+            checks if not provided (default is None)
+        checks : list of callable, optional
+            Checks the Pattern nodes are compiled into, they are compiled from the nodes once they are needed if not
+            provided (default is None)
         """
-        pass
+        super().__init__(pattern)
+        self.recommender = recommender
+        self.wildcard_matches = []
+        self.nodes = nodes if nodes is not None else pattern_nodes(pattern)
+        self.labels = labels if labels is not None else \
+            [None if isinstance(node, Wildcard) else match_label(node) for node in self.nodes]
+        self.tokens = tokens
+        self.__checks = checks
+        self.index = 0
+        self.start = recommender.current_index if recommender is not None else -1
+        self.end = -1
+        self.resume_at = 0
+        self.method = recommender.current_method if recommender is not None else -1
 
     def update(self):
         """
@@ -367,8 +1227,30 @@ class PatternListener(IListener, IPatternMatcher):
             Pattern listener unsubscribes from the reader and requests parsing.
         2) The matched node is not the last node in the pattern:
             Pattern listener increments its internal node count and continues to listen for updates from the reader.
+        In the top-k mode the listener also unsubscribes once its match can no longer be among the best matches of
+        its method.
         """
-        pass
+
+        if self.recommender.current_index < self.resume_at:
+            return
+        if self.recommender.top_k is not None and not self.recommender.can_rank(self.pattern, self.method):
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_pruned')
+            self.unsubscribe()
+            return
+        node = self.recommender.current_node
+        if instrumentation.enabled:
+            instrumentation.count('listener.check_match')
+        if self.recommender.profile is None:
+            matched = self.check_match(node)
+        else:
+            matched = _profiled_check_match(self, node)
+        if matched:
+            self.advance(node)
+        else:
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_abandoned')
+            self.unsubscribe()
 
     def check_match(self, node):
         """
@@ -384,10 +1266,346 @@ class PatternListener(IListener, IPatternMatcher):
         bool
             True if the nodes match, false otherwise
         """
-        pass
+
+        if self.tokens is not None and node is self.recommender.current_node:
+            token = self.tokens[self.index]
+            return token == WILDCARD or token == self.recommender.current_token
+        check = self.checks[self.index]
+        return check is None or check(node)
+
+    def advance(self, node):
+        """
+        Moves to the next node in the pattern after the input node was matched. Nodes matched to wildcards are saved
+        together with their subtrees, which are skipped. When the last node of the pattern is matched, the listener
+        unsubscribes and requests parsing.
+
+        Parameters
+        ----------
+        node : ast
+            AST node that matched the next IPatternMatcher Pattern node
+        """
+
+        if self.labels[self.index] is None:
+            self.wildcard_matches.append(node)
+            self.resume_at = self.recommender.current_end
+        self.index += 1
+        if self.index == len(self.nodes):
+            self.end = self.recommender.current_index
+            if instrumentation.enabled:
+                instrumentation.count('recommender.matches_completed')
+            self.unsubscribe()
+            self.recommender.parse(self)
+
+    @property
+    def checks(self):
+        """
+        Returns the checks the Pattern nodes are compiled into, compiling them on first access.
+
+        Returns
+        -------
+        list of callable
+            Checks of the Pattern nodes, None for wildcard nodes
+        """
+
+        if self.__checks is None:
+            self.__checks = [compile_node(node) for node in self.nodes]
+        return self.__checks
 
     def unsubscribe(self):
         """
         Removes itself from the list of listeners in the associated Reader object.
         """
-        pass
\ No newline at end of file
+
+        self.recommender.unsubscribe(self)
+
+
+def iter_top_level_sources(readline):
+    """
+    Splits the code into top-level statements without parsing it. The code is tokenized lazily
+    and every statement is yielded as soon as the next one starts, so only a single statement
+    is kept in memory. Decorators are kept together with the decorated definition, the elif,
+    else, except and finally clauses together with their compound statement, comments and
+    blank lines are kept with the preceding statement.
+
+    Parameters
+    ----------
+    readline : callable
+        Function that returns the next line of the code, such as readline of a file
+
+    Yields
+    ------
+    (int, str)
+        Number of the first line of the statement and the source code of the statement
+    """
+
+    lines = []
+    first_line = 1
+
+    def read():
+        line = readline()
+        lines.append(line)
+        return line
+
+    depth = 0
+    at_line_start = True
+    after_decorator = False
+    for token in tokenize.generate_tokens(read):
+        if token.type == tokenize.INDENT:
+            depth += 1
+        elif token.type == tokenize.DEDENT:
+            depth -= 1
+        elif token.type == tokenize.NEWLINE:
+            at_line_start = True
+        elif token.type not in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER) and at_line_start:
+            at_line_start = False
+            if depth == 0 and token.string not in _CONTINUATION_KEYWORDS:
+                line_number = token.start[0]
+                if not after_decorator and line_number > first_line:
+                    yield first_line, ''.join(lines[:line_number - first_line])
+                    del lines[:line_number - first_line]
+                    first_line = line_number
+                after_decorator = token.string == '@'
+
+    source = ''.join(lines)
+    if source.strip():
+        yield first_line, source
+
+
+def pattern_nodes(pattern):
+    """
+    Returns the nodes of the pattern in the order in which they are matched against the uploaded AST. The module node
+    of the original AST is skipped, nodes of its statements are returned in preorder.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose nodes are returned
+
+    Returns
+    -------
+    list of ast
+        Nodes of the pattern
+    """
+
+    roots = pattern.original.body if isinstance(pattern.original, ast.Module) else [pattern.original]
+    return [node for root in roots for node in preorder(root)]
+
+
+def _profiled_check_match(matcher, node):
+    """
+    Calls check_match of the matcher and records its duration in the profile of the current Recommender run.
+
+    Parameters
+    ----------
+    matcher : IPatternMatcher
+        Matcher whose check_match is called, it needs to be bound to a Recommender
+    node : ast
+        AST node that is checked for match
+
+    Returns
+    -------
+    bool
+        Result of check_match
+    """
+
+    started = time.perf_counter()
+    matched = matcher.check_match(node)
+    elapsed = time.perf_counter() - started
+    profile = matcher.recommender.profile
+    entry = profile.get(matcher.pattern.pattern_id)
+    if entry is None:
+        profile[matcher.pattern.pattern_id] = [1, elapsed]
+    else:
+        entry[0] += 1
+        entry[1] += elapsed
+    return matched
+
+
+def match_order_key(start, end, rank):
+    """
+    Returns the key that sorts matches in the order in which a single Recommender parses them. Matches are parsed at
+    the node where they are completed. At that node the factories are notified first, so single node matches come
+    before the longer ones, which are notified in the order in which they were started.
+
+    Parameters
+    ----------
+    start : int
+        Preorder index at which the match started
+    end : int
+        Preorder index at which the match was completed
+    rank : int
+        Position of the matched pattern in the pattern set
+
+    Returns
+    -------
+    tuple
+        Sort key of the match
+    """
+
+    return end, start != end, start, rank
+
+
+def _regions(ends, count):
+    """
+    Splits the top-level statements of the uploaded module into at most count runs of consecutive statements with
+    similar numbers of nodes.
+
+    Parameters
+    ----------
+    ends : list of int
+        Preorder index that follows the last node of the subtree of every uploaded node
+    count : int
+        Maximum number of regions
+
+    Returns
+    -------
+    list of (int, int)
+        Preorder index of the first node of every region and the index that follows its last node
+    """
+
+    # index 0 belongs to the module node, which the Recommender matches itself
+    size = len(ends) - 1
+    regions = []
+    start = index = 1
+    while index < len(ends):
+        index = ends[index]
+        if index - 1 >= size * (len(regions) + 1) / count or index == len(ends):
+            regions.append((start, index))
+            start = index
+    return regions
+
+
+def _match_region(generation, patterns, region, offset):
+    """
+    Finds the matches of the patterns that start in the region of the uploaded AST. Executed in the worker processes
+    of a Recommender. The decoded patterns are kept by the worker process until it receives another generation.
+
+    Parameters
+    ----------
+    generation : int
+        Generation of the pattern set the patterns belong to
+    patterns : bytes
+        Serialized patterns in the order in which their factories are notified
+    region : bytes
+        Serialized module that holds the top-level statements of the region
+    offset : int
+        Difference between the preorder index of a node in the uploaded AST and in the region module
+
+    Returns
+    -------
+    bytes
+        Serialized completed matches sorted by their match_order_key, which is followed by the preorder indexes of
+        the ASTs matched to the wildcard nodes of the pattern, and matches in progress at the end of the region as
+        the position of the pattern, start preorder index, index of the next pattern node, preorder index of the next
+        checked node and the preorder indexes of the wildcard matches
+    """
+
+    global _worker_patterns
+    if _worker_patterns[0] != generation:
+        vocabulary = TokenVocabulary()
+        _worker_patterns = (generation, [PatternFactoryListener(pattern, vocabulary=vocabulary)
+                                         for pattern in pattern_serialization.loads(patterns)], vocabulary)
+    _, factories, vocabulary = _worker_patterns
+    ranks = _pattern_ranks(factories)
+
+    parser = CollectingPatternParser()
+    recommender = Recommender(parser, pattern_serialization.loads(region), vocabulary=vocabulary)
+    for factory in factories:
+        recommender.subscribe(factory.bind(recommender))
+    nodes = preorder(recommender.uploaded_ast)
+    # the completed matches are kept until the end of the region and the abandoned ones are freed by reference
+    # counting, so the cyclic garbage collector is paused meanwhile
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # the module node of the region is not part of the uploaded AST
+        recommender.match_region(1, len(nodes))
+    finally:
+        if enabled:
+            gc.enable()
+
+    indexes = {id(node): index + offset for index, node in enumerate(nodes)}
+    completed = [match_order_key(matcher.start + offset, matcher.end + offset, ranks[id(matcher.pattern)]) +
+                 ([indexes[id(node)] for node in matcher.wildcard_matches],) for matcher in parser.output]
+    completed.sort()
+    in_progress = [(ranks[id(listener.pattern)], listener.start + offset, listener.index, listener.resume_at + offset,
+                    [indexes[id(node)] for node in listener.wildcard_matches]) for listener in recommender.listeners
+                   if isinstance(listener, PatternListener)]
+    return pattern_serialization.dumps((completed, in_progress))
+
+
+def _pattern_ranks(factories):
+    """
+    Returns the positions of the patterns of the factories indexed by the identities of the patterns.
+    """
+
+    ranks = {}
+    for rank, factory in enumerate(factories):
+        ranks.setdefault(id(factory.pattern), rank)
+    return ranks
+
+
+def _serialized_patterns(patterns):
+    """
+    Returns the generation and the serialized form of the patterns sent to the worker processes. The patterns are
+    serialized again only if they differ from the patterns of the previous call.
+
+    Parameters
+    ----------
+    patterns : list of Pattern
+        Patterns in the order in which their factories are notified
+
+    Returns
+    -------
+    int, bytes
+        Generation of the patterns and the serialized patterns
+    """
+
+    global _sent_patterns
+    with _pool_lock:
+        sent, data, generation = _sent_patterns
+        if len(sent) != len(patterns) or any(first is not second for first, second in zip(sent, patterns)):
+            # the sent patterns are referenced until they are replaced, so their identities are not reused meanwhile
+            sent, data, generation = tuple(patterns), pattern_serialization.dumps(patterns), generation + 1
+            _sent_patterns = (sent, data, generation)
+        return generation, data
+
+
+def _process_pool(workers):
+    """
+    Returns the worker processes shared by the Recommender objects of this process. The pool is created on first use
+    and replaced by a larger one if more workers are requested.
+
+    Parameters
+    ----------
+    workers : int
+        Number of needed worker processes
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        Shared worker processes
+    """
+
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            # imported lazily, most runs never start worker processes
+            from concurrent.futures import ProcessPoolExecutor
+
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool, _pool_workers = ProcessPoolExecutor(max_workers=workers), workers
+        return _pool
+
+
+def _discard_process_pool(pool):
+    """
+    Forgets the shared worker processes after one of them failed, the next run creates a new pool.
+    """
+
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is pool:
+            _pool, _pool_workers = None, 0
+    pool.shutdown(wait=False)
@@ -1,5 +1,9 @@
+import ast
+import sys
 from abc import ABC, abstractmethod
 
+from .ast_normalization import restore_original
+
 
 class PatternParser(ABC):
     """
@@ -34,7 +38,10 @@ class XMLPatternParser(PatternParser):
     This class is responsible for parsing matched patterns into XML
     form which will be used by the web user interface to present the
     code analysis results. This parser writes to the file passed to it
-    in its constructor.
+    in its constructor. The matches are written as match elements of a
+    single matches root element, which is opened before the first match
+    and ended by close, so the output is a well-formed XML document once
+    the parser is closed.
 
     ...
 
@@ -50,6 +57,9 @@ class XMLPatternParser(PatternParser):
 
     public void parse(self, pattern)
         Parses the IPatternMatcher into a XML form and writes it to a file.
+
+    public void close(self)
+        Ends the root element of the document.
     """
 
     def __init__(self, output):
@@ -61,7 +71,10 @@ class XMLPatternParser(PatternParser):
         output : File
             File in which the parser will write the parsed patterns
         """
-        pass
+
+        self.output = output
+        self.__opened = False
+        self.__closed = False
 
     def parse(self, pattern):
         """
@@ -71,9 +84,38 @@ class XMLPatternParser(PatternParser):
         ----------
         pattern : IPatternMatcher
             IPatternMatcher object that will be parsed and written to a file
+
+        Raises
+        ------
+        ValueError
+            If the parser was already closed
+        """
+
+        if self.__closed:
+            raise ValueError('XMLPatternParser is closed')
+        self.__open()
+        self.output.write('<match pattern={} start={}>'.format(_quoteattr(str(pattern.pattern.pattern_id)),
+                                                               _quoteattr(str(getattr(pattern, 'start', -1)))))
+        for node in pattern.wildcard_matches:
+            self.output.write('<wildcard>{}</wildcard>'.format(_escape(ast.unparse(restore_original(node)))))
+        self.output.write('</match>\n')
+
+    def close(self):
+        """
+        Ends the root element of the document, the root element is written as well if no match was parsed. The
+        output file itself is not closed. Closing the parser again has no effect.
         """
-        pass
 
+        if self.__closed:
+            return
+        self.__open()
+        self.output.write('</matches>\n')
+        self.__closed = True
+
+    def __open(self):
+        if not self.__opened:
+            self.output.write('<matches>\n')
+            self.__opened = True
 
 
 class ReadeablePatternParser(PatternParser):
@@ -85,6 +127,11 @@ class ReadeablePatternParser(PatternParser):
 
     ...
 
+    Attributes
+    ----------
+    output : File
+        Standard output
+
     Methods
     -------
     public void parse(self, pattern)
@@ -92,6 +139,10 @@ class ReadeablePatternParser(PatternParser):
         it to standard output.
     """
 
+    @property
+    def output(self):
+        return sys.stdout
+
     def parse(self, pattern):
         """
         Parses the IPatternMatcher into a human-readable form and writes it to
@@ -103,3 +154,92 @@ class ReadeablePatternParser(PatternParser):
             IPatternMatcher object that will be parsed and written to standard
             output
         """
+
+        wildcards = ', '.join(ast.unparse(restore_original(node)) for node in pattern.wildcard_matches)
+        print('Pattern {} matched at node {}{}'.format(pattern.pattern.pattern_id, getattr(pattern, 'start', -1),
+                                                       ': ' + wildcards if wildcards else ''), file=self.output)
+
+
+class CollectingPatternParser(PatternParser):
+    """
+    This class collects the parsed IPatternMatcher objects in a list instead of writing them
+    anywhere. It is used when the matches found by a Recommender need to be processed further,
+    for example merged with matches found by other Recommender objects, before they are parsed
+    into their final form.
+
+    ...
+
+    Attributes
+    ----------
+    output : list of IPatternMatcher
+        Parsed IPatternMatcher objects in the order in which they were parsed
+
+    Methods
+    -------
+    public __init__(self)
+        Initialises CollectingPatternParser object.
+    public void parse(self, pattern)
+        Appends the IPatternMatcher to the output list.
+    """
+
+    def __init__(self):
+        """
+        Initialises CollectingPatternParser object.
+        """
+
+        self.output = []
+
+    def parse(self, pattern):
+        """
+        Appends the IPatternMatcher to the output list.
+
+        Parameters
+        ----------
+        pattern : IPatternMatcher
+            IPatternMatcher object that is collected
+        """
+
+        self.output.append(pattern)
+
+
+def _escape(text):
+    """
+    Escapes the characters of the text that are not allowed in XML character data, the same way as
+    xml.sax.saxutils.escape. The xml package is not imported, importing it takes longer than parsing the matches of
+    a typical upload.
+
+    Parameters
+    ----------
+    text : str
+        Escaped text
+
+    Returns
+    -------
+    str
+        Escaped text
+    """
+
+    return text.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+
+def _quoteattr(text):
+    """
+    Escapes the text and quotes it for use as an XML attribute value, the same way as xml.sax.saxutils.quoteattr.
+
+    Parameters
+    ----------
+    text : str
+        Attribute value
+
+    Returns
+    -------
+    str
+        Quoted attribute value
+    """
+
+    text = _escape(text).replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+    if '"' not in text:
+        return '"{}"'.format(text)
+    if "'" not in text:
+        return "'{}'".format(text)
+    return '"{}"'.format(text.replace('"', '&quot;'))
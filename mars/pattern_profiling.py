@@ -0,0 +1,187 @@
+import random
+import threading
+
+
+class PatternProfiler:
+    """
+    This class attributes the matching time of Recommender runs to individual patterns. It is passed to Recommender
+    objects and profiles only a sample of their runs, so it can stay enabled in production. For every pattern it
+    records the number of match attempts and the cumulative time spent in check_match, which is used to find the
+    patterns that are the most expensive to match.
+
+    ...
+
+    Attributes
+    ----------
+    sample_rate : float
+        Share of Recommender runs that are profiled, between 0 and 1
+    profiles : dict of (int, PatternProfile)
+        Collected profiles indexed by pattern identifiers
+    sampled_runs : int
+        Number of profiled Recommender runs
+
+    Methods
+    -------
+    public __init__(self, sample_rate, seed)
+        Initialises PatternProfiler object.
+    public bool sample(self)
+        Decides whether the next Recommender run is profiled.
+    public void merge(self, run_profile)
+        Adds the measurements of a single profiled run to the collected profiles.
+    public list of PatternProfile report(self, limit)
+        Returns the profiles of the most expensive patterns.
+    public str format_report(self, limit)
+        Returns the report of the most expensive patterns in a human-readable form.
+    public void reset(self)
+        Removes all collected profiles.
+    """
+
+    def __init__(self, sample_rate=1.0, seed=None):
+        """
+        Initialises PatternProfiler object.
+
+        Parameters
+        ----------
+        sample_rate : float, optional
+            Share of Recommender runs that are profiled (default is 1.0, every run is profiled)
+        seed : int, optional
+            Seed of the random generator used for sampling (default is None)
+        """
+
+        self.sample_rate = sample_rate
+        self.profiles = {}
+        self.sampled_runs = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def sample(self):
+        """
+        Decides whether the next Recommender run is profiled.
+
+        Returns
+        -------
+        bool
+            True if the run should be profiled
+        """
+
+        with self.__lock:
+            return self.sample_rate >= 1.0 or self.__random.random() < self.sample_rate
+
+    def merge(self, run_profile):
+        """
+        Adds the measurements of a single profiled run to the collected profiles.
+
+        Parameters
+        ----------
+        run_profile : dict of (int, list)
+            Number of match attempts and cumulative check_match time in seconds indexed by pattern identifiers
+        """
+
+        with self.__lock:
+            self.sampled_runs += 1
+            for pattern_id, (attempts, seconds) in run_profile.items():
+                profile = self.profiles.get(pattern_id)
+                if profile is None:
+                    profile = self.profiles[pattern_id] = PatternProfile(pattern_id)
+                profile.attempts += attempts
+                profile.total_time += seconds
+
+    def report(self, limit=None):
+        """
+        Returns the profiles of the most expensive patterns.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of returned profiles (default is None, all profiles are returned)
+
+        Returns
+        -------
+        list of PatternProfile
+            Profiles sorted by cumulative check_match time, from the most expensive pattern
+        """
+
+        with self.__lock:
+            profiles = sorted(self.profiles.values(), key=lambda profile: (-profile.total_time, profile.pattern_id))
+        return profiles[:limit]
+
+    def format_report(self, limit=20):
+        """
+        Returns the report of the most expensive patterns in a human-readable form.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of reported patterns (default is 20)
+
+        Returns
+        -------
+        str
+            Table with pattern identifiers, total time, attempts and mean time per attempt
+        """
+
+        lines = ['{:>12} {:>12} {:>12} {:>12}'.format('pattern', 'total [s]', 'attempts', 'mean [us]')]
+        for profile in self.report(limit):
+            lines.append('{:>12} {:>12.6f} {:>12} {:>12.3f}'.format(str(profile.pattern_id), profile.total_time,
+                                                                    profile.attempts, profile.mean_time * 1e6))
+        return '\n'.join(lines)
+
+    def reset(self):
+        """
+        Removes all collected profiles.
+        """
+
+        with self.__lock:
+            self.profiles = {}
+            self.sampled_runs = 0
+
+
+class PatternProfile:
+    """
+    This class holds the profile of a single pattern.
+
+    ...
+
+    Attributes
+    ----------
+    pattern_id : int
+        Identifier of the profiled pattern
+    attempts : int
+        Number of times the pattern was checked against a node
+    total_time : float
+        Cumulative time spent in check_match of the pattern in seconds
+
+    Methods
+    -------
+    public __init__(self, pattern_id)
+        Initialises PatternProfile object.
+    public float mean_time(self)
+        Returns the mean time of a single match attempt in seconds.
+    """
+
+    def __init__(self, pattern_id):
+        """
+        Initialises PatternProfile object.
+
+        Parameters
+        ----------
+        pattern_id : int
+            Identifier of the profiled pattern
+        """
+
+        self.pattern_id = pattern_id
+        self.attempts = 0
+        self.total_time = 0.0
+
+    @property
+    def mean_time(self):
+        """
+        Returns the mean time of a single match attempt in seconds.
+
+        Returns
+        -------
+        float
+            Mean time of a single match attempt
+        """
+
+        return self.total_time / self.attempts if self.attempts else 0.0
@@ -1,4 +1,20 @@
+import ast
+import bisect
+import copy
+import heapq
+import os
+import time
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+
+from .ast_utils import SubtreeHasher, match_label, postorder, preorder, preorder_with_ends
+from .pattern import ChangeOperation, Delete, EditScript, Insert, Move, Update, Wildcard, canonical_hash, root_node_type
+from . import pattern_serialization
+from .pattern_distance import TreeEditDistance
+from .pattern_storage import InMemoryDbContext
+
+# node types whose instances CPython shares between all their occurrences in a parsed AST, they are never wildcards
+_SHARED_NODE_TYPES = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
 
 
 class PatternRefiner:
@@ -22,13 +38,31 @@ class PatternRefiner:
         Maximum distance between patterns that can be used for generalisation
     optimiser : IOptimiser
         Optimiser that offers additional functionalities for the refinement process
+    tree_distance : TreeEditDistance
+        Object used for computing distances between patterns, it memoizes already computed distances
+    checkpoint_path : str
+        Path of the file in which the refinement state is periodically saved
+    checkpoint_interval : int
+        Number of generalisations between two checkpoints
+    max_iterations : int
+        Maximum number of generalisations in a single run
+    time_budget : float
+        Maximum duration of a single run in seconds
+    script_prefix : int
+        Number of leading EditScript operations that need to be of the same kinds for two patterns to be compared,
+        None if all pairs are compared
+    max_candidates : int
+        Number of patterns closest in size every pattern is compared with, None if it is compared with all patterns
 
     Methods
     -------
-    public __init__(self, optimiser, min_patterns, max_distance)
+    public __init__(self, context, optimiser, min_patterns, max_distance, checkpoint_path, checkpoint_interval,
+                    max_iterations, time_budget, script_prefix, max_candidates)
         Initialises PatternRefiner object.
-    public void refine(self)
+    public RefinementReport refine(self)
         Method that starts the refinement process.
+    public RefinementReport resume(self)
+        Continues the refinement process from the last saved checkpoint.
     public Pattern, Pattern void find_nearest_patterns(self)
         Finds the most similar patterns in the database.
     public void add_wildcards(self, first_pattern, second_pattern)
@@ -38,18 +72,21 @@ class PatternRefiner:
     public void add_uses(self, first_pattern, second_pattern)
         Compares the EditScripts of two chosen Patterns and changes nodes
         determined by the algorithm in both Patterns to use nodes.
-    public void connect_wildcards_and_uses(self, first_pattern, second_pattern)
+    public bool connect_wildcards_and_uses(self, first_pattern, second_pattern)
         Compares the ASTs of two chosen Patterns and determines which are the
         corresponding wildcard-use and connects them. The pattern inputs are changed
         in place and will be the same after this method, any of them can be used to
         save in the database.
     """
-    def __init__(self, context, optimiser=None, min_pattern=1, max_pattern=float('inf')):
+    def __init__(self, context, optimiser=None, min_patterns=1, max_distance=float('inf'), checkpoint_path=None,
+                 checkpoint_interval=100, max_iterations=None, time_budget=None, script_prefix=None, max_candidates=64):
         """
         Initialises PatternRefiner object.
 
         Parameters
         ----------
+        context : DbContext
+            Database where all the patterns are saved
         optimiser : IOptimiser, optional
             This object is used in the further steps of pattern refinement
             to offer additional options for different pattern refinement approaches.
@@ -67,14 +104,227 @@ class PatternRefiner:
             Default is inf.
             If all pattern similarities are greater than max_distance, the refinement process
             ends.
+        checkpoint_path : str, optional
+            Path of the file in which the refinement state is saved every checkpoint_interval
+            generalisations and when the run ends before the refinement is finished.
+            Default is None, no checkpoints are saved.
+        checkpoint_interval : int, optional
+            Number of generalisations between two checkpoints (default is 100)
+        max_iterations : int, optional
+            Maximum number of generalisations in a single run (default is None, unlimited)
+        time_budget : float, optional
+            Maximum duration of a single run in seconds (default is None, unlimited)
+        script_prefix : int, optional
+            Number of leading EditScript operations that need to be of the same kinds for two patterns to be
+            compared. Pairs that differ in them are rejected before their distance is computed, only the compared
+            operations of lazily generated scripts are produced. Default is None, all pairs are compared.
+        max_candidates : int, optional
+            Number of patterns closest in size every pattern is compared with (default is 64). The difference of
+            the sizes of two patterns is a lower bound of their distance, so the nearest pairs are among these
+            candidates unless there are many patterns of similar sizes. None compares every pair of patterns.
         """
-        pass
+
+        self.context = context
+        self.optimiser = optimiser if optimiser is not None else EditScriptOptimiser()
+        self.min_patterns = min_patterns
+        self.max_distance = max_distance
+        self.tree_distance = TreeEditDistance()
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.script_prefix = script_prefix
+        self.max_candidates = max_candidates
 
     def refine(self):
         """
         Method that starts the refinement process.
+
+        Every pattern is compared with the max_candidates patterns closest to it in size and the
+        distances are kept in a queue, after every generalisation only the distances of the generalised
+        pattern to its candidates are added to it. A pair is merged only if the generalisation made
+        both patterns structurally equal, see canonical_hash, otherwise both patterns are kept. The
+        database is updated when the refinement is finished. If the run stops earlier because of
+        max_iterations or time_budget, the state is saved to checkpoint_path instead and the
+        refinement can be continued with resume(). Without checkpoint_path the partial result
+        is saved to the database.
+
+        Returns
+        -------
+        RefinementReport
+            Report with the number of generalised pattern pairs and the stats of every optimiser in the chain
+        """
+
+        checkpoint = RefinementCheckpoint({pattern.pattern_id: pattern for pattern in self.context.load_patterns()})
+        sizes, order = _size_order(checkpoint.patterns)
+        pairs = set()
+        for size, first_id in order:
+            for second_id in self.__candidates(order, size, first_id):
+                pairs.add((min(first_id, second_id), max(first_id, second_id)))
+        for first_id, second_id in sorted(pairs):
+            self.__push_distance(checkpoint, first_id, second_id)
+        return self.__run(checkpoint, sizes, order)
+
+    def resume(self):
+        """
+        Continues the refinement process from the last saved checkpoint.
+
+        Returns
+        -------
+        RefinementReport
+            Report of the continued run
+
+        Raises
+        ------
+        FileNotFoundError
+            If there is no checkpoint to continue from
+        """
+
+        if self.checkpoint_path is None:
+            raise FileNotFoundError('PatternRefiner has no checkpoint_path to resume from')
+        checkpoint = RefinementCheckpoint.load(self.checkpoint_path)
+        return self.__run(checkpoint, *_size_order(checkpoint.patterns))
+
+    def __run(self, checkpoint, sizes, order):
+        """
+        Generalises the nearest patterns from the queue until the refinement is finished or the budget is spent.
+
+        Parameters
+        ----------
+        checkpoint : RefinementCheckpoint
+            State of the refinement
+        sizes : dict of (int, int)
+            Sizes of the patterns of the checkpoint indexed by their identifiers, kept up to date
+        order : list of (int, int)
+            Sizes and identifiers of the patterns of the checkpoint in increasing order, kept up to date
+
+        Returns
+        -------
+        RefinementReport
+            Report of the run
+        """
+
+        for link in _optimiser_chain(self.optimiser):
+            link.stats.reset()
+        start = time.perf_counter()
+        merges = 0
+        finished = False
+
+        while True:
+            if len(checkpoint.patterns) <= self.min_patterns:
+                finished = True
+                break
+            if self.max_iterations is not None and merges >= self.max_iterations:
+                break
+            if self.time_budget is not None and time.perf_counter() - start >= self.time_budget:
+                break
+            nearest = checkpoint.pop_nearest()
+            if nearest is None:
+                finished = True
+                break
+            distance, first_id, second_id = nearest
+            first_pattern, second_pattern = checkpoint.patterns[first_id], checkpoint.patterns[second_id]
+            self.optimiser.optimise(first_pattern, second_pattern)
+            self.add_wildcards(first_pattern, second_pattern)
+            self.add_uses(first_pattern, second_pattern)
+            if not self.connect_wildcards_and_uses(first_pattern, second_pattern):
+                # the patterns were not generalised into the same one, merging them would lose the second pattern
+                continue
+            checkpoint.merge(first_id, second_id, distance)
+            for pattern_id in (first_id, second_id):
+                del order[bisect.bisect_left(order, (sizes.pop(pattern_id), pattern_id))]
+            size = sizes[first_id] = _pattern_size(first_pattern)
+            bisect.insort(order, (size, first_id))
+            for other_id in sorted(self.__candidates(order, size, first_id)):
+                self.__push_distance(checkpoint, min(first_id, other_id), max(first_id, other_id))
+            merges += 1
+            if self.checkpoint_path is not None and merges % self.checkpoint_interval == 0:
+                checkpoint.save(self.checkpoint_path)
+
+        if finished or self.checkpoint_path is None:
+            self.__commit(checkpoint)
+            if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        else:
+            checkpoint.save(self.checkpoint_path)
+
+        return RefinementReport.from_chain(self.optimiser, merges, time.perf_counter() - start, finished)
+
+    def __candidates(self, order, size, pattern_id):
+        """
+        Returns the identifiers of the max_candidates patterns closest in size to the pattern, without the patterns
+        whose difference in size alone is greater than max_distance.
+
+        Parameters
+        ----------
+        order : list of (int, int)
+            Sizes and identifiers of the patterns in increasing order, the pattern included
+        size : int
+            Size of the pattern
+        pattern_id : int
+            Identifier of the pattern
+
+        Returns
+        -------
+        list of int
+            Identifiers of the candidates, the closest in size first
+        """
+
+        position = bisect.bisect_left(order, (size, pattern_id))
+        limit = self.max_candidates if self.max_candidates is not None else len(order)
+        left, right = position - 1, position + 1
+        candidates = []
+        while len(candidates) < limit and (left >= 0 or right < len(order)):
+            left_gap = size - order[left][0] if left >= 0 else float('inf')
+            right_gap = order[right][0] - size if right < len(order) else float('inf')
+            if min(left_gap, right_gap) > self.max_distance:
+                break
+            if left_gap <= right_gap:
+                candidates.append(order[left][1])
+                left -= 1
+            else:
+                candidates.append(order[right][1])
+                right += 1
+        return candidates
+
+    def __push_distance(self, checkpoint, first_id, second_id):
+        """
+        Computes the distance between two patterns and adds the pair to the queue if they are close enough.
+
+        Parameters
+        ----------
+        checkpoint : RefinementCheckpoint
+            State of the refinement
+        first_id : int
+            Identifier of the first pattern
+        second_id : int
+            Identifier of the second pattern
+        """
+
+        first_pattern, second_pattern = checkpoint.patterns[first_id], checkpoint.patterns[second_id]
+        if self.script_prefix and _scripts_differ(first_pattern, second_pattern, self.script_prefix):
+            return
+        distance = self.tree_distance.pattern_distance(first_pattern, second_pattern, self.max_distance)
+        if distance <= self.max_distance:
+            checkpoint.push(distance, first_id, second_id)
+
+    def __commit(self, checkpoint):
+        """
+        Saves the result of the refinement in the database.
+
+        Parameters
+        ----------
+        checkpoint : RefinementCheckpoint
+            State of the refinement
         """
-        pass
+
+        removed_ids = {second_id for _, second_id, _ in checkpoint.history}
+        changed_ids = {first_id for first_id, _, _ in checkpoint.history} - removed_ids
+        for pattern in self.context.load_patterns():
+            if pattern.pattern_id in removed_ids or pattern.pattern_id in changed_ids:
+                self.context.remove_pattern(pattern)
+        for pattern_id in sorted(changed_ids):
+            self.context.save_pattern(checkpoint.patterns[pattern_id])
 
     def find_nearest_patterns(self):
         """
@@ -83,9 +333,25 @@ class PatternRefiner:
         Returns
         -------
         Pattern, Pattern
-            Tuple of two most similar patterns in the database
+            Tuple of two most similar patterns in the database, None if there are no patterns that
+            are close enough to be generalised
         """
-        pass
+
+        patterns = self.context.load_patterns()
+        nearest = None
+        bound = self.max_distance
+        for i, first_pattern in enumerate(patterns):
+            for second_pattern in patterns[i + 1:]:
+                if self.script_prefix and _scripts_differ(first_pattern, second_pattern, self.script_prefix):
+                    continue
+                distance = self.tree_distance.pattern_distance(first_pattern, second_pattern, bound)
+                if distance <= bound:
+                    nearest = first_pattern, second_pattern
+                    # only strictly closer pairs are of interest from now on
+                    bound = distance - 1
+                    if bound < 0:
+                        return nearest
+        return nearest
 
     def add_wildcards(self, first_pattern, second_pattern):
         """
@@ -93,6 +359,12 @@ class PatternRefiner:
         by the algorithm in both Patterns to wildcard nodes. Takes two Pattern objects
         as input.
 
+        The original ASTs are compared side by side and every pair of corresponding subtrees that differ and that
+        no operation of either EditScript touches is replaced by a wildcard in both Patterns, the indexes of the
+        operations are shifted to the smaller ASTs. The Patterns are changed only if their EditScripts are equal
+        afterwards, otherwise they are not instances of the same change and both are left as they are. Patterns
+        without change operations are never generalised.
+
         Parameters
         ----------
         first_pattern : Pattern
@@ -100,13 +372,22 @@ class PatternRefiner:
         second_pattern : Pattern
             Pattern that is chosen for refinement
         """
-        pass
+
+        generalisation = _generalise(first_pattern, second_pattern)
+        if generalisation is None:
+            return
+        for pattern, (original, changes) in zip((first_pattern, second_pattern), generalisation):
+            pattern.original = original
+            pattern.edit_script = EditScript(changes)
 
     def add_uses(self, first_pattern, second_pattern):
         """
         Compares the EditScripts of two chosen Patterns and changes nodes
         determined by the algorithm in both Patterns to use nodes.
 
+        The uses of a wildcard are the copies of it the EditScript carries over into the modified AST, so the
+        modified AST of a Pattern with wildcards is rebuilt by applying the EditScript to its original AST.
+
         Parameters
         ----------
         first_pattern : Pattern
@@ -114,7 +395,15 @@ class PatternRefiner:
         second_pattern : Pattern
             Pattern that is chosen for refinement
         """
-        pass
+
+        for pattern in (first_pattern, second_pattern):
+            if pattern.original is None or not isinstance(pattern.edit_script, EditScript) or \
+                    not any(isinstance(node, Wildcard) for node in ast.walk(pattern.original)):
+                continue
+            tree = copy.deepcopy(pattern.original)
+            for change in pattern.edit_script.materialize() or ():
+                tree = change.make_change(tree)
+            pattern.modified = tree
 
     def connect_wildcards_and_uses(self, first_pattern, second_pattern):
         """
@@ -123,14 +412,349 @@ class PatternRefiner:
         in place and will be the same after this method, any of them can be used to
         save in the database.
 
+        Wildcards are not named, every use is connected to its wildcard by the operations of the EditScript. The
+        Patterns are the same only if they were generalised into structurally equal ones, see canonical_hash, the
+        second Pattern then shares the ASTs and the EditScript of the first one.
+
         Parameters
         ----------
         first_pattern : Pattern
             Pattern that is chosen for refinement
         second_pattern : Pattern
             Pattern that is chosen for refinement
+
+        Returns
+        -------
+        bool
+            True if the Patterns were generalised into the same one
         """
-        pass
+
+        if canonical_hash(first_pattern) != canonical_hash(second_pattern):
+            return False
+        second_pattern.original = first_pattern.original
+        second_pattern.modified = first_pattern.modified
+        second_pattern.edit_script = first_pattern.edit_script
+        return True
+
+
+class RefinementCheckpoint:
+    """
+    This class holds the state of a refinement run which can be saved to disk and used to
+    continue the run later.
+
+    ...
+
+    Attributes
+    ----------
+    patterns : dict of (int, Pattern)
+        Patterns that are still being refined, indexed by their identifiers
+    versions : dict of (int, int)
+        Number of generalisations every pattern went through, used to detect outdated queue entries
+    queue : list of tuple
+        Heap of pending pattern pairs ordered by their distance
+    history : list of (int, int, int)
+        Identifiers of the kept and the removed pattern and their distance for every generalisation
+
+    Methods
+    -------
+    public __init__(self, patterns)
+        Initialises RefinementCheckpoint object.
+    public void push(self, distance, first_id, second_id)
+        Adds a pair of patterns to the queue.
+    public (int, int, int) pop_nearest(self)
+        Removes and returns the nearest pair of patterns from the queue.
+    public void merge(self, first_id, second_id, distance)
+        Records the generalisation of two patterns into the first one.
+    public void save(self, path)
+        Atomically writes the checkpoint to a file.
+    public RefinementCheckpoint load(cls, path)
+        Reads the checkpoint from a file.
+    """
+
+    def __init__(self, patterns):
+        """
+        Initialises RefinementCheckpoint object.
+
+        Parameters
+        ----------
+        patterns : dict of (int, Pattern)
+            Patterns that are being refined, indexed by their identifiers
+        """
+
+        self.patterns = patterns
+        self.versions = {pattern_id: 0 for pattern_id in patterns}
+        self.queue = []
+        self.history = []
+
+    def push(self, distance, first_id, second_id):
+        """
+        Adds a pair of patterns to the queue.
+
+        Parameters
+        ----------
+        distance : int
+            Distance between the patterns
+        first_id : int
+            Identifier of the first pattern
+        second_id : int
+            Identifier of the second pattern
+        """
+
+        heapq.heappush(self.queue, (distance, first_id, second_id,
+                                    self.versions[first_id], self.versions[second_id]))
+
+    def pop_nearest(self):
+        """
+        Removes and returns the nearest pair of patterns from the queue. Pairs whose patterns were removed
+        or generalised after their distance was computed are discarded.
+
+        Returns
+        -------
+        (int, int, int)
+            Distance and identifiers of the nearest patterns, None if the queue is empty
+        """
+
+        while self.queue:
+            distance, first_id, second_id, first_version, second_version = heapq.heappop(self.queue)
+            if self.versions.get(first_id) == first_version and self.versions.get(second_id) == second_version:
+                return distance, first_id, second_id
+        return None
+
+    def merge(self, first_id, second_id, distance):
+        """
+        Records the generalisation of two patterns into the first one, which takes over the occurrences of the second.
+
+        Parameters
+        ----------
+        first_id : int
+            Identifier of the pattern that is kept
+        second_id : int
+            Identifier of the pattern that is removed
+        distance : int
+            Distance between the patterns
+        """
+
+        self.patterns[first_id].occurrences += self.patterns[second_id].occurrences
+        del self.patterns[second_id]
+        del self.versions[second_id]
+        self.versions[first_id] += 1
+        self.history.append((first_id, second_id, distance))
+
+    def save(self, path):
+        """
+        Atomically writes the checkpoint to a file. The checkpoint is written to a temporary file
+        in the same directory first, which then replaces the previous checkpoint.
+
+        Parameters
+        ----------
+        path : str
+            Path of the checkpoint file
+        """
+
+        # imported lazily, checkpoints are saved only by runs with a checkpoint_path
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(pattern_serialization.dumps(vars(self)))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads the checkpoint from a file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the checkpoint file
+
+        Returns
+        -------
+        RefinementCheckpoint
+            Loaded checkpoint
+        """
+
+        with open(path, 'rb') as file:
+            state = pattern_serialization.loads(file.read())
+        checkpoint = cls.__new__(cls)
+        checkpoint.__dict__.update(state)
+        return checkpoint
+
+
+class ParallelPatternRefiner:
+    """
+    This class runs the pattern refinement process on multiple cores. Since PatternRefiner
+    is sequential by design, the patterns in the database are first partitioned into
+    independent clusters, each cluster is refined by its own PatternRefiner in a separate
+    worker process and the refined clusters are finally merged back into the database.
+    Patterns from different clusters are never generalised together.
+
+    ...
+
+    Attributes
+    ----------
+    context : DbContext
+        Database where all the patterns are saved
+    optimiser : IOptimiser
+        Optimiser used by the PatternRefiner of every cluster, it needs to be picklable
+    min_patterns : int
+        Minimum amount of patterns that need to be left in every cluster after refinement
+    max_distance : int
+        Maximum distance between patterns that can be used for generalisation
+    partition_key : callable
+        Function that maps a Pattern to the key of the cluster it belongs to
+    processes : int
+        Maximum number of worker processes used for refinement
+    script_prefix : int
+        Number of leading EditScript operations that need to be of the same kinds for two patterns to be compared,
+        None if all pairs are compared
+
+    Methods
+    -------
+    public __init__(self, context, optimiser, min_patterns, max_distance, partition_key, processes, script_prefix)
+        Initialises ParallelPatternRefiner object.
+    public RefinementReport refine(self)
+        Partitions the patterns, refines the clusters in parallel and merges the results into the database.
+    public list of list of Pattern partition(self, patterns)
+        Partitions the patterns into independent clusters.
+    """
+
+    def __init__(self, context, optimiser=None, min_patterns=1, max_distance=float('inf'),
+                 partition_key=root_node_type, processes=None, script_prefix=None):
+        """
+        Initialises ParallelPatternRefiner object.
+
+        Parameters
+        ----------
+        context : DbContext
+            Database where all the patterns are saved
+        optimiser : IOptimiser, optional
+            Optimiser used by the PatternRefiner of every cluster (default is None)
+        min_patterns : int, optional
+            Minimum amount of patterns that need to be left in every cluster (default is 1)
+        max_distance : int, optional
+            Maximum distance between patterns that can be used for generalisation (default is inf)
+        partition_key : callable, optional
+            Function that maps a Pattern to the key of the cluster it belongs to. Patterns with
+            equal keys are refined together. Default partitions the patterns by their root node type.
+        processes : int, optional
+            Maximum number of worker processes, default is the number of available cores
+        script_prefix : int, optional
+            Number of leading EditScript operations that need to be of the same kinds for two patterns to be
+            compared (default is None, all pairs are compared)
+        """
+
+        self.context = context
+        self.optimiser = optimiser
+        self.min_patterns = min_patterns
+        self.max_distance = max_distance
+        self.partition_key = partition_key
+        self.processes = processes or os.cpu_count()
+        self.script_prefix = script_prefix
+
+    def refine(self):
+        """
+        Partitions the patterns, refines the clusters in parallel and merges the results into the database.
+
+        Returns
+        -------
+        RefinementReport
+            Reports of all clusters merged into a single report
+        """
+
+        report = RefinementReport()
+        clusters = [cluster for cluster in self.partition(self.context.load_patterns())
+                    if len(cluster) > self.min_patterns]
+        if not clusters:
+            return report
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(clusters))) as executor:
+            results = executor.map(_refine_cluster, [pattern_serialization.dumps(cluster) for cluster in clusters],
+                                   [self.optimiser] * len(clusters),
+                                   [self.min_patterns] * len(clusters), [self.max_distance] * len(clusters),
+                                   [self.script_prefix] * len(clusters))
+            for cluster, (refined, cluster_report) in zip(clusters, results):
+                self.__merge(cluster, pattern_serialization.loads(refined))
+                report.merge(cluster_report)
+        return report
+
+    def partition(self, patterns):
+        """
+        Partitions the patterns into independent clusters.
+
+        Parameters
+        ----------
+        patterns : list of Pattern
+            Patterns that are partitioned
+
+        Returns
+        -------
+        list of list of Pattern
+            Clusters of patterns, in the order in which their first pattern appears
+        """
+
+        clusters = defaultdict(list)
+        for pattern in patterns:
+            clusters[self.partition_key(pattern)].append(pattern)
+        return list(clusters.values())
+
+    def __merge(self, cluster, refined):
+        """
+        Replaces the patterns of the cluster in the database with the refined ones.
+
+        Parameters
+        ----------
+        cluster : list of Pattern
+            Patterns of the cluster as they were loaded from the database
+        refined : list of Pattern
+            Patterns of the cluster after refinement, they keep the identifiers of the patterns they
+            were generalised from
+        """
+
+        for pattern in cluster:
+            self.context.remove_pattern(pattern)
+        for pattern in refined:
+            self.context.save_pattern(pattern)
+
+
+def _refine_cluster(patterns, optimiser, min_patterns, max_distance, script_prefix=None):
+    """
+    Refines a single cluster of patterns, executed in a worker process. Patterns are exchanged with the worker in the
+    format of pattern_serialization.
+
+    Parameters
+    ----------
+    patterns : bytes
+        Serialized patterns of the cluster
+    optimiser : IOptimiser
+        Optimiser used for refinement
+    min_patterns : int
+        Minimum amount of patterns that need to be left in the cluster
+    max_distance : int
+        Maximum distance between patterns that can be used for generalisation
+    script_prefix : int, optional
+        Number of leading EditScript operations that need to be of the same kinds for two patterns to be compared
+        (default is None, all pairs are compared)
+
+    Returns
+    -------
+    bytes, RefinementReport
+        Serialized refined patterns of the cluster and the report of its refinement
+    """
+
+    context = InMemoryDbContext(pattern_serialization.loads(patterns))
+    report = PatternRefiner(context, optimiser, min_patterns, max_distance, script_prefix=script_prefix).refine()
+    return pattern_serialization.dumps(context.load_patterns()), report
 
 
 class IOptimiser(ABC):
@@ -201,7 +825,17 @@ class EditScriptOptimiser(IOptimiser):
 class EditScriptOptimiserDecorator(IOptimiser):
     """
     This is a decorator class that is used to chain different change
-    script optimisers that implement IOptimiser interface.
+    script optimisers that implement IOptimiser interface. Every link of
+    the chain measures how long its own optimisation takes and records
+    whether it changed the EditScripts. When it makes no change to
+    EditScripts that the rest of the chain has already left unchanged
+    before, it skips the rest of the chain. EditScripts are compared by
+    the identities of the scripts and their operations, so optimisers
+    replace operations instead of changing them in place.
+
+    Subclasses implement optimise_scripts. Optimisers that override
+    optimise itself keep working, they call the rest of the chain on their
+    own and are neither timed nor profiled.
 
     ...
 
@@ -209,6 +843,8 @@ class EditScriptOptimiserDecorator(IOptimiser):
     ----------
     base_optimiser : IOptimiser
         Optimiser that is chained to this optimiser
+    stats : OptimiserStats
+        Timings and counters of this optimiser
 
     Methods
     -------
@@ -217,8 +853,12 @@ class EditScriptOptimiserDecorator(IOptimiser):
     public void optimise(self, first_pattern, second_pattern)
         This method takes two Patterns and optimises their ChangeScripts in place.
         After its optimisation, calls the optimise method of the next optimiser in chain.
+    public void optimise_scripts(self, first_pattern, second_pattern)
+        Optimises the ChangeScripts of two Patterns in place without calling the rest of the chain.
     """
 
+    max_stable_fingerprints = 4096
+
     def __init__(self, base_optimiser):
         """
         Initialises BaseOptimiser object.
@@ -228,14 +868,46 @@ class EditScriptOptimiserDecorator(IOptimiser):
         base_optimiser : IOptimiser
             Optimiser that is chained to this optimiser
         """
-        pass
 
-    @abstractmethod
+        self.base_optimiser = base_optimiser
+        self.stats = OptimiserStats(type(self).__name__)
+        self.__stable = {}
+
     def optimise(self, first_pattern, second_pattern):
         """
         This method takes two Patterns and optimises their ChangeScripts in place.
         After its optimisation, calls the optimise method of the next optimiser in chain.
 
+        Parameters
+        ----------
+        first_pattern : Pattern
+            Pattern that is chosen for refinement
+        second_pattern : Pattern
+            Pattern that is chosen for refinement
+        """
+
+        # the scripts before the call are kept alive, so the changed scripts can not reuse their identities
+        before, previous_scripts = _scripts_identity(first_pattern, second_pattern)
+        start = time.perf_counter()
+        self.optimise_scripts(first_pattern, second_pattern)
+        elapsed = time.perf_counter() - start
+        after, scripts = _scripts_identity(first_pattern, second_pattern)
+        self.stats.record(elapsed, after != before)
+
+        if after == before and after in self.__stable:
+            self.stats.skips += 1
+            return
+        self.base_optimiser.optimise(first_pattern, second_pattern)
+        if _scripts_identity(first_pattern, second_pattern)[0] == after:
+            if len(self.__stable) >= self.max_stable_fingerprints:
+                self.__stable.clear()
+            # the scripts are kept alive, so their identities are not reused by other scripts
+            self.__stable[after] = scripts
+
+    def optimise_scripts(self, first_pattern, second_pattern):
+        """
+        Optimises the ChangeScripts of two Patterns in place without calling the rest of the chain.
+
         Parameters
         ----------
         first_pattern : Pattern
@@ -256,26 +928,26 @@ class ChangeIsolator(EditScriptOptimiserDecorator):
     ----------
     base_optimiser : IOptimiser
         Optimiser that is chained to this optimiser
+    stats : OptimiserStats
+        Timings and counters of this optimiser
 
     Methods
     -------
-    private void __isolate(self)
+    private void __isolate(self, pattern)
         This method is used for isolating important changes in ChangeScript objects.
-    public void optimise(self, first_pattern, second_pattern)
+    public void optimise_scripts(self, first_pattern, second_pattern)
         This method takes two Patterns and optimises their ChangeScripts in place.
         This concrete implementation aims to isolate the relevant changes in edit
         scripts of patterns so that they wouldn’t be replaced by wildcards in the
         next steps.
-        After its optimisation, calls the optimise() method of the next optimiser in chain.
     """
 
-    def optimise(self, first_pattern, second_pattern):
+    def optimise_scripts(self, first_pattern, second_pattern):
         """
         This method takes two Patterns and optimises their ChangeScripts in place.
         This concrete implementation aims to isolate the relevant changes in edit
         scripts of patterns so that they wouldn’t be replaced by wildcards in the
         next steps.
-        After its optimisation, calls the optimise() method of the next optimiser in chain.
 
         Parameters
         ----------
@@ -284,13 +956,33 @@ class ChangeIsolator(EditScriptOptimiserDecorator):
             second_pattern : Pattern
             Pattern that is chosen for refinement
         """
-        pass
 
-    def __isolate(self):
+        self.__isolate(first_pattern)
+        self.__isolate(second_pattern)
+
+    def __isolate(self, pattern):
         """
-        This method is used for isolating important changes in ChangeScript objects.
+        This method is used for isolating important changes in ChangeScript objects. The operations are applied to
+        a copy of the original AST one by one and the ones that leave it unchanged are removed, so only the relevant
+        changes are left. The removed operations change nothing, so the indexes of the following ones stay valid.
         """
-        pass
+
+        if not isinstance(pattern.edit_script, EditScript) or pattern.original is None:
+            return
+        changes = pattern.edit_script.materialize()
+        if not changes:
+            return
+        tree = copy.deepcopy(pattern.original)
+        dump = ast.dump(tree)
+        isolated = []
+        for change in changes:
+            tree = change.make_change(tree)
+            changed_dump = ast.dump(tree)
+            if changed_dump != dump:
+                isolated.append(change)
+            dump = changed_dump
+        if len(isolated) < len(changes):
+            pattern.edit_script.changes = isolated
 
 
 class MatchInserter(EditScriptOptimiserDecorator):
@@ -303,24 +995,24 @@ class MatchInserter(EditScriptOptimiserDecorator):
     ----------
     base_optimiser : IOptimiser
         Optimiser that is chained to this optimiser
+    stats : OptimiserStats
+        Timings and counters of this optimiser
 
     Methods
     -------
-    private void __insert(self)
+    private void __insert(self, first_pattern, second_pattern)
         This method is used for inserting matches into the ChangeScript objects
-    public void optimise(self, first_pattern, second_pattern)
+    public void optimise_scripts(self, first_pattern, second_pattern)
         This method takes two Patterns and optimises their ChangeScript objects in place.
         This concrete implementation aims to recognise and locate matches between pattern
         change scripts so that generalisation of them would be maximised.
-        After its optimisation, call the optimize method of the next optimiser in chain.
     """
 
-    def optimise(self, first_pattern, second_pattern):
+    def optimise_scripts(self, first_pattern, second_pattern):
         """
         This method takes two Patterns and optimises their ChangeScript objects in place.
         This concrete implementation aims to recognise and locate matches between pattern
         change scripts so that generalisation of them would be maximised.
-        After its optimisation, call the optimize method of the next optimiser in chain.
 
         Parameters
         ----------
@@ -329,10 +1021,628 @@ class MatchInserter(EditScriptOptimiserDecorator):
             second_pattern : Pattern
             Pattern that is chosen for refinement
         """
-        pass
 
-    def __insert(self):
+        self.__insert(first_pattern, second_pattern)
+
+    def __insert(self, first_pattern, second_pattern):
         """
-        This method is used for inserting matches into the ChangeScript objects.
+        This method is used for inserting matches into the ChangeScript objects. Operations of the second script
+        that are equal to operations of the first one are matched to them and reordered into the order of their
+        matches, the other operations keep their places. The reordered script is kept only if it still transforms
+        the original AST of the second pattern into its modified AST.
         """
-        pass
+
+        if not isinstance(first_pattern.edit_script, EditScript) or \
+                not isinstance(second_pattern.edit_script, EditScript) or second_pattern.original is None:
+            return
+        first_changes = first_pattern.edit_script.materialize() or []
+        second_changes = second_pattern.edit_script.materialize() or []
+        positions = {}
+        for position, change in enumerate(first_changes):
+            positions.setdefault(_fingerprint(change), deque()).append(position)
+        matches = [positions[key].popleft() if positions.get(key) else None
+                   for key in map(_fingerprint, second_changes)]
+        matched = [index for index, match in enumerate(matches) if match is not None]
+        reordered = list(second_changes)
+        for slot, index in zip(matched, sorted(matched, key=matches.__getitem__)):
+            reordered[slot] = second_changes[index]
+        if any(change is not original for change, original in zip(reordered, second_changes)) and \
+                _transforms(second_pattern, reordered):
+            second_pattern.edit_script.changes = reordered
+
+
+class OptimiserStats:
+    """
+    This class holds the timings and counters of a single optimiser in the optimiser chain.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Name of the optimiser
+    calls : int
+        Number of times the optimiser was called
+    changes : int
+        Number of calls in which the optimiser changed the EditScripts
+    skips : int
+        Number of calls after which the rest of the chain was skipped because nothing changed
+    total_time : float
+        Total time in seconds spent in the optimiser itself, without the rest of the chain
+
+    Methods
+    -------
+    public __init__(self, name)
+        Initialises OptimiserStats object.
+    public void record(self, elapsed, changed)
+        Records a single call of the optimiser.
+    public void reset(self)
+        Resets all counters.
+    public OptimiserStats copy(self)
+        Returns a copy of the stats.
+    public dict as_dict(self)
+        Returns the stats as a dictionary.
+    """
+
+    def __init__(self, name):
+        """
+        Initialises OptimiserStats object.
+
+        Parameters
+        ----------
+        name : str
+            Name of the optimiser
+        """
+
+        self.name = name
+        self.reset()
+
+    def record(self, elapsed, changed=None):
+        """
+        Records a single call of the optimiser.
+
+        Parameters
+        ----------
+        elapsed : float
+            Time in seconds spent in the call
+        changed : bool, optional
+            True if the call changed the EditScripts (default is None, it is not known)
+        """
+
+        self.calls += 1
+        self.changes += int(bool(changed))
+        self.total_time += elapsed
+
+    def reset(self):
+        """
+        Resets all counters.
+        """
+
+        self.calls = 0
+        self.changes = 0
+        self.skips = 0
+        self.total_time = 0.0
+
+    def copy(self):
+        """
+        Returns a copy of the stats.
+
+        Returns
+        -------
+        OptimiserStats
+            Copy of the stats
+        """
+
+        stats = OptimiserStats(self.name)
+        stats.calls, stats.changes, stats.skips, stats.total_time = \
+            self.calls, self.changes, self.skips, self.total_time
+        return stats
+
+    def as_dict(self):
+        """
+        Returns the stats as a dictionary.
+
+        Returns
+        -------
+        dict
+            Stats as a dictionary
+        """
+
+        return {'name': self.name, 'calls': self.calls, 'changes': self.changes, 'skips': self.skips,
+                'total_time': self.total_time}
+
+
+class RefinementReport:
+    """
+    This class is a structured report of a single refinement run.
+
+    ...
+
+    Attributes
+    ----------
+    merges : int
+        Number of pattern pairs that were generalised
+    total_time : float
+        Duration of the refinement in seconds
+    optimisers : list of OptimiserStats
+        Stats of every optimiser in the chain, in chain order
+    finished : bool
+        False if the run stopped because its iteration or time budget was spent
+
+    Methods
+    -------
+    public __init__(self, merges, total_time, optimisers, finished)
+        Initialises RefinementReport object.
+    public RefinementReport from_chain(cls, optimiser, merges, total_time, finished)
+        Creates the report from the stats collected by the optimiser chain.
+    public void merge(self, other)
+        Adds the counters of another report of the same optimiser chain to this report.
+    public dict as_dict(self)
+        Returns the report as a dictionary.
+    """
+
+    def __init__(self, merges=0, total_time=0.0, optimisers=None, finished=True):
+        """
+        Initialises RefinementReport object.
+
+        Parameters
+        ----------
+        merges : int, optional
+            Number of pattern pairs that were generalised (default is 0)
+        total_time : float, optional
+            Duration of the refinement in seconds (default is 0.0)
+        optimisers : list of OptimiserStats, optional
+            Stats of every optimiser in the chain (default is None)
+        finished : bool, optional
+            False if the run stopped because its iteration or time budget was spent (default is True)
+        """
+
+        self.merges = merges
+        self.total_time = total_time
+        self.optimisers = optimisers if optimisers is not None else []
+        self.finished = finished
+
+    @classmethod
+    def from_chain(cls, optimiser, merges=0, total_time=0.0, finished=True):
+        """
+        Creates the report from the stats collected by the optimiser chain.
+
+        Parameters
+        ----------
+        optimiser : IOptimiser
+            First optimiser in the chain
+        merges : int, optional
+            Number of pattern pairs that were generalised (default is 0)
+        total_time : float, optional
+            Duration of the refinement in seconds (default is 0.0)
+        finished : bool, optional
+            False if the run stopped because its iteration or time budget was spent (default is True)
+
+        Returns
+        -------
+        RefinementReport
+            Report of the refinement
+        """
+
+        return cls(merges, total_time, [link.stats.copy() for link in _optimiser_chain(optimiser)], finished)
+
+    def merge(self, other):
+        """
+        Adds the counters of another report of the same optimiser chain to this report. Total time is kept as
+        the longest of both, since merged reports come from refinements that run in parallel.
+
+        Parameters
+        ----------
+        other : RefinementReport
+            Report that is merged into this report
+        """
+
+        self.merges += other.merges
+        self.total_time = max(self.total_time, other.total_time)
+        self.finished = self.finished and other.finished
+        if not self.optimisers:
+            self.optimisers = [stats.copy() for stats in other.optimisers]
+            return
+        for stats, other_stats in zip(self.optimisers, other.optimisers):
+            stats.calls += other_stats.calls
+            stats.changes += other_stats.changes
+            stats.skips += other_stats.skips
+            stats.total_time += other_stats.total_time
+
+    def as_dict(self):
+        """
+        Returns the report as a dictionary.
+
+        Returns
+        -------
+        dict
+            Report as a dictionary
+        """
+
+        return {'merges': self.merges, 'total_time': self.total_time, 'finished': self.finished,
+                'optimisers': [stats.as_dict() for stats in self.optimisers]}
+
+
+def _size_order(patterns):
+    """
+    Returns the sizes of the patterns, as the number of nodes of their original and modified ASTs, and the patterns
+    ordered by their sizes.
+
+    Parameters
+    ----------
+    patterns : dict of (int, Pattern)
+        Patterns indexed by their identifiers
+
+    Returns
+    -------
+    dict of (int, int), list of (int, int)
+        Sizes of the patterns indexed by their identifiers, and sizes and identifiers in increasing order
+    """
+
+    sizes = {pattern_id: _pattern_size(pattern) for pattern_id, pattern in patterns.items()}
+    return sizes, sorted((size, pattern_id) for pattern_id, size in sizes.items())
+
+
+def _pattern_size(pattern):
+    """
+    Returns the number of nodes of the original and modified ASTs of the pattern. The difference of the sizes of two
+    patterns is a lower bound of their distance computed by TreeEditDistance.pattern_distance.
+    """
+
+    return sum(1 for tree in (pattern.original, pattern.modified) if tree is not None for _ in ast.walk(tree))
+
+
+def _optimiser_chain(optimiser):
+    """
+    Yields all profiled optimisers in the chain, starting with the received one.
+
+    Parameters
+    ----------
+    optimiser : IOptimiser
+        First optimiser in the chain
+
+    Yields
+    ------
+    EditScriptOptimiserDecorator
+        Optimisers in the chain that collect stats
+    """
+
+    # optimisers that override __init__ without calling it of the decorator have no stats
+    while isinstance(optimiser, EditScriptOptimiserDecorator) and hasattr(optimiser, 'stats'):
+        yield optimiser
+        optimiser = optimiser.base_optimiser
+
+
+def _fingerprint(value):
+    """
+    Returns a hashable representation of an EditScript component.
+
+    Parameters
+    ----------
+    value : object
+        ChangeOperation, AST or a value stored in them
+
+    Returns
+    -------
+    object
+        Hashable representation of the value
+    """
+
+    if isinstance(value, ast.AST):
+        return ast.dump(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(item) for item in value)
+    if isinstance(value, ChangeOperation):
+        return (type(value).__name__,) + tuple((name, _fingerprint(item))
+                                               for name, item in sorted(vars(value).items()))
+    return value
+
+
+def _scripts_differ(first_pattern, second_pattern, length):
+    """
+    Checks if the leading operations of the EditScripts of both patterns differ in their kinds. Operations are taken
+    one by one, so lazily generated scripts produce only the operations up to the first difference.
+
+    Parameters
+    ----------
+    first_pattern : Pattern
+        First compared pattern
+    second_pattern : Pattern
+        Second compared pattern
+    length : int
+        Number of compared leading operations
+
+    Returns
+    -------
+    bool
+        True if the kinds of the operations differ or only one of the scripts ends among them
+    """
+
+    for index in range(length):
+        first, second = _operation(first_pattern, index), _operation(second_pattern, index)
+        if type(first) is not type(second):
+            return True
+        if first is None:
+            return False
+    return False
+
+
+def _operation(pattern, index):
+    """
+    Returns the operation of the pattern EditScript at the index, None if the script is shorter.
+    """
+
+    if pattern.edit_script is None:
+        return None
+    try:
+        return pattern.edit_script.get(index)
+    except IndexError:
+        return None
+
+
+def _scripts_identity(first_pattern, second_pattern):
+    """
+    Returns the identity of the EditScripts of both patterns, used for detecting whether an optimiser changed them.
+    It consists of the id() of the scripts and their operations, so it is computed without dumping any AST.
+
+    Parameters
+    ----------
+    first_pattern : Pattern
+        Pattern that is chosen for refinement
+    second_pattern : Pattern
+        Pattern that is chosen for refinement
+
+    Returns
+    -------
+    tuple, tuple
+        Identity of both EditScripts and the scripts and operations it refers to, equal identities describe the same
+        scripts as long as these are kept alive
+    """
+
+    scripts = tuple((pattern.edit_script, tuple(pattern.edit_script.materialize() or ()))
+                    if isinstance(pattern.edit_script, EditScript) else (None, ())
+                    for pattern in (first_pattern, second_pattern))
+    return tuple((id(script), tuple(map(id, changes))) for script, changes in scripts), scripts
+
+
+def _transforms(pattern, changes):
+    """
+    Checks if the change operations transform a copy of the original AST of the pattern into its modified AST.
+
+    Parameters
+    ----------
+    pattern : Pattern
+        Pattern whose ASTs are compared
+    changes : list of ChangeOperation
+        Change operations that are applied to the original AST
+
+    Returns
+    -------
+    bool
+        True if the changed original AST is structurally equal to the modified AST
+    """
+
+    tree = copy.deepcopy(pattern.original)
+    try:
+        for change in changes:
+            tree = change.make_change(tree)
+    except (IndexError, AttributeError, TypeError, ValueError):
+        return False
+    return ast.dump(tree) == ast.dump(pattern.modified)
+
+
+def _generalise(first_pattern, second_pattern):
+    """
+    Returns the original ASTs and the change operations of both patterns with the corresponding subtrees that differ
+    and that no operation touches replaced by wildcards.
+
+    Parameters
+    ----------
+    first_pattern : Pattern
+        First generalised pattern
+    second_pattern : Pattern
+        Second generalised pattern
+
+    Returns
+    -------
+    list of (ast, list of ChangeOperation)
+        Generalised original AST and change operations of both patterns, None if there is nothing to generalise or
+        the patterns can not be generalised into the same one
+    """
+
+    patterns = (first_pattern, second_pattern)
+    if any(pattern.original is None or not isinstance(pattern.edit_script, EditScript) for pattern in patterns):
+        return None
+    changes = [pattern.edit_script.materialize() or [] for pattern in patterns]
+    touched = [_touched_nodes(pattern.original, pattern_changes)
+               for pattern, pattern_changes in zip(patterns, changes)]
+    if not all(touched):
+        return None
+    pairs = _differing_subtrees(first_pattern.original, second_pattern.original, *touched)
+    if not pairs:
+        return None
+    generalisation = []
+    for pattern, pattern_changes, roots in zip(patterns, changes, zip(*pairs)):
+        roots = {id(root) for root in roots}
+        generalisation.append((_with_wildcards(pattern.original, roots),
+                               _shifted_changes(pattern.original, pattern_changes, roots)))
+    if any(shifted is None for _, shifted in generalisation) or \
+            _fingerprint(generalisation[0][1]) != _fingerprint(generalisation[1][1]):
+        return None
+    return generalisation
+
+
+def _indexed_operations(change):
+    """
+    Returns the insert and delete operations the change operation consists of, together with a flag that tells whether
+    the operation touches the whole subtree of its node or the node alone. An insert into a field of a node touches
+    only the node, the other positions in the field keep their nodes.
+    """
+
+    if isinstance(change, Update):
+        return [(change.insert_operation, False), (change.delete_operation, False)]
+    if isinstance(change, Move):
+        return [(change.insert_operation, change.insert_operation.field is None), (change.delete_operation, True)]
+    if isinstance(change, Insert):
+        return [(change, change.field is None)]
+    if isinstance(change, Delete):
+        return [(change, True)]
+    return None
+
+
+def _touched_nodes(original, changes):
+    """
+    Returns the nodes of the original AST that the change operations touch. The operations are applied to a copy of
+    the AST one by one, since each of them addresses the AST as it is after the preceding ones.
+
+    Parameters
+    ----------
+    original : ast
+        Original AST of the pattern
+    changes : list of ChangeOperation
+        Change operations of the pattern
+
+    Returns
+    -------
+    set of int
+        id() of the touched nodes of the original AST, None if the operations can not be applied to it
+    """
+
+    memo = {}
+    tree = copy.deepcopy(original, memo)
+    origins = {id(node): key for key, node in memo.items() if isinstance(node, ast.AST)}
+    touched = set()
+    try:
+        for change in changes:
+            operations = _indexed_operations(change)
+            if operations is None:
+                return None
+            nodes = preorder(tree)
+            for operation, subtree in operations:
+                node = nodes[operation.index]
+                touched.update(origins.get(id(item)) for item in (ast.walk(node) if subtree else (node,))
+                               if not isinstance(item, _SHARED_NODE_TYPES))
+            tree = change.make_change(tree)
+    except (IndexError, AttributeError, TypeError, ValueError):
+        return None
+    touched.discard(None)
+    return touched
+
+
+def _differing_subtrees(first, second, first_touched, second_touched):
+    """
+    Returns the pairs of corresponding subtrees of two ASTs that differ and contain no touched nodes. The roots are
+    never paired, corresponding nodes above touched nodes need to have equal labels and children.
+
+    Parameters
+    ----------
+    first : ast
+        First AST
+    second : ast
+        Second AST
+    first_touched : set of int
+        id() of the touched nodes of the first AST
+    second_touched : set of int
+        id() of the touched nodes of the second AST
+
+    Returns
+    -------
+    list of (ast, ast)
+        Roots of the differing subtrees of both ASTs in preorder, None if nodes above touched nodes differ
+    """
+
+    hasher = SubtreeHasher()
+    hashes = hasher.hash_tree(first), hasher.hash_tree(second)
+    tainted = []
+    for tree, touched in ((first, first_touched), (second, second_touched)):
+        ids = set()
+        for node in postorder(tree):
+            if id(node) in touched or any(id(child) in ids for child in ast.iter_child_nodes(node)):
+                ids.add(id(node))
+        tainted.append(ids)
+
+    pairs = []
+    stack = [(first, second)]
+    while stack:
+        first_node, second_node = stack.pop()
+        if hashes[0][id(first_node)] == hashes[1][id(second_node)]:
+            continue
+        if (first_node is not first and id(first_node) not in tainted[0] and id(second_node) not in tainted[1] and
+                not isinstance(first_node, _SHARED_NODE_TYPES) and not isinstance(second_node, _SHARED_NODE_TYPES)):
+            pairs.append((first_node, second_node))
+            continue
+        if match_label(first_node) != match_label(second_node) or \
+                [isinstance(getattr(first_node, field, None), ast.AST) for field in first_node._fields] != \
+                [isinstance(getattr(second_node, field, None), ast.AST) for field in second_node._fields]:
+            return None
+        stack.extend(reversed(list(zip(ast.iter_child_nodes(first_node), ast.iter_child_nodes(second_node)))))
+    return pairs
+
+
+def _with_wildcards(original, roots):
+    """
+    Returns a copy of the AST with the subtrees of the received roots replaced by wildcards.
+
+    Parameters
+    ----------
+    original : ast
+        Copied AST
+    roots : set of int
+        id() of the roots of the replaced subtrees in the AST
+
+    Returns
+    -------
+    ast
+        Copy of the AST with wildcards
+    """
+
+    memo = {}
+    tree = copy.deepcopy(original, memo)
+    replaced = {id(memo[root]) for root in roots}
+    for node in preorder(tree):
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST) and id(value) in replaced:
+                setattr(node, field, Wildcard())
+            elif isinstance(value, list):
+                value[:] = [Wildcard() if id(item) in replaced else item for item in value]
+    return tree
+
+
+def _shifted_changes(original, changes, roots):
+    """
+    Returns copies of the change operations with their indexes shifted to the AST in which the subtrees of the received
+    roots are replaced by wildcards. An index is lowered by the number of nodes below the roots that precede it in the
+    AST the operation is applied to.
+
+    Parameters
+    ----------
+    original : ast
+        Original AST of the pattern
+    changes : list of ChangeOperation
+        Change operations of the pattern
+    roots : set of int
+        id() of the roots of the subtrees that are replaced by wildcards in the original AST
+
+    Returns
+    -------
+    list of ChangeOperation
+        Shifted copies of the change operations, None if the operations can not be applied to the AST
+    """
+
+    memo = {}
+    tree = copy.deepcopy(original, memo)
+    replaced = {id(memo[root]) for root in roots}
+    shifted = []
+    try:
+        for change in changes:
+            nodes, ends = preorder_with_ends(tree)
+            subtrees = [(start, ends[start]) for start, node in enumerate(nodes) if id(node) in replaced]
+            change_copy = copy.deepcopy(change)
+            for operation, _ in _indexed_operations(change_copy):
+                operation.index -= sum(max(0, min(end, operation.index) - start - 1) for start, end in subtrees)
+            shifted.append(change_copy)
+            tree = change.make_change(tree)
+    except (IndexError, AttributeError, TypeError, ValueError):
+        return None
+    return shifted
+
@@ -0,0 +1,242 @@
+import ast
+import gc
+import marshal
+from array import array
+
+from .pattern import Delete, EditScript, Insert, Move, Pattern, Update, Wildcard
+
+FORMAT_VERSION = 3
+
+# Codes of the values that are not nodes or registered objects, which are encoded by the non-negative codes of their
+# type table entries. None and other constants are encoded by negative codes starting at _FIRST_CONSTANT.
+_LIST = -1
+_TUPLE = -2
+_DICT = -3
+_FIRST_CONSTANT = -4
+
+# kinds of the type table entries
+_NODE = 0
+_SHARED_NODE = 1
+_OBJECT = 2
+
+_CONSTANT_TYPES = (str, bytes, int, float, complex, bool, type(Ellipsis), type(None))
+# CPython shares a single instance of these nodes between all ASTs, decoded ASTs do the same
+_SHARED_NODE_TYPES = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
+
+_registry = {}
+
+
+def register(cls):
+    """
+    Registers the class whose objects can be serialized. Objects are serialized by their state, as returned by
+    __getstate__, and decoded without calling the constructor, so only classes whose objects are fully described by
+    their state should be registered. Besides the registered classes, loads only instantiates AST node classes and
+    never runs any other code of the decoded data.
+
+    Parameters
+    ----------
+    cls : type
+        Registered class
+
+    Returns
+    -------
+    type
+        The registered class, so the function can be used as a class decorator
+    """
+
+    _registry[cls.__module__ + '.' + cls.__qualname__] = cls
+    return cls
+
+
+def dumps(value):
+    """
+    Serializes the value into bytes. The value is encoded as a preorder array of codes: ASTs and registered objects
+    by the codes of their entries in a type table, which hold the class and the names of the attributes, all strings
+    and other constants by their positions in a constant table, and the line and column numbers of the nodes in a
+    separate array. All attributes of the AST nodes are kept, so the original identifiers and literals of normalized
+    ASTs are restored after decoding. Lazily produced operations of EditScripts are produced and serialized like the
+    rest of the script. The value is walked with an explicit stack, so deeply nested ASTs are not limited by the
+    recursion limit.
+
+    Parameters
+    ----------
+    value : object
+        AST, Pattern, EditScript, registered object, constant, None or a list, tuple or dict of such values
+
+    Returns
+    -------
+    bytes
+        Serialized value
+
+    Raises
+    ------
+    TypeError
+        If the value contains an object that cannot be serialized
+    """
+
+    types, type_codes = [], {}
+    constants, constant_codes = [], {}
+    codes, positions = array('i'), array('i')
+    emit = codes.append
+    stack = [value]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        item = pop()
+        if isinstance(item, _CONSTANT_TYPES):
+            key = (type(item), repr(item) if isinstance(item, (float, complex)) else item)
+            code = constant_codes.get(key)
+            if code is None:
+                code = constant_codes[key] = len(constants)
+                constants.append(item)
+            emit(_FIRST_CONSTANT - code)
+        elif isinstance(item, ast.AST):
+            cls = type(item)
+            state = item.__dict__
+            position_names = tuple(name for name in cls._attributes if type(state.get(name)) is int)
+            names = tuple(name for name in state if name not in position_names)
+            emit(_type_code(types, type_codes, (_NODE, cls.__name__, names, position_names)))
+            positions.extend([state[name] for name in position_names])
+            extend([state[name] for name in reversed(names)])
+        elif isinstance(item, (list, tuple, dict)):
+            # the length follows the code when the array is read backwards
+            emit(len(item))
+            if isinstance(item, dict):
+                emit(_DICT)
+                extend([part for pair in reversed(item.items()) for part in reversed(pair)])
+            else:
+                emit(_LIST if isinstance(item, list) else _TUPLE)
+                extend(reversed(item))
+        else:
+            cls = type(item)
+            name = cls.__module__ + '.' + cls.__qualname__
+            if _registry.get(name) is not cls:
+                raise TypeError('Object of type {} cannot be serialized'.format(name))
+            state = item.__getstate__() or {}
+            emit(_type_code(types, type_codes, (_OBJECT, name, tuple(state))))
+            extend(reversed(list(state.values())))
+    return marshal.dumps((FORMAT_VERSION, types, constants, codes.tobytes(), positions.tobytes()))
+
+
+def loads(data):
+    """
+    Deserializes the value from bytes created by dumps. The array of codes is read backwards, so the attributes of
+    every node are decoded before the node itself and a single stack of decoded values is enough. Decoding creates
+    many objects at once, the cyclic garbage collector is paused meanwhile, since none of them is garbage.
+
+    Parameters
+    ----------
+    data : bytes
+        Serialized value
+
+    Returns
+    -------
+    object
+        Deserialized value
+
+    Raises
+    ------
+    ValueError
+        If the data was created by an incompatible format version or refers to a class that is neither registered
+        nor an AST node class
+    """
+
+    try:
+        version, types, constants, raw_codes, raw_positions = marshal.loads(data)
+    except (EOFError, TypeError, ValueError) as error:
+        raise ValueError('Data is not serialized in a supported format') from error
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported serialization format version {}'.format(version))
+    plans = [_plan(entry) for entry in types]
+    codes, positions = array('i'), array('i')
+    codes.frombytes(raw_codes)
+    positions.frombytes(raw_positions)
+    positions = positions.tolist()
+    position = len(positions)
+
+    stack = []
+    push = stack.append
+    # lengths of lists, tuples and dicts are read from the same iterator inside the loop
+    code_iterator = reversed(codes)
+    read = code_iterator.__next__
+    first_constant, node_kind, shared_node = _FIRST_CONSTANT, _NODE, _SHARED_NODE
+    new_node = ast.AST.__new__
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for code in code_iterator:
+            if code >= 0:
+                kind, cls, names, count, position_count = plans[code]
+                if kind == shared_node:
+                    push(cls)
+                    continue
+                node = new_node(cls) if kind == node_kind else cls.__new__(cls)
+                if count:
+                    values = stack[-count:]
+                    del stack[-count:]
+                else:
+                    values = []
+                if position_count:
+                    next_position = position - position_count
+                    values += positions[next_position:position]
+                    position = next_position
+                node.__dict__.update(zip(names, values))
+                push(node)
+            elif code <= first_constant:
+                push(constants[first_constant - code])
+            else:
+                count = read()
+                if code == _DICT:
+                    count *= 2
+                items = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                items.reverse()
+                push(items if code == _LIST else tuple(items) if code == _TUPLE else
+                     dict(zip(items[::2], items[1::2])))
+    except (IndexError, StopIteration) as error:
+        raise ValueError('Data is not serialized in a supported format') from error
+    finally:
+        if enabled:
+            gc.enable()
+    if len(stack) != 1:
+        raise ValueError('Data is not serialized in a supported format')
+    return stack[0]
+
+
+def _type_code(types, type_codes, entry):
+    """
+    Returns the code of the type table entry, the entry is added to the table if it is not there yet.
+    """
+
+    code = type_codes.get(entry)
+    if code is None:
+        code = type_codes[entry] = len(types)
+        types.append(entry)
+    return code
+
+
+def _plan(entry):
+    """
+    Returns the decoding plan of the type table entry: its kind, the class (or the shared node), the names of the
+    attributes, first the ones decoded before the object in reverse order, as they are on the stack, then the ones
+    stored in the positions array, and the numbers of both.
+    """
+
+    if entry[0] == _OBJECT:
+        _, name, names = entry
+        cls = _registry.get(name)
+        if cls is None:
+            raise ValueError('Unknown serialized class {}'.format(name))
+        return _OBJECT, cls, names[::-1], len(names), 0
+
+    _, name, names, position_names = entry
+    cls = Wildcard if name == 'Wildcard' else getattr(ast, name, None)
+    if not isinstance(cls, type) or not issubclass(cls, ast.AST):
+        raise ValueError('Unknown serialized node type {}'.format(name))
+    if not names and not position_names and issubclass(cls, _SHARED_NODE_TYPES):
+        return _SHARED_NODE, cls(), (), 0, 0
+    return _NODE, cls, names[::-1] + position_names, len(names), len(position_names)
+
+
+for _cls in (Pattern, EditScript, Insert, Delete, Update, Move):
+    register(_cls)
@@ -0,0 +1,279 @@
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+from . import pattern_serialization
+from .ast_encoding import TokenVocabulary
+from .pattern import root_node_type
+from .pattern_matching import PatternFactoryListener, PatternListener, Recommender, match_order_key
+from .pattern_parsing import CollectingPatternParser
+
+
+class PatternShard(ABC):
+    """
+    This interface represents a single matching node that holds a part of the pattern set. The uploaded AST is
+    submitted to every shard and the found matches are collected afterwards, so the shards can search for matches
+    concurrently.
+
+    ...
+
+    Methods
+    -------
+    public void submit(self, uploaded_ast)
+        Starts matching the uploaded AST against the patterns of the shard.
+    public list of tuple result(self)
+        Returns the matches found for the last submitted AST.
+    public void close(self)
+        Releases all resources held by the shard.
+    """
+
+    @abstractmethod
+    def submit(self, uploaded_ast):
+        """
+        Starts matching the uploaded AST against the patterns of the shard.
+
+        Parameters
+        ----------
+        uploaded_ast : ast
+            AST of the code that needs to be matched
+        """
+        pass
+
+    @abstractmethod
+    def result(self):
+        """
+        Returns the matches found for the last submitted AST.
+
+        Returns
+        -------
+        list of (int, int, int, list of ast)
+            Identifier of the matched pattern, start and end preorder index of the match and the ASTs matched to the
+            wildcard nodes of the pattern, for every found match
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        """
+        Releases all resources held by the shard.
+        """
+        pass
+
+
+class LocalProcessShard(PatternShard):
+    """
+    This class is a PatternShard that matches its patterns in a local worker process. It stands in for a remote
+    matching node, the patterns, uploaded ASTs and found matches are exchanged through a pipe in the format of
+    pattern_serialization.
+
+    ...
+
+    Methods
+    -------
+    public __init__(self, patterns)
+        Initialises LocalProcessShard object and starts its worker process.
+    public void submit(self, uploaded_ast)
+        Sends the uploaded AST to the worker process.
+    public list of tuple result(self)
+        Waits for the matches found by the worker process.
+    public void close(self)
+        Stops the worker process.
+    """
+
+    def __init__(self, patterns):
+        """
+        Initialises LocalProcessShard object and starts its worker process.
+
+        Parameters
+        ----------
+        patterns : list of Pattern
+            Patterns held by the shard
+        """
+
+        self.__connection, worker_connection = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=_serve_shard, daemon=True,
+                                                 args=(worker_connection, pattern_serialization.dumps(patterns)))
+        self.__process.start()
+        worker_connection.close()
+
+    def submit(self, uploaded_ast):
+        """
+        Sends the uploaded AST to the worker process.
+
+        Parameters
+        ----------
+        uploaded_ast : ast
+            AST of the code that needs to be matched
+        """
+
+        self.__connection.send_bytes(pattern_serialization.dumps(uploaded_ast))
+
+    def result(self):
+        """
+        Waits for the matches found by the worker process.
+
+        Returns
+        -------
+        list of (int, int, int, list of ast)
+            Identifier of the matched pattern, start and end preorder index of the match and the ASTs matched to the
+            wildcard nodes of the pattern, for every found match
+        """
+
+        return pattern_serialization.loads(self.__connection.recv_bytes())
+
+    def close(self):
+        """
+        Stops the worker process.
+        """
+
+        if self.__process.is_alive():
+            self.__connection.send_bytes(pattern_serialization.dumps(None))
+            self.__process.join()
+        self.__connection.close()
+
+
+class ShardedRecommender:
+    """
+    This class coordinates matching over a pattern set that is partitioned across several
+    PatternShard objects. Every uploaded AST is sent to all shards, their matches are merged
+    in the order in which a single Recommender with the whole pattern set would find them and
+    parsed by the received parser.
+
+    ...
+
+    Attributes
+    ----------
+    patterns : list of Pattern
+        Whole pattern set, its order determines the order of matches found at the same node
+    shards : list of PatternShard
+        Shards that hold the partitions of the pattern set
+
+    Methods
+    -------
+    public __init__(self, patterns, shard_count, partition_key, shard_factory)
+        Initialises ShardedRecommender object and starts its shards.
+    public File get_recommendations(self, uploaded_ast, parser)
+        Finds the matches for the uploaded AST on all shards and parses them with the parser.
+    public void close(self)
+        Closes all shards.
+    """
+
+    def __init__(self, patterns, shard_count=2, partition_key=root_node_type, shard_factory=LocalProcessShard):
+        """
+        Initialises ShardedRecommender object and starts its shards.
+
+        Parameters
+        ----------
+        patterns : list of Pattern
+            Whole pattern set, every pattern needs to have an identifier
+        shard_count : int, optional
+            Number of shards (default is 2)
+        partition_key : callable, optional
+            Function that maps a Pattern to the key of its partition, patterns with equal keys are
+            held by the same shard. Default partitions the patterns by their root node type.
+        shard_factory : callable, optional
+            Function that creates a PatternShard from a list of patterns (default is LocalProcessShard)
+        """
+
+        self.patterns = list(patterns)
+        self.shards = [shard_factory(partition) for partition in
+                       _partition(self.patterns, shard_count, partition_key) if partition]
+        self.__patterns = {pattern.pattern_id: pattern for pattern in self.patterns}
+        self.__ranks = {pattern.pattern_id: rank for rank, pattern in enumerate(self.patterns)}
+
+    def get_recommendations(self, uploaded_ast, parser):
+        """
+        Finds the matches for the uploaded AST on all shards and parses them with the parser.
+
+        Parameters
+        ----------
+        uploaded_ast : ast
+            AST of the code that needs to be matched
+        parser : IPatternParser
+            Parser used for parsing found matches
+
+        Returns
+        -------
+        File
+            Output of the parser
+        """
+
+        for shard in self.shards:
+            shard.submit(uploaded_ast)
+        matches = [match for shard in self.shards for match in shard.result()]
+        matches.sort(key=lambda match: match_order_key(match[1], match[2], self.__ranks[match[0]]))
+
+        for pattern_id, start, end, wildcard_matches in matches:
+            matcher = PatternListener(self.__patterns[pattern_id], None)
+            matcher.start, matcher.end, matcher.wildcard_matches = start, end, wildcard_matches
+            parser.parse(matcher)
+        return parser.output
+
+    def close(self):
+        """
+        Closes all shards.
+        """
+
+        for shard in self.shards:
+            shard.close()
+
+
+def _partition(patterns, shard_count, partition_key):
+    """
+    Partitions the patterns into shard_count balanced partitions, patterns with equal keys end up in the same
+    partition.
+
+    Parameters
+    ----------
+    patterns : list of Pattern
+        Partitioned patterns
+    shard_count : int
+        Number of partitions
+    partition_key : callable
+        Function that maps a Pattern to the key of its partition
+
+    Returns
+    -------
+    list of list of Pattern
+        Partitions of the patterns
+    """
+
+    groups = defaultdict(list)
+    for pattern in patterns:
+        groups[partition_key(pattern)].append(pattern)
+
+    partitions = [[] for _ in range(shard_count)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(partitions, key=len).extend(group)
+    return partitions
+
+
+def _serve_shard(connection, patterns):
+    """
+    Matches the uploaded ASTs received through the connection against the patterns until None is received. Executed
+    in the worker process of a LocalProcessShard.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection to the coordinating process
+    patterns : bytes
+        Serialized patterns held by the shard
+    """
+
+    vocabulary = TokenVocabulary()
+    factories = [PatternFactoryListener(pattern, vocabulary=vocabulary)
+                 for pattern in pattern_serialization.loads(patterns)]
+    while True:
+        uploaded_ast = pattern_serialization.loads(connection.recv_bytes())
+        if uploaded_ast is None:
+            break
+        parser = CollectingPatternParser()
+        recommender = Recommender(parser, uploaded_ast, vocabulary=vocabulary)
+        for factory in factories:
+            recommender.subscribe(factory.bind(recommender))
+        recommender.get_recommendations()
+        connection.send_bytes(pattern_serialization.dumps(
+            [(matcher.pattern.pattern_id, matcher.start, matcher.end, matcher.wildcard_matches)
+             for matcher in parser.output]))
+    connection.close()
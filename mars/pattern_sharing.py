@@ -0,0 +1,405 @@
+import marshal
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+from . import pattern_serialization
+from .ast_utils import match_label
+from .pattern import Wildcard
+from .pattern_compilation import compile_node
+from .pattern_matching import PatternFactoryListener, pattern_nodes
+
+_MAGIC = b'MARSPT01'
+# magic, version of the pattern set, number of patterns, offset and length of the root type table
+_HEADER = struct.Struct('<8sqqqq')
+# offset and length of the serialized pattern, pattern identifier and code of its root node type
+_ENTRY = struct.Struct('<qqqq')
+# root type codes of patterns that start with a wildcard and of patterns without nodes
+_ANY_ROOT = -1
+_NO_ROOT = -2
+
+
+class SharedPatternTable:
+    """
+    This class is an immutable table of serialized patterns placed in shared memory. The serving process publishes
+    the table once and the worker processes attach to it by its name. Workers read the patterns directly from
+    the shared memory and decode only the patterns they need. The serialized pattern set is held in memory only once
+    no matter how many workers there are, but every worker holds its own decoded copies of the patterns it needed,
+    so the memory of a worker still grows with the patterns whose root node types appear in the code it matches.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Name of the shared memory block, used by workers for attaching to the table
+    version : int
+        Version of the pattern set in the table
+
+    Methods
+    -------
+    public SharedPatternTable create(cls, patterns, version, name)
+        Serializes the patterns into a new shared memory block.
+    public SharedPatternTable attach(cls, name, track)
+        Attaches to a table published by another process.
+    public int __len__(self)
+        Returns the number of patterns in the table.
+    public int pattern_id(self, index)
+        Returns the identifier of the pattern at the index.
+    public str root_type(self, index)
+        Returns the name of the node type the pattern at the index starts with.
+    public Pattern pattern(self, index)
+        Decodes the pattern at the index.
+    public void close(self)
+        Detaches from the shared memory block.
+    public void unlink(self)
+        Destroys the shared memory block, called by the process that created it.
+    """
+
+    def __init__(self, memory):
+        """
+        Initialises SharedPatternTable object over the shared memory block. Tables are created with create() or
+        attach().
+
+        Parameters
+        ----------
+        memory : SharedMemory
+            Shared memory block that holds the table
+        """
+
+        self.__memory = memory
+        magic, self.version, self.__count, types_offset, types_length = _HEADER.unpack_from(memory.buf, 0)
+        if magic != _MAGIC:
+            raise ValueError('Shared memory block {} does not hold a pattern table'.format(memory.name))
+        with memory.buf[types_offset:types_offset + types_length] as root_types:
+            self.__root_types = marshal.loads(root_types)
+
+    @property
+    def name(self):
+        """
+        Returns the name of the shared memory block.
+
+        Returns
+        -------
+        str
+            Name of the shared memory block
+        """
+
+        return self.__memory.name
+
+    @classmethod
+    def create(cls, patterns, version, name=None):
+        """
+        Serializes the patterns into a new shared memory block.
+
+        Parameters
+        ----------
+        patterns : list of Pattern
+            Published patterns, their order is kept in the table
+        version : int
+            Version of the pattern set
+        name : str, optional
+            Name of the shared memory block (default is None, a unique name is generated)
+
+        Returns
+        -------
+        SharedPatternTable
+            Table owned by the calling process
+        """
+
+        root_codes, entries, blobs = {}, [], []
+        offset = _HEADER.size + _ENTRY.size * len(patterns)
+        for pattern in patterns:
+            blob = pattern_serialization.dumps(pattern)
+            nodes = pattern_nodes(pattern)
+            if not nodes:
+                root_code = _NO_ROOT
+            elif isinstance(nodes[0], Wildcard):
+                root_code = _ANY_ROOT
+            else:
+                root_code = root_codes.setdefault(type(nodes[0]).__name__, len(root_codes))
+            pattern_id = pattern.pattern_id if pattern.pattern_id is not None else -1
+            entries.append((offset, len(blob), pattern_id, root_code))
+            blobs.append(blob)
+            offset += len(blob)
+        root_types = marshal.dumps(sorted(root_codes, key=root_codes.get))
+
+        memory = shared_memory.SharedMemory(name=name, create=True, size=offset + len(root_types))
+        try:
+            buffer = memory.buf
+            _HEADER.pack_into(buffer, 0, _MAGIC, version, len(patterns), offset, len(root_types))
+            for index, entry in enumerate(entries):
+                _ENTRY.pack_into(buffer, _HEADER.size + _ENTRY.size * index, *entry)
+            for (blob_offset, length, _, _), blob in zip(entries, blobs):
+                buffer[blob_offset:blob_offset + length] = blob
+            buffer[offset:offset + len(root_types)] = root_types
+            del buffer
+            return cls(memory)
+        except BaseException:
+            memory.close()
+            memory.unlink()
+            raise
+
+    @classmethod
+    def attach(cls, name, track=True):
+        """
+        Attaches to a table published by another process.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block
+        track : bool, optional
+            True if the block is registered with the resource tracker of the calling process (default is True).
+            Processes started by multiprocessing share the tracker of the publisher, which destroys the block only
+            if the publisher does not unlink it. Processes started independently have trackers of their own, which
+            would destroy the block when they exit, they need to attach with False.
+
+        Returns
+        -------
+        SharedPatternTable
+            Attached table, it needs to be closed but not unlinked by the calling process
+        """
+
+        try:
+            memory = shared_memory.SharedMemory(name=name, track=track)
+        except TypeError:
+            # before Python 3.13 every attached block is registered, POSIX blocks under their name with a leading slash
+            memory = shared_memory.SharedMemory(name=name)
+            if not track and os.name == 'posix':
+                resource_tracker.unregister('/' + memory.name, 'shared_memory')
+        return cls(memory)
+
+    def __len__(self):
+        """
+        Returns the number of patterns in the table.
+
+        Returns
+        -------
+        int
+            Number of patterns
+        """
+
+        return self.__count
+
+    def pattern_id(self, index):
+        """
+        Returns the identifier of the pattern at the index.
+
+        Parameters
+        ----------
+        index : int
+            Position of the pattern in the table
+
+        Returns
+        -------
+        int
+            Identifier of the pattern, None if it was published without one
+        """
+
+        pattern_id = self.__entry(index)[2]
+        return pattern_id if pattern_id >= 0 else None
+
+    def root_type(self, index):
+        """
+        Returns the name of the node type the pattern at the index starts with.
+
+        Parameters
+        ----------
+        index : int
+            Position of the pattern in the table
+
+        Returns
+        -------
+        str
+            Name of the root node type, None if the pattern starts with a wildcard and '' if it has no nodes
+        """
+
+        root_code = self.__entry(index)[3]
+        if root_code == _ANY_ROOT:
+            return None
+        return self.__root_types[root_code] if root_code != _NO_ROOT else ''
+
+    def pattern(self, index):
+        """
+        Decodes the pattern at the index. Every call returns a new Pattern object.
+
+        Parameters
+        ----------
+        index : int
+            Position of the pattern in the table
+
+        Returns
+        -------
+        Pattern
+            Decoded pattern
+        """
+
+        offset, length, _, _ = self.__entry(index)
+        with self.__memory.buf[offset:offset + length] as blob:
+            return pattern_serialization.loads(blob)
+
+    def close(self):
+        """
+        Detaches from the shared memory block. Patterns that were already decoded remain usable.
+        """
+
+        self.__memory.close()
+
+    def unlink(self):
+        """
+        Destroys the shared memory block, called by the process that created it once all workers are stopped.
+        """
+
+        self.__memory.unlink()
+
+    def __entry(self, index):
+        if not 0 <= index < self.__count:
+            raise IndexError('Pattern table index out of range')
+        return _ENTRY.unpack_from(self.__memory.buf, _HEADER.size + _ENTRY.size * index)
+
+
+class SharedPatternFactoryListener(PatternFactoryListener):
+    """
+    This class is a PatternFactoryListener whose pattern stays in a SharedPatternTable until it is needed. The pattern
+    is decoded the first time a node with its root node type is checked, patterns whose root type never appears in
+    the uploaded code are never decoded. Bound copies share the decoded pattern with the factory they were bound from.
+
+    ...
+
+    Attributes
+    ----------
+    table : SharedPatternTable
+        Table that holds the pattern
+    index : int
+        Position of the pattern in the table
+    root_type : str
+        Name of the node type the pattern starts with, None if it starts with a wildcard
+    pattern : Pattern
+        Pattern decoded from the table on first access
+    nodes : list of ast
+        Nodes of the Pattern in the order in which they are matched
+    labels : list of tuple
+        Labels of the Pattern nodes, None for wildcard nodes
+    checks : list of callable
+        Checks the Pattern nodes are compiled into, None for wildcard nodes
+    compiler : PatternCompiler
+        Compiler that caches the checks of the pattern nodes, None if they are compiled without caching
+
+    Methods
+    -------
+    public __init__(self, table, index, recommender, compiler)
+        Initialises SharedPatternFactoryListener object without decoding the pattern.
+    public bool check_match(self, node)
+        Check if the input node matches the first node of the pattern.
+    """
+
+    def __init__(self, table, index, recommender=None, compiler=None):
+        """
+        Initialises SharedPatternFactoryListener object without decoding the pattern.
+
+        Parameters
+        ----------
+        table : SharedPatternTable
+            Table that holds the pattern
+        index : int
+            Position of the pattern in the table
+        recommender : Recommender, optional
+            Recommender object that the listener is listening to (default is None)
+        compiler : PatternCompiler, optional
+            Compiler that caches the checks of the pattern nodes once the pattern is decoded (default is None, the
+            nodes are compiled without caching)
+        """
+
+        self.recommender = recommender
+        self.wildcard_matches = []
+        self.table = table
+        self.index = index
+        self.root_type = table.root_type(index)
+        self.compiler = compiler
+        # patterns are decoded lazily, so they are matched by their checks instead of tokens
+        self.vocabulary = self.tokens = self.runs = None
+        # shared with bound copies, holds the pattern, its nodes, labels and checks once they are decoded
+        self.__decoded = []
+
+    @property
+    def pattern(self):
+        """
+        Returns the pattern, decoding it from the table on first access.
+
+        Returns
+        -------
+        Pattern
+            Decoded pattern
+        """
+
+        return self.__decode()[0]
+
+    @property
+    def nodes(self):
+        """
+        Returns the nodes of the pattern, decoding it from the table on first access.
+
+        Returns
+        -------
+        list of ast
+            Nodes of the pattern in the order in which they are matched
+        """
+
+        return self.__decode()[1]
+
+    @property
+    def labels(self):
+        """
+        Returns the labels of the pattern nodes, decoding the pattern from the table on first access.
+
+        Returns
+        -------
+        list of tuple
+            Labels of the pattern nodes, None for wildcard nodes
+        """
+
+        return self.__decode()[2]
+
+    @property
+    def checks(self):
+        """
+        Returns the checks the pattern nodes are compiled into, decoding the pattern from the table on first access.
+
+        Returns
+        -------
+        list of callable
+            Checks of the pattern nodes, None for wildcard nodes
+        """
+
+        return self.__decode()[3]
+
+    def check_match(self, node):
+        """
+        Check if the input node matches the first node of the pattern. The pattern is decoded only if the node has
+        the root node type of the pattern.
+
+        Parameters
+        ----------
+        node : ast
+            AST node that is checked for match
+
+        Returns
+        -------
+        bool
+            True if the nodes match, false otherwise
+        """
+
+        if self.root_type is not None and self.root_type != type(node).__name__:
+            return False
+        return super().check_match(node)
+
+    def __decode(self):
+        if not self.__decoded:
+            pattern = self.table.pattern(self.index)
+            nodes = pattern_nodes(pattern)
+            labels = [None if isinstance(node, Wildcard) else match_label(node) for node in nodes]
+            checks = self.compiler.compile(nodes) if self.compiler is not None else \
+                [compile_node(node) for node in nodes]
+            self.__decoded.extend((pattern, nodes, labels, checks))
+        return self.__decoded
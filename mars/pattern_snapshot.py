@@ -0,0 +1,180 @@
+import marshal
+import os
+from array import array
+
+from . import pattern_serialization
+from .ast_encoding import WILDCARD
+from .pattern import Wildcard
+from .pattern_compilation import PatternCompiler, node_shape, shape_label
+from .pattern_matching import PatternFactoryListener, pattern_nodes
+
+_MAGIC = b'MARSSN04'
+
+
+class PatternSnapshot:
+    """
+    This class is a precompiled snapshot of a loaded pattern set that is saved to a single file. Loading the patterns
+    from the database decodes every pattern separately and building the factories computes the label and the token
+    or the check of every pattern node. The snapshot holds all patterns in a single serialized block together with the
+    shapes of their nodes, see node_shape. Every distinct shape is stored only once, so a process that loads the
+    snapshot reads the file at once, decodes the patterns in one call and computes the labels and the tokens or checks
+    per distinct shape instead of per node.
+
+    ...
+
+    Attributes
+    ----------
+    version : int
+        Version of the pattern set in the snapshot
+    filters : dict
+        Keyword arguments of DbContext.iter_patterns the patterns were selected by, empty if all patterns are held
+    patterns : list of Pattern
+        Patterns of the snapshot
+    shapes : list of tuple
+        Distinct shapes of the pattern nodes
+    node_shapes : list of array
+        Positions of the shapes of the nodes of every pattern in shapes, -1 for wildcard nodes
+
+    Methods
+    -------
+    public __init__(self, patterns, version, filters, shapes, node_shapes)
+        Initialises PatternSnapshot object.
+    public void save(self, path)
+        Atomically writes the snapshot to a file.
+    public PatternSnapshot load(cls, path)
+        Reads the snapshot from a file.
+    public list of PatternFactoryListener factories(self, vocabulary, compiler)
+        Creates the factories of the patterns in the snapshot.
+    """
+
+    def __init__(self, patterns, version, filters=None, shapes=None, node_shapes=None):
+        """
+        Initialises PatternSnapshot object.
+
+        Parameters
+        ----------
+        patterns : list of Pattern
+            Patterns of the snapshot, their order is kept
+        version : int
+            Version of the pattern set
+        filters : dict, optional
+            Keyword arguments of DbContext.iter_patterns the patterns were selected by (default is None, all
+            patterns are held)
+        shapes : list of tuple, optional
+            Distinct shapes of the pattern nodes, they are computed from the patterns if not provided (default is
+            None)
+        node_shapes : list of array, optional
+            Positions of the shapes of the nodes of every pattern, they are computed from the patterns if not
+            provided (default is None)
+        """
+
+        self.version = version
+        self.filters = dict(filters or {})
+        self.patterns = list(patterns)
+        if shapes is None or node_shapes is None:
+            positions = {}
+            node_shapes = [array('i', [-1 if isinstance(node, Wildcard) else
+                                       positions.setdefault(node_shape(node), len(positions))
+                                       for node in pattern_nodes(pattern)]) for pattern in self.patterns]
+            shapes = sorted(positions, key=positions.get)
+        self.shapes = shapes
+        self.node_shapes = node_shapes
+
+    def save(self, path):
+        """
+        Atomically writes the snapshot to a file. The snapshot is written to a temporary file in the same directory
+        first, which then replaces the previous snapshot, so processes that load the snapshot concurrently never
+        read a partially written one.
+
+        Parameters
+        ----------
+        path : str
+            Path of the snapshot file
+        """
+
+        # imported lazily, processes that only load snapshots do not need it
+        import tempfile
+
+        data = marshal.dumps((self.version, self.filters, self.shapes,
+                              [positions.tobytes() for positions in self.node_shapes],
+                              pattern_serialization.dumps(self.patterns)))
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(_MAGIC)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads the snapshot from a file in a single read.
+
+        Parameters
+        ----------
+        path : str
+            Path of the snapshot file
+
+        Returns
+        -------
+        PatternSnapshot
+            Loaded snapshot
+
+        Raises
+        ------
+        ValueError
+            If the file does not hold a pattern snapshot
+        """
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        if data[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('File {} does not hold a pattern snapshot'.format(path))
+        try:
+            version, filters, shapes, node_shapes, patterns = marshal.loads(memoryview(data)[len(_MAGIC):])
+        except (EOFError, TypeError) as error:
+            raise ValueError('Pattern snapshot {} is damaged'.format(path)) from error
+        node_shapes = [array('i', positions) for positions in node_shapes]
+        return cls(pattern_serialization.loads(patterns), version, filters, shapes, node_shapes)
+
+    def factories(self, vocabulary=None, compiler=None):
+        """
+        Creates the factories of the patterns in the snapshot. The labels and tokens of the pattern nodes are
+        computed once for every distinct shape. The checks are computed the same way if the patterns are not encoded,
+        the factories of encoded patterns compile them only if they need them.
+
+        Parameters
+        ----------
+        vocabulary : TokenVocabulary, optional
+            Vocabulary the patterns are encoded by (default is None, the patterns are not encoded)
+        compiler : PatternCompiler, optional
+            Compiler that caches the checks of the pattern nodes (default is None, a new compiler is created)
+
+        Returns
+        -------
+        list of PatternFactoryListener
+            Factories of the patterns that are not bound to any Recommender
+        """
+
+        compiler = compiler if compiler is not None else PatternCompiler()
+        labels = [shape_label(shape) for shape in self.shapes]
+        tokens = [vocabulary.intern_label(label) for label in labels] if vocabulary is not None else None
+        # encoded patterns are matched by their tokens, their factories compile the checks only if they need them
+        checks = [compiler.compile_shape(shape) for shape in self.shapes] if tokens is None else None
+
+        factories = []
+        for pattern, positions in zip(self.patterns, self.node_shapes):
+            factories.append(PatternFactoryListener(
+                pattern, vocabulary=vocabulary, compiler=compiler,
+                labels=[labels[position] if position >= 0 else None for position in positions],
+                tokens=array('i', [tokens[position] if position >= 0 else WILDCARD for position in positions])
+                if tokens is not None else None,
+                checks=[checks[position] if position >= 0 else None for position in positions]
+                if checks is not None else None))
+        return factories
@@ -0,0 +1,1261 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from . import instrumentation, pattern_serialization
+from .pattern import canonical_hash, edit_signature, root_node_type
+
+logger = logging.getLogger(__name__)
+
+
+class DbContext(ABC):
+    """
+    This interface represents the database in which the patterns created and refined by the system are saved.
+
+    ...
+
+    Methods
+    -------
+    public list of Pattern load_patterns(self)
+        Loads all patterns saved in the database.
+    public Iterator iter_patterns(self, root_type, signature, since_version)
+        Iterates over the saved patterns with the received root node type and edit signature.
+    public void save_pattern(self, pattern)
+        Saves the pattern in the database.
+    public void save_patterns(self, patterns)
+        Saves all the patterns in the database.
+    public Pattern find_pattern(self, pattern_hash)
+        Returns the saved pattern with the received canonical hash.
+    public list of Pattern merge_patterns(self, patterns)
+        Saves the patterns, merging duplicates of saved patterns into them.
+    public void remove_pattern(self, pattern)
+        Removes the pattern from the database.
+    public void remove_patterns(self, patterns)
+        Removes all the patterns from the database.
+    public int get_version(self)
+        Returns the version of the saved pattern set.
+    """
+
+    @abstractmethod
+    def load_patterns(self):
+        """
+        Loads all patterns saved in the database.
+
+        Returns
+        -------
+        list of Pattern
+            List of all patterns saved in the database
+        """
+        pass
+
+    def iter_patterns(self, root_type=None, signature=None, since_version=None):
+        """
+        Iterates over the saved patterns with the received root node type and edit signature. Implementations backed
+        by a persistent database answer the query from their indexes, this implementation filters all loaded patterns.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with, see root_node_type (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns, see edit_signature (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are returned (default is None, all
+            patterns). Implementations that do not record when the patterns were saved do not support it.
+
+        Returns
+        -------
+        Iterator
+            Iterator over the matching patterns, ordered by their identifiers
+
+        Raises
+        ------
+        NotImplementedError
+            If since_version is set and the implementation does not record when the patterns were saved
+        """
+
+        if since_version is not None:
+            raise NotImplementedError('{} does not record the versions in which its patterns were saved, they can not '
+                                      'be filtered by since_version'.format(type(self).__name__))
+        for pattern in self.load_patterns():
+            if (root_type is None or root_node_type(pattern) == root_type) and \
+                    (signature is None or edit_signature(pattern) == signature):
+                yield pattern
+
+    @abstractmethod
+    def save_pattern(self, pattern):
+        """
+        Saves the pattern in the database. If the pattern does not have an identifier yet, a new one is assigned to it.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be saved in the database
+        """
+        pass
+
+    def save_patterns(self, patterns):
+        """
+        Saves all the patterns in the database. Implementations backed by a persistent database save them in a
+        single transaction.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+        """
+
+        for pattern in patterns:
+            self.save_pattern(pattern)
+
+    def find_pattern(self, pattern_hash):
+        """
+        Returns the saved pattern with the received canonical hash. Implementations backed by a persistent database
+        answer the query from their indexes, this implementation hashes all loaded patterns.
+
+        Parameters
+        ----------
+        pattern_hash : str
+            Canonical hash of the pattern, see canonical_hash
+
+        Returns
+        -------
+        Pattern
+            Saved pattern with the hash, None if there is no such pattern
+        """
+
+        return next((pattern for pattern in self.load_patterns() if canonical_hash(pattern) == pattern_hash), None)
+
+    def merge_patterns(self, patterns):
+        """
+        Saves the patterns, merging duplicates into a single pattern. A pattern whose canonical hash equals the hash of
+        a saved pattern, or of a pattern earlier in the list, is not saved. Its occurrences are added to the
+        occurrences of the pattern it duplicates instead. Hashing materializes lazily produced EditScripts.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+
+        Returns
+        -------
+        list of Pattern
+            For every received pattern, the pattern it was saved as
+        """
+
+        stored, unique = _merge_duplicates(patterns, self.find_pattern)
+        self.save_patterns(unique.values())
+        return stored
+
+    @abstractmethod
+    def remove_pattern(self, pattern):
+        """
+        Removes the pattern from the database.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If the pattern is not saved in the database
+        """
+        pass
+
+    def remove_patterns(self, patterns):
+        """
+        Removes all the patterns from the database. Implementations backed by a persistent database remove them in a
+        single transaction.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If any of the patterns is not saved in the database
+        """
+
+        for pattern in patterns:
+            self.remove_pattern(pattern)
+
+    @abstractmethod
+    def get_version(self):
+        """
+        Returns the version of the saved pattern set. The version changes every time a pattern is saved or removed.
+
+        Returns
+        -------
+        int
+            Version of the saved pattern set
+        """
+        pass
+
+
+class InMemoryDbContext(DbContext):
+    """
+    This class is a DbContext implementation that keeps all the patterns in memory. It is used when patterns need to be
+    processed without touching the persistent database, for example when a cluster of patterns is refined in a worker
+    process.
+
+    ...
+
+    Attributes
+    ----------
+    patterns : dict of (int, Pattern)
+        Saved patterns indexed by their identifiers
+    version : int
+        Version of the saved pattern set
+
+    Methods
+    -------
+    public __init__(self, patterns=None)
+        Initialises InMemoryDbContext object.
+    public list of Pattern load_patterns(self)
+        Loads all patterns saved in the database.
+    public Iterator iter_patterns(self, root_type, signature, since_version)
+        Iterates over the saved patterns matching the received filters.
+    public void save_pattern(self, pattern)
+        Saves the pattern in the database.
+    public Pattern find_pattern(self, pattern_hash)
+        Returns the saved pattern with the received canonical hash.
+    public void remove_pattern(self, pattern)
+        Removes the pattern from the database.
+    public int get_version(self)
+        Returns the version of the saved pattern set.
+    """
+
+    def __init__(self, patterns=None):
+        """
+        Initialises InMemoryDbContext object.
+
+        Parameters
+        ----------
+        patterns : list of Pattern, optional
+            Patterns that are saved in the database on creation (default is None)
+        """
+
+        self.patterns = {}
+        self.version = 0
+        self.__next_id = 0
+        # versions of the pattern set in which the patterns were last saved, indexed by their identifiers
+        self.__generations = {}
+        # canonical hashes of the saved patterns when they were saved, indexed by their identifiers
+        self.__hashes = {}
+        # identifiers of the saved patterns indexed by their canonical hashes when they were saved
+        self.__hash_index = {}
+        for pattern in patterns or ():
+            self.save_pattern(pattern)
+
+    def load_patterns(self):
+        """
+        Loads all patterns saved in the database.
+
+        Returns
+        -------
+        list of Pattern
+            List of all patterns saved in the database, ordered by their identifiers
+        """
+
+        return [self.patterns[pattern_id] for pattern_id in sorted(self.patterns)]
+
+    def iter_patterns(self, root_type=None, signature=None, since_version=None):
+        """
+        Iterates over the saved patterns matching the received filters.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with, see root_node_type (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns, see edit_signature (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are returned (default is None, all
+            patterns)
+
+        Returns
+        -------
+        Iterator
+            Iterator over the matching patterns, ordered by their identifiers
+        """
+
+        for pattern_id in sorted(self.patterns):
+            if since_version is not None and self.__generations[pattern_id] <= since_version:
+                continue
+            pattern = self.patterns[pattern_id]
+            if (root_type is None or root_node_type(pattern) == root_type) and \
+                    (signature is None or edit_signature(pattern) == signature):
+                yield pattern
+
+    def save_pattern(self, pattern):
+        """
+        Saves the pattern in the database. If the pattern does not have an identifier yet, a new one is assigned to it.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be saved in the database
+        """
+
+        if pattern.pattern_id is None:
+            pattern.pattern_id = self.__next_id
+        self.__next_id = max(self.__next_id, pattern.pattern_id + 1)
+        self.patterns[pattern.pattern_id] = pattern
+        self.__index(pattern.pattern_id, canonical_hash(pattern))
+        self.version += 1
+        self.__generations[pattern.pattern_id] = self.version
+
+    def find_pattern(self, pattern_hash):
+        """
+        Returns the saved pattern with the received canonical hash. Patterns are indexed by their hashes when they are
+        saved, a pattern changed in place is found by its new hash only after it is saved again.
+
+        Parameters
+        ----------
+        pattern_hash : str
+            Canonical hash of the pattern, see canonical_hash
+
+        Returns
+        -------
+        Pattern
+            Saved pattern with the hash, None if there is no such pattern
+        """
+
+        for pattern_id in sorted(self.__hash_index.get(pattern_hash, ())):
+            pattern = self.patterns[pattern_id]
+            current_hash = canonical_hash(pattern)
+            if current_hash == pattern_hash:
+                return pattern
+            # the pattern was changed in place after it was saved, it is indexed by its current hash instead
+            self.__index(pattern_id, current_hash)
+        return None
+
+    def remove_pattern(self, pattern):
+        """
+        Removes the pattern from the database.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If the pattern is not saved in the database
+        """
+
+        del self.patterns[pattern.pattern_id]
+        del self.__generations[pattern.pattern_id]
+        self.__index(pattern.pattern_id, None)
+        self.version += 1
+
+    def get_version(self):
+        """
+        Returns the version of the saved pattern set. The version changes every time a pattern is saved or removed.
+
+        Returns
+        -------
+        int
+            Version of the saved pattern set
+        """
+
+        return self.version
+
+    def __index(self, pattern_id, pattern_hash):
+        """
+        Indexes the pattern with the identifier by the canonical hash instead of its previous one, None only removes
+        it from the index.
+        """
+
+        previous_hash = self.__hashes.pop(pattern_id, None)
+        if previous_hash is not None:
+            pattern_ids = self.__hash_index[previous_hash]
+            pattern_ids.discard(pattern_id)
+            if not pattern_ids:
+                del self.__hash_index[previous_hash]
+        if pattern_hash is not None:
+            self.__hashes[pattern_id] = pattern_hash
+            self.__hash_index.setdefault(pattern_hash, set()).add(pattern_id)
+
+
+class SqliteConnectionPool:
+    """
+    This class is a fixed-size pool of connections to a SQLite database. Connections are opened once and reused, so
+    no connection is opened per query, and threads that use the same database get different connections, so their
+    reads run concurrently in WAL mode.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the database file
+    size : int
+        Number of connections in the pool
+
+    Methods
+    -------
+    public __init__(self, path, size, timeout)
+        Initialises SqliteConnectionPool object and opens its connections.
+    public Connection connection(self)
+        Context manager that borrows a connection from the pool.
+    public void close(self)
+        Closes all connections of the pool.
+    """
+
+    def __init__(self, path, size=4, timeout=30.0):
+        """
+        Initialises SqliteConnectionPool object and opens its connections.
+
+        Parameters
+        ----------
+        path : str
+            Path of the database file, a pool of a private ':memory:' database always holds a single connection
+        size : int, optional
+            Number of connections in the pool (default is 4)
+        timeout : float, optional
+            Number of seconds a write waits for other writers to finish (default is 30.0)
+        """
+
+        self.path = path
+        self.size = 1 if path == ':memory:' else size
+        self.__idle = queue.LifoQueue()
+        self.__connections = []
+        for _ in range(self.size):
+            connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+            if path != ':memory:':
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connections.append(connection)
+            self.__idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a connection from the pool, waiting until one is available.
+
+        Returns
+        -------
+        Connection
+            Borrowed connection, it is returned to the pool when the with block exits
+        """
+
+        connection = self.__idle.get()
+        try:
+            yield connection
+        finally:
+            self.__idle.put(connection)
+
+    def close(self):
+        """
+        Closes all connections of the pool.
+        """
+
+        for connection in self.__connections:
+            connection.close()
+
+
+class SqliteDbContext(DbContext):
+    """
+    This class is a DbContext implementation that saves the patterns in a SQLite database. Patterns are stored in the
+    format of pattern_serialization and indexed by their root node type, their edit signature and the version of the
+    pattern set in which they were last saved (their generation), so subsets of patterns can be loaded without
+    decoding all of them. Canonical hashes of the patterns are indexed as well, for merging duplicates. The database is
+    used in WAL mode, so readers in other threads and processes are not blocked by writes. Queries of different
+    threads use different connections from a SqliteConnectionPool.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Path of the database file, ':memory:' for a private in-memory database
+    pool : SqliteConnectionPool
+        Pool of connections to the database
+
+    Methods
+    -------
+    public __init__(self, path, timeout, pool_size)
+        Initialises SqliteDbContext object and creates the schema if needed.
+    public list of Pattern load_patterns(self, root_type, signature, since_version)
+        Loads the saved patterns, optionally only the ones matching the received filters.
+    public Iterator iter_patterns(self, root_type, signature, since_version, batch_size)
+        Iterates over the saved patterns matching the received filters, loading them in batches.
+    public void save_pattern(self, pattern)
+        Saves the pattern in the database.
+    public void save_patterns(self, patterns)
+        Saves all the patterns in the database in a single transaction.
+    public Pattern find_pattern(self, pattern_hash)
+        Returns the saved pattern with the received canonical hash.
+    public list of Pattern merge_patterns(self, patterns)
+        Saves the patterns in a single transaction, merging duplicates of saved patterns into them.
+    public void remove_pattern(self, pattern)
+        Removes the pattern from the database.
+    public void remove_patterns(self, patterns)
+        Removes all the patterns from the database in a single transaction.
+    public int get_version(self)
+        Returns the version of the saved pattern set.
+    public void close(self)
+        Closes all database connections.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS patterns (pattern_id INTEGER PRIMARY KEY, root_type TEXT, '
+        'signature TEXT NOT NULL, generation INTEGER NOT NULL, data BLOB NOT NULL, canonical_hash TEXT)',
+        'CREATE INDEX IF NOT EXISTS patterns_root_type ON patterns (root_type)',
+        'CREATE INDEX IF NOT EXISTS patterns_signature ON patterns (signature)',
+        'CREATE INDEX IF NOT EXISTS patterns_generation ON patterns (generation)',
+        'CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        "INSERT OR IGNORE INTO metadata (key, value) VALUES ('version', 0)",
+    )
+
+    def __init__(self, path, timeout=30.0, pool_size=4):
+        """
+        Initialises SqliteDbContext object and creates the schema if needed.
+
+        Parameters
+        ----------
+        path : str
+            Path of the database file, ':memory:' for a private in-memory database
+        timeout : float, optional
+            Number of seconds a write waits for other writers to finish (default is 30.0)
+        pool_size : int, optional
+            Number of pooled database connections (default is 4)
+        """
+
+        self.path = path
+        self.pool = SqliteConnectionPool(path, pool_size, timeout)
+        with self.__transaction() as cursor:
+            for statement in self.SCHEMA:
+                cursor.execute(statement)
+            self.__migrate(cursor)
+            cursor.execute('CREATE INDEX IF NOT EXISTS patterns_canonical_hash ON patterns (canonical_hash)')
+
+    def load_patterns(self, root_type=None, signature=None, since_version=None):
+        """
+        Loads the saved patterns, optionally only the ones matching the received filters.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are loaded (default is None, all patterns)
+
+        Returns
+        -------
+        list of Pattern
+            List of the matching patterns, ordered by their identifiers
+        """
+
+        return list(self.iter_patterns(root_type, signature, since_version))
+
+    def iter_patterns(self, root_type=None, signature=None, since_version=None, batch_size=512):
+        """
+        Iterates over the saved patterns matching the received filters. Patterns are loaded in batches, so only a
+        single batch is held in memory at once and no database cursor is kept open between batches.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are loaded (default is None, all patterns)
+        batch_size : int, optional
+            Number of patterns loaded by a single query (default is 512)
+
+        Returns
+        -------
+        Iterator
+            Iterator over the matching patterns, ordered by their identifiers
+        """
+
+        conditions, parameters = ['pattern_id > ?'], []
+        for column, operator, value in (('root_type', '=', root_type), ('signature', '=', signature),
+                                        ('generation', '>', since_version)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                parameters.append(value)
+        query = 'SELECT pattern_id, data FROM patterns WHERE {} ORDER BY pattern_id LIMIT ?'.format(
+            ' AND '.join(conditions))
+
+        last_id = -1
+        while True:
+            with self.pool.connection() as connection:
+                rows = connection.execute(query, [last_id] + parameters + [batch_size]).fetchall()
+            for last_id, data in rows:
+                yield pattern_serialization.loads(data)
+            if len(rows) < batch_size:
+                return
+
+    def save_pattern(self, pattern):
+        """
+        Saves the pattern in the database. If the pattern does not have an identifier yet, a new one is assigned to it.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be saved in the database
+        """
+
+        self.save_patterns([pattern])
+
+    def save_patterns(self, patterns):
+        """
+        Saves all the patterns in the database in a single transaction, the version of the pattern set changes only
+        once. Patterns without an identifier get a new one.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+        """
+
+        with self.__transaction() as cursor:
+            self.__write_patterns(cursor, patterns)
+
+    def find_pattern(self, pattern_hash):
+        """
+        Returns the saved pattern with the received canonical hash.
+
+        Parameters
+        ----------
+        pattern_hash : str
+            Canonical hash of the pattern, see canonical_hash
+
+        Returns
+        -------
+        Pattern
+            Saved pattern with the hash, None if there is no such pattern
+        """
+
+        with self.pool.connection() as connection:
+            return self.__find_pattern(connection.cursor(), pattern_hash)
+
+    def merge_patterns(self, patterns):
+        """
+        Saves the patterns in a single transaction, merging duplicates into a single pattern. A pattern whose canonical
+        hash equals the hash of a saved pattern, or of a pattern earlier in the list, is not saved. Its occurrences are
+        added to the occurrences of the pattern it duplicates instead. Concurrent merges from other processes are
+        serialized by the transaction, so no duplicates are saved.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+
+        Returns
+        -------
+        list of Pattern
+            For every received pattern, the pattern it was saved as
+        """
+
+        with self.__transaction() as cursor:
+            stored, unique = _merge_duplicates(patterns, lambda pattern_hash: self.__find_pattern(cursor, pattern_hash))
+            self.__write_patterns(cursor, list(unique.values()))
+        return stored
+
+    def remove_pattern(self, pattern):
+        """
+        Removes the pattern from the database.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If the pattern is not saved in the database
+        """
+
+        self.remove_patterns([pattern])
+
+    def remove_patterns(self, patterns):
+        """
+        Removes all the patterns from the database in a single transaction, the version of the pattern set changes
+        only once. If any of the patterns is not saved, none of them is removed.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If any of the patterns is not saved in the database
+        """
+
+        with self.__transaction() as cursor:
+            for pattern in patterns:
+                cursor.execute('DELETE FROM patterns WHERE pattern_id = ?', (pattern.pattern_id,))
+                if cursor.rowcount == 0:
+                    raise KeyError(pattern.pattern_id)
+            self.__increment_version(cursor)
+
+    def get_version(self):
+        """
+        Returns the version of the saved pattern set. The version changes every time patterns are saved or removed,
+        also by other processes using the same database file.
+
+        Returns
+        -------
+        int
+            Version of the saved pattern set
+        """
+
+        with self.pool.connection() as connection:
+            return connection.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()[0]
+
+    def close(self):
+        """
+        Closes all database connections.
+        """
+
+        self.pool.close()
+
+    def __write_patterns(self, cursor, patterns):
+        """
+        Writes the patterns inside the current transaction and increments the version of the pattern set once.
+
+        Parameters
+        ----------
+        cursor : Cursor
+            Cursor of the current transaction
+        patterns : iterable of Pattern
+            Patterns that are written
+        """
+
+        generation = self.__increment_version(cursor)
+        for pattern in patterns:
+            if pattern.pattern_id is None:
+                cursor.execute('INSERT INTO patterns (root_type, signature, generation, data) VALUES (?, ?, ?, ?)',
+                               (root_node_type(pattern), edit_signature(pattern), generation, b''))
+                pattern.pattern_id = cursor.lastrowid
+            cursor.execute('INSERT OR REPLACE INTO patterns (pattern_id, root_type, signature, generation, data, '
+                           'canonical_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                           (pattern.pattern_id, root_node_type(pattern), edit_signature(pattern), generation,
+                            pattern_serialization.dumps(pattern), canonical_hash(pattern)))
+
+    def __find_pattern(self, cursor, pattern_hash):
+        """
+        Loads the saved pattern with the received canonical hash.
+
+        Parameters
+        ----------
+        cursor : Cursor
+            Cursor used for the query
+        pattern_hash : str
+            Canonical hash of the pattern
+
+        Returns
+        -------
+        Pattern
+            Saved pattern with the hash, None if there is no such pattern
+        """
+
+        row = cursor.execute('SELECT data FROM patterns WHERE canonical_hash = ? ORDER BY pattern_id LIMIT 1',
+                             (pattern_hash,)).fetchone()
+        return pattern_serialization.loads(row[0]) if row is not None else None
+
+    def __migrate(self, cursor):
+        """
+        Adds the canonical hashes to a database created before they were stored.
+
+        Parameters
+        ----------
+        cursor : Cursor
+            Cursor of the current transaction
+        """
+
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(patterns)')]
+        if 'canonical_hash' in columns:
+            return
+        cursor.execute('ALTER TABLE patterns ADD COLUMN canonical_hash TEXT')
+        for pattern_id, data in cursor.execute('SELECT pattern_id, data FROM patterns').fetchall():
+            cursor.execute('UPDATE patterns SET canonical_hash = ? WHERE pattern_id = ?',
+                           (canonical_hash(pattern_serialization.loads(data)), pattern_id))
+
+    def __increment_version(self, cursor):
+        """
+        Increments the version of the pattern set inside the current transaction.
+
+        Parameters
+        ----------
+        cursor : Cursor
+            Cursor of the current transaction
+
+        Returns
+        -------
+        int
+            New version of the pattern set
+        """
+
+        cursor.execute("UPDATE metadata SET value = value + 1 WHERE key = 'version'")
+        return cursor.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()[0]
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """
+        Runs the statements executed on the yielded cursor in a single write transaction, which is rolled back if
+        an exception is raised.
+        """
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+
+class BatchingDbContext(DbContext):
+    """
+    This class is a decorator of a DbContext that delays writes and sends them to the decorated context in batches.
+    Saves and removes are queued and written with a single save_patterns and remove_patterns call once the batch is
+    full, once the oldest queued write is older than the flush interval, or when flush is called. Repeated writes of
+    the same pattern are coalesced into the last one. Every read flushes the queued writes first, so readers always
+    see their own writes. Merges are queued as well, duplicates are looked up among the queued patterns by their
+    canonical hashes and among the saved patterns with find_pattern of the decorated context.
+
+    ...
+
+    Attributes
+    ----------
+    context : DbContext
+        Decorated context that receives the batched writes
+    batch_size : int
+        Number of queued writes that triggers a flush
+    flush_interval : float
+        Maximum number of seconds a write stays queued, None if writes are flushed only by batch size and flush
+    flushes : int
+        Number of flushed batches
+
+    Methods
+    -------
+    public __init__(self, context, batch_size, flush_interval)
+        Initialises BatchingDbContext object.
+    public list of Pattern load_patterns(self, root_type, signature, since_version)
+        Flushes the queued writes and loads the patterns from the decorated context.
+    public Iterator iter_patterns(self, root_type, signature, since_version)
+        Flushes the queued writes and iterates over the patterns of the decorated context.
+    public void save_pattern(self, pattern)
+        Queues the pattern for saving.
+    public void save_patterns(self, patterns)
+        Queues all the patterns for saving.
+    public Pattern find_pattern(self, pattern_hash)
+        Flushes the queued writes and returns the pattern with the hash from the decorated context.
+    public list of Pattern merge_patterns(self, patterns)
+        Merges the patterns into the queued and the saved patterns and queues the ones that need to be written.
+    public void remove_pattern(self, pattern)
+        Queues the pattern for removal.
+    public int get_version(self)
+        Flushes the queued writes and returns the version of the decorated context.
+    public void flush(self)
+        Writes all queued writes to the decorated context.
+    public void close(self)
+        Flushes the queued writes and stops the background flushing.
+    """
+
+    def __init__(self, context, batch_size=256, flush_interval=1.0):
+        """
+        Initialises BatchingDbContext object. If flush_interval is set, a background thread flushes writes that
+        stayed queued for longer than the interval.
+
+        Parameters
+        ----------
+        context : DbContext
+            Decorated context that receives the batched writes
+        batch_size : int, optional
+            Number of queued writes that triggers a flush (default is 256)
+        flush_interval : float, optional
+            Maximum number of seconds a write stays queued (default is 1.0), None disables the background flushing
+        """
+
+        self.context = context
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        # saves and removes of saved patterns by identifier, the last write of every pattern wins
+        self.__writes = {}
+        # patterns without identifiers, they get one from the decorated context when they are flushed
+        self.__new_patterns = []
+        # queued saves by their canonical hashes, and the hashes of the queued saves by the ids of the patterns, saves
+        # queued by save_patterns are hashed only when the next merge needs them
+        self.__queued_hashes = {}
+        self.__hashes = {}
+        self.__unhashed = {}
+        self.__oldest_write = None
+        self.__lock = threading.RLock()
+        self.__stopped = threading.Event()
+        self.__flusher = None
+        if flush_interval is not None:
+            self.__flusher = threading.Thread(target=self.__flush_periodically, name='BatchingDbContext', daemon=True)
+            self.__flusher.start()
+
+    def load_patterns(self, root_type=None, signature=None, since_version=None):
+        """
+        Flushes the queued writes and loads the patterns from the decorated context, optionally only the ones
+        matching the received filters.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with, see root_node_type (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns, see edit_signature (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are loaded (default is None, all patterns)
+
+        Returns
+        -------
+        list of Pattern
+            List of the matching patterns
+        """
+
+        self.flush()
+        if root_type is None and signature is None and since_version is None:
+            return self.context.load_patterns()
+        return list(self.context.iter_patterns(root_type, signature, since_version))
+
+    def iter_patterns(self, root_type=None, signature=None, since_version=None):
+        """
+        Flushes the queued writes and iterates over the patterns of the decorated context with the received root node
+        type and edit signature.
+
+        Parameters
+        ----------
+        root_type : str, optional
+            Name of the node type the patterns start with, see root_node_type (default is None, any type)
+        signature : str, optional
+            Edit signature of the patterns, see edit_signature (default is None, any signature)
+        since_version : int, optional
+            Only the patterns saved after this version of the pattern set are returned (default is None, all
+            patterns), supported only if the decorated context supports it
+
+        Returns
+        -------
+        Iterator
+            Iterator over the matching patterns, ordered by their identifiers
+
+        Raises
+        ------
+        NotImplementedError
+            If since_version is set and the decorated context does not record when the patterns were saved
+        """
+
+        self.flush()
+        return self.context.iter_patterns(root_type, signature, since_version)
+
+    def save_pattern(self, pattern):
+        """
+        Queues the pattern for saving. Patterns without an identifier get it when they are flushed.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be saved in the database
+        """
+
+        self.save_patterns([pattern])
+
+    def save_patterns(self, patterns):
+        """
+        Queues all the patterns for saving.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+        """
+
+        with self.__lock:
+            for pattern in patterns:
+                self.__save(pattern)
+                self.__unhashed[id(pattern)] = pattern
+            self.__queued()
+
+    def find_pattern(self, pattern_hash):
+        """
+        Flushes the queued writes and returns the pattern with the hash from the decorated context.
+
+        Parameters
+        ----------
+        pattern_hash : str
+            Canonical hash of the pattern, see canonical_hash
+
+        Returns
+        -------
+        Pattern
+            Saved pattern with the hash, None if there is no such pattern
+        """
+
+        self.flush()
+        return self.context.find_pattern(pattern_hash)
+
+    def merge_patterns(self, patterns):
+        """
+        Merges the patterns into the queued and the saved patterns and queues the ones that need to be written, see
+        DbContext.merge_patterns. A duplicate of a queued pattern increases the occurrences of the queued pattern, a
+        duplicate of a saved pattern queues the saved pattern with the increased occurrences. Patterns merged into the
+        saved patterns of the decorated context by other writers before the flush are not seen, so merges of
+        concurrent writers need to go through a single BatchingDbContext.
+
+        Parameters
+        ----------
+        patterns : iterable of Pattern
+            Patterns that are going to be saved in the database
+
+        Returns
+        -------
+        list of Pattern
+            For every received pattern, the pattern it was saved as
+        """
+
+        with self.__lock:
+            self.__hash_queued()
+            stored, unique = _merge_duplicates(patterns, self.__find_merged)
+            for pattern_hash, pattern in unique.items():
+                self.__save(pattern)
+                self.__unhashed.pop(id(pattern), None)
+                self.__forget(pattern)
+                self.__queued_hashes[pattern_hash] = pattern
+                self.__hashes[id(pattern)] = pattern_hash
+            self.__queued()
+        return stored
+
+    def remove_pattern(self, pattern):
+        """
+        Queues the pattern for removal. A pattern that is only queued for saving and has no identifier yet is dropped
+        from the queue instead. A pattern that is not saved in the database is detected only when the removal is
+        flushed.
+
+        Parameters
+        ----------
+        pattern : Pattern
+            Pattern that is going to be removed from the database
+
+        Raises
+        ------
+        KeyError
+            If the pattern does not have an identifier and is not queued for saving
+        """
+
+        with self.__lock:
+            if pattern.pattern_id is None:
+                position = next((position for position, new_pattern in enumerate(self.__new_patterns)
+                                 if new_pattern is pattern), None)
+                if position is None:
+                    raise KeyError(pattern.pattern_id)
+                del self.__new_patterns[position]
+                self.__forget(pattern)
+                return
+            self.__forget(self.__writes.get(pattern.pattern_id, (False, pattern))[1])
+            self.__writes[pattern.pattern_id] = (False, pattern)
+            self.__queued()
+
+    def get_version(self):
+        """
+        Flushes the queued writes and returns the version of the decorated context.
+
+        Returns
+        -------
+        int
+            Version of the saved pattern set
+        """
+
+        self.flush()
+        return self.context.get_version()
+
+    def flush(self):
+        """
+        Writes all queued writes to the decorated context, saves first and removals afterwards. If the decorated
+        context raises an exception, the writes that were not written stay queued.
+
+        Raises
+        ------
+        KeyError
+            If a queued removal refers to a pattern that is not saved in the database, the removal is discarded and
+            the removals that were not written stay queued
+        """
+
+        with self.__lock:
+            if not self.__writes and not self.__new_patterns:
+                return
+            started = time.perf_counter() if instrumentation.enabled else None
+            saved = self.__new_patterns + [pattern for save, pattern in self.__writes.values() if save]
+            removed = [pattern for save, pattern in self.__writes.values() if not save]
+            if saved:
+                self.context.save_patterns(saved)
+                self.__new_patterns = []
+                self.__queued_hashes, self.__hashes, self.__unhashed = {}, {}, {}
+                self.__writes = {pattern_id: write for pattern_id, write in self.__writes.items() if not write[0]}
+            if removed:
+                self.__remove(removed)
+            self.__writes = {}
+            self.__oldest_write = None
+            self.flushes += 1
+            if started is not None:
+                instrumentation.timing('db.flush', time.perf_counter() - started)
+                instrumentation.count('db.flushed_writes', len(saved) + len(removed))
+
+    def close(self):
+        """
+        Flushes the queued writes and stops the background flushing.
+        """
+
+        self.__stopped.set()
+        if self.__flusher is not None:
+            self.__flusher.join()
+            self.__flusher = None
+        self.flush()
+
+    def __remove(self, removed):
+        """
+        Removes the patterns from the decorated context and drops every written removal from the queue, called with
+        the lock held. The removal of an unsaved pattern can never succeed, it is dropped as well.
+        """
+
+        if type(self.context).remove_patterns is DbContext.remove_patterns:
+            # the removals are not transactional, the ones before a failing removal are written, so they are
+            # written one by one to know which of them succeeded
+            batches = [[pattern] for pattern in removed]
+        else:
+            batches = [removed]
+        for batch in batches:
+            try:
+                self.context.remove_patterns(batch)
+            except KeyError as error:
+                self.__writes.pop(error.args[0], None)
+                raise
+            for pattern in batch:
+                del self.__writes[pattern.pattern_id]
+
+    def __save(self, pattern):
+        """
+        Queues the pattern for saving, called with the lock held. A different pattern object queued with the same
+        identifier is replaced.
+        """
+
+        if pattern.pattern_id is None:
+            if self.__unhashed.get(id(pattern)) is not pattern and self.__hashes.get(id(pattern)) is None:
+                self.__new_patterns.append(pattern)
+            return
+        replaced = self.__writes.get(pattern.pattern_id)
+        if replaced is not None and replaced[1] is not pattern:
+            self.__forget(replaced[1])
+        self.__writes[pattern.pattern_id] = (True, pattern)
+
+    def __forget(self, pattern):
+        """
+        Drops the pattern from the canonical hashes of the queued saves, called with the lock held.
+        """
+
+        self.__unhashed.pop(id(pattern), None)
+        pattern_hash = self.__hashes.pop(id(pattern), None)
+        if pattern_hash is not None and self.__queued_hashes.get(pattern_hash) is pattern:
+            del self.__queued_hashes[pattern_hash]
+
+    def __hash_queued(self):
+        """
+        Hashes the saves queued since the last merge, called with the lock held. Patterns saved again after they were
+        hashed are hashed again, since they may have changed.
+        """
+
+        unhashed, self.__unhashed = self.__unhashed, {}
+        for pattern in unhashed.values():
+            self.__forget(pattern)
+            pattern_hash = canonical_hash(pattern)
+            self.__queued_hashes[pattern_hash] = pattern
+            self.__hashes[id(pattern)] = pattern_hash
+
+    def __find_merged(self, pattern_hash):
+        """
+        Returns the queued or saved pattern with the canonical hash, called with the lock held. A saved pattern with
+        a queued write is returned only as the queued pattern, since the queued write replaces it.
+        """
+
+        pattern = self.__queued_hashes.get(pattern_hash)
+        if pattern is not None:
+            return pattern
+        pattern = self.context.find_pattern(pattern_hash)
+        if pattern is not None and pattern.pattern_id in self.__writes:
+            return None
+        return pattern
+
+    def __queued(self):
+        """
+        Flushes the queued writes if the batch is full, called with the lock held after every queued write.
+        """
+
+        if self.__oldest_write is None:
+            self.__oldest_write = time.monotonic()
+        if len(self.__writes) + len(self.__new_patterns) >= self.batch_size:
+            self.flush()
+
+    def __flush_periodically(self):
+        """
+        Flushes the writes that stayed queued for longer than the flush interval until the context is closed.
+        """
+
+        while not self.__stopped.wait(self.flush_interval / 2):
+            oldest_write = self.__oldest_write
+            if oldest_write is None or time.monotonic() - oldest_write < self.flush_interval:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing queued pattern writes failed, they stay queued')
+
+
+def _merge_duplicates(patterns, find_pattern):
+    """
+    Merges the duplicates among the patterns and the saved patterns by adding their occurrences together.
+
+    Parameters
+    ----------
+    patterns : iterable of Pattern
+        Patterns that are going to be saved
+    find_pattern : callable
+        Function that returns the saved pattern with the received canonical hash, or None
+
+    Returns
+    -------
+    list of Pattern, dict
+        For every received pattern the pattern it is saved as, and the patterns that need to be written by their
+        canonical hashes
+    """
+
+    stored, merged = [], {}
+    for pattern in patterns:
+        pattern_hash = canonical_hash(pattern)
+        target = merged.get(pattern_hash)
+        if target is None:
+            target = find_pattern(pattern_hash)
+        if target is None or target is pattern or \
+                (pattern.pattern_id is not None and target.pattern_id == pattern.pattern_id):
+            # a new pattern, or a saved pattern that is saved again
+            target = pattern
+        else:
+            target.occurrences += pattern.occurrences
+        merged[pattern_hash] = target
+        stored.append(target)
+    return stored, merged
@@ -0,0 +1,310 @@
+import ast
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from . import instrumentation
+from .ast_encoding import UNKNOWN
+from .ast_utils import node_label, preorder_with_ends
+
+
+class ASTParser:
+    """
+    This class is responsible for transforming source code into AST. If a normalizer is set, every parsed AST is
+    normalized, the same parser needs to be used for patterns and for the uploaded code.
+
+    ...
+
+    Attributes
+    ----------
+    feature_version : (int, int)
+        Python grammar version used for parsing, None for the grammar of the running interpreter
+    normalizer : ASTNormalizer
+        Normalizer applied to every parsed AST, None if ASTs are not normalized
+
+    Methods
+    -------
+    public __init__(self, feature_version, normalizer)
+        Initialises ASTParser object.
+    public ast parse(self, source)
+        Parses the source code into AST.
+    """
+
+    def __init__(self, feature_version=None, normalizer=None):
+        """
+        Initialises ASTParser object.
+
+        Parameters
+        ----------
+        feature_version : (int, int), optional
+            Python grammar version used for parsing (default is None, the grammar of the running interpreter)
+        normalizer : ASTNormalizer, optional
+            Normalizer applied to every parsed AST (default is None)
+        """
+
+        self.feature_version = feature_version
+        self.normalizer = normalizer
+
+    def parse(self, source):
+        """
+        Parses the source code into AST.
+
+        Parameters
+        ----------
+        source : str
+            Source code
+
+        Returns
+        -------
+        ast
+            AST of the source code
+        """
+
+        tree = ast.parse(source, feature_version=self.feature_version)
+        return self.normalizer.normalize(tree) if self.normalizer is not None else tree
+
+
+class ParsedSource:
+    """
+    This class holds the parsed source code together with the data derived from its AST that
+    is needed for matching and comparing. Parsed sources are shared by all users of the cache,
+    so neither the AST nor the derived data may be modified.
+
+    ...
+
+    Attributes
+    ----------
+    tree : ast
+        AST of the source code
+    normalized : str
+        Dump of the AST without positions in the source code, equal for ASTs with equal structure
+    nodes : list of ast
+        Nodes of the AST in preorder
+    ends : list of int
+        For every node, the preorder index that follows the last node of its subtree
+    subtree_hashes : list of int
+        For every node, the structural hash of its subtree
+    memory_size : int
+        Estimated memory footprint in bytes
+
+    Methods
+    -------
+    public __init__(self, tree)
+        Initialises ParsedSource object and derives all data from the AST.
+    public array tokens(self, vocabulary)
+        Returns the tokens of the nodes encoded by the vocabulary.
+    """
+
+    def __init__(self, tree):
+        """
+        Initialises ParsedSource object and derives all data from the AST.
+
+        Parameters
+        ----------
+        tree : ast
+            AST of the source code
+        """
+
+        self.tree = tree
+        self.normalized = ast.dump(tree, include_attributes=False)
+        self.nodes, self.ends = preorder_with_ends(tree)
+
+        self.subtree_hashes = [0] * len(self.nodes)
+        for index in range(len(self.nodes) - 1, -1, -1):
+            children = []
+            child = index + 1
+            while child < self.ends[index]:
+                children.append(self.subtree_hashes[child])
+                child = self.ends[child]
+            self.subtree_hashes[index] = hash((node_label(self.nodes[index]), tuple(children)))
+
+        node_size = sum(sys.getsizeof(node) + sys.getsizeof(node.__dict__) for node in self.nodes)
+        self.memory_size = (node_size + sys.getsizeof(self.normalized) + sys.getsizeof(self.nodes)
+                            + sys.getsizeof(self.ends) + sys.getsizeof(self.subtree_hashes))
+        # vocabulary, its size when the tokens were encoded and the tokens
+        self.__tokens = (None, 0, None)
+
+    def tokens(self, vocabulary):
+        """
+        Returns the tokens of the nodes encoded by the vocabulary. The tokens are cached, if the vocabulary has grown
+        since they were encoded, only the nodes that were unknown to it are encoded again.
+
+        Parameters
+        ----------
+        vocabulary : TokenVocabulary
+            Vocabulary of the loaded patterns
+
+        Returns
+        -------
+        array
+            Tokens of the nodes in preorder, they must not be modified
+        """
+
+        cached_vocabulary, size, tokens = self.__tokens
+        if cached_vocabulary is not vocabulary:
+            size, tokens = len(vocabulary), vocabulary.encode(self.nodes)
+        elif size != len(vocabulary):
+            size, tokens = len(vocabulary), tokens[:]
+            for index, token in enumerate(tokens):
+                if token == UNKNOWN:
+                    tokens[index] = vocabulary.token(self.nodes[index])
+        else:
+            return tokens
+        self.__tokens = (vocabulary, size, tokens)
+        return tokens
+
+
+class CachingASTParser(ASTParser):
+    """
+    This class is an ASTParser with a bounded LRU cache of parsed sources. Sources are identified
+    by the hash of their content and the grammar version, so repeated uploads of the same code
+    are parsed only once. The cache is bounded both by the number of entries and by their
+    estimated memory footprint. ASTs returned by the cache are shared and must not be modified.
+
+    ...
+
+    Attributes
+    ----------
+    feature_version : (int, int)
+        Python grammar version used for parsing, None for the grammar of the running interpreter
+    normalizer : ASTNormalizer
+        Normalizer applied to every parsed AST before it is cached, None if ASTs are not normalized
+    max_entries : int
+        Maximum number of cached sources
+    max_memory : int
+        Maximum estimated memory footprint of all cached sources in bytes
+    hits : int
+        Number of sources found in the cache
+    misses : int
+        Number of sources that had to be parsed
+    evictions : int
+        Number of sources removed from the cache to make room for new ones
+    memory_size : int
+        Estimated memory footprint of all cached sources in bytes
+
+    Methods
+    -------
+    public __init__(self, feature_version, max_entries, max_memory, normalizer)
+        Initialises CachingASTParser object.
+    public ast parse(self, source)
+        Returns the AST of the source code.
+    public ParsedSource parse_source(self, source)
+        Returns the parsed source code together with its derived data.
+    public dict stats(self)
+        Returns the statistics of the cache.
+    public void clear(self)
+        Removes all sources from the cache.
+    """
+
+    def __init__(self, feature_version=None, max_entries=256, max_memory=256 * 1024 * 1024, normalizer=None):
+        """
+        Initialises CachingASTParser object.
+
+        Parameters
+        ----------
+        feature_version : (int, int), optional
+            Python grammar version used for parsing (default is None, the grammar of the running interpreter)
+        max_entries : int, optional
+            Maximum number of cached sources (default is 256)
+        max_memory : int, optional
+            Maximum estimated memory footprint of all cached sources in bytes (default is 256 MiB)
+        normalizer : ASTNormalizer, optional
+            Normalizer applied to every parsed AST before it is cached (default is None)
+        """
+
+        super().__init__(feature_version, normalizer)
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__grammar = feature_version if feature_version is not None else sys.version_info[:2]
+
+    def parse(self, source):
+        """
+        Returns the AST of the source code.
+
+        Parameters
+        ----------
+        source : str
+            Source code
+
+        Returns
+        -------
+        ast
+            AST of the source code, shared with other users of the cache
+        """
+
+        return self.parse_source(source).tree
+
+    def parse_source(self, source):
+        """
+        Returns the parsed source code together with its derived data.
+
+        Parameters
+        ----------
+        source : str
+            Source code
+
+        Returns
+        -------
+        ParsedSource
+            Parsed source code, shared with other users of the cache
+        """
+
+        data = source.encode('utf-8') if isinstance(source, str) else source
+        key = (hashlib.blake2b(data, digest_size=20).digest(), self.__grammar)
+        with self.__lock:
+            parsed = self.__entries.get(key)
+            if parsed is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if instrumentation.enabled:
+            instrumentation.count('parse_cache.hit' if parsed is not None else 'parse_cache.miss')
+        if parsed is not None:
+            return parsed
+
+        started = time.perf_counter() if instrumentation.enabled else None
+        parsed = ParsedSource(super().parse(source))
+        with self.__lock:
+            if key not in self.__entries:
+                self.__entries[key] = parsed
+                self.memory_size += parsed.memory_size
+                while len(self.__entries) > 1 and (len(self.__entries) > self.max_entries
+                                                   or self.memory_size > self.max_memory):
+                    _, evicted = self.__entries.popitem(last=False)
+                    self.memory_size -= evicted.memory_size
+                    self.evictions += 1
+        if started is not None:
+            instrumentation.timing('parse_cache.parse', time.perf_counter() - started)
+        return parsed
+
+    def stats(self):
+        """
+        Returns the statistics of the cache.
+
+        Returns
+        -------
+        dict
+            Number of entries, estimated memory footprint, hits, misses and evictions
+        """
+
+        with self.__lock:
+            return {'entries': len(self.__entries), 'memory_size': self.memory_size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        """
+        Removes all sources from the cache.
+        """
+
+        with self.__lock:
+            self.__entries.clear()
+            self.memory_size = 0
@@ -0,0 +1,134 @@
+import ast
+import copy
+import inspect
+import random
+import textwrap
+
+import pytest
+
+from . import instrumentation
+from .pattern import Delete, EditScript, Insert, Move, Update
+from .pattern_creation import EditScriptGenerator, TreeDifferencer
+
+# original and modified code of the edits every operation type is generated for
+EDITS = [
+    ('x = 1\n', 'x = 2\n'),
+    ('x = 1\n', 'x = 1\ny = 2\n'),
+    ('x = 1\ny = 2\n', 'y = 2\n'),
+    ('a = 1\nb = 2\nc = 3\n', 'c = 3\na = 1\nb = 2\n'),
+    ('def f(a):\n    return a + 1\n', 'def f(a, b):\n    return a + b\n'),
+    ('if x:\n    y = f(x)\n', 'y = f(x)\nif x:\n    pass\n'),
+    ('for i in range(10):\n    total += i\n', 'total = sum(range(10))\n'),
+    ('class A:\n    def f(self):\n        return 1\n\n    def g(self):\n        return 2\n',
+     'class A:\n    def g(self):\n        return 2\n\n    def f(self):\n        return 1\n'),
+]
+
+
+def _apply(edit_script, tree):
+    tree = copy.deepcopy(tree)
+    for change in edit_script:
+        tree = change.make_change(tree)
+    return tree
+
+
+def _mutate(tree, random_state):
+    bodies = [node.body for node in ast.walk(tree)
+              if isinstance(getattr(node, 'body', None), list) and node.body and isinstance(node.body[0], ast.stmt)]
+    for _ in range(random_state.randint(1, 4)):
+        body = random_state.choice(bodies)
+        kind = random_state.randrange(5)
+        if kind == 0 and len(body) > 1:
+            first, second = random_state.sample(range(len(body)), 2)
+            body[first], body[second] = body[second], body[first]
+        elif kind == 1 and len(body) > 1:
+            body.pop(random_state.randrange(len(body)))
+        elif kind == 2:
+            body.insert(random_state.randrange(len(body) + 1), ast.parse('x = compute(1, 2)').body[0])
+        elif kind == 3:
+            names = [node for node in ast.walk(tree) if isinstance(node, ast.Name)]
+            if names:
+                random_state.choice(names).id = 'renamed'
+        elif kind == 4 and len(body) > 1:
+            other = random_state.choice(bodies)
+            other.insert(random_state.randrange(len(other) + 1), body.pop(random_state.randrange(len(body))))
+    return ast.parse(ast.unparse(tree))
+
+
+@pytest.mark.parametrize('original, modified', EDITS)
+def test_edit_script_transforms_original_to_modified(original, modified):
+    first_ast, second_ast = ast.parse(original), ast.parse(modified)
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(first_ast, second_ast)
+
+    assert ast.dump(_apply(edit_script, first_ast)) == ast.dump(second_ast)
+
+
+def test_edit_script_uses_every_operation_type():
+    generator = EditScriptGenerator(TreeDifferencer())
+    types = set()
+    for original, modified in EDITS:
+        types.update(type(change) for change in generator.generate(ast.parse(original), ast.parse(modified)))
+
+    assert types == {Insert, Delete, Update, Move}
+
+
+def test_identical_asts_need_no_changes():
+    tree = ast.parse(inspect.getsource(textwrap))
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(tree, copy.deepcopy(tree))
+
+    assert not edit_script.materialize()
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_edit_script_transforms_mutated_module(seed):
+    random_state = random.Random(seed)
+    functions = [node for node in ast.parse(inspect.getsource(textwrap)).body
+                 if isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    first_ast = ast.parse(ast.unparse(ast.Module(body=random_state.sample(functions, 3), type_ignores=[])))
+    second_ast = _mutate(copy.deepcopy(first_ast), random_state)
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(first_ast, second_ast)
+
+    assert ast.dump(_apply(edit_script, first_ast)) == ast.dump(second_ast)
+
+
+def test_parallel_generation_transforms_original_to_modified():
+    first_ast = ast.parse(inspect.getsource(textwrap))
+    second_ast = copy.deepcopy(first_ast)
+    for node in ast.walk(second_ast):
+        if isinstance(node, ast.FunctionDef) and node.body and isinstance(node.body[-1], ast.Return):
+            node.body.insert(len(node.body) - 1, ast.parse('log(1)').body[0])
+    second_ast = ast.parse(ast.unparse(second_ast))
+    aggregator = instrumentation.InMemoryAggregator()
+    instrumentation.add_sink(aggregator)
+    try:
+        edit_script = EditScriptGenerator(TreeDifferencer(), processes=2).generate(first_ast, second_ast)
+    finally:
+        instrumentation.remove_sink(aggregator)
+
+    assert aggregator.counters['pattern_creator.parallel_methods'] > 1
+    assert ast.dump(_apply(edit_script, first_ast)) == ast.dump(second_ast)
+
+
+def test_lazy_edit_script_is_produced_on_demand():
+    first_ast, second_ast = ast.parse('a = 1\nb = 2\n'), ast.parse('b = 3\nc = 4\na = 1\n')
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(first_ast, second_ast)
+    first_change = edit_script.get(0)
+
+    assert edit_script.changes == [first_change]
+    assert ast.dump(_apply(edit_script, first_ast)) == ast.dump(second_ast)
+    assert isinstance(EditScript(operations=iter(edit_script.changes)).get(-1), type(edit_script.changes[-1]))
+
+
+def test_lazy_edit_script_produces_only_requested_operations():
+    produced = []
+
+    def operations():
+        for index in range(5):
+            produced.append(index)
+            yield Delete(index)
+
+    edit_script = EditScript(operations=operations())
+    for _ in range(5):
+        edit_script.get(0)
+
+    assert produced == [0]
+    assert [change.index for change in edit_script] == list(range(5)) and produced == list(range(5))
@@ -0,0 +1,199 @@
+import argparse
+import ast
+import copy
+import inspect
+import io
+import random
+
+import pytest
+
+from .ast_encoding import TokenVocabulary
+from .ast_utils import preorder
+from .pattern import EditScript, Pattern, Wildcard
+from .pattern_loading import PatternFactoryLoader, PatternSetHandle
+from .pattern_matching import MIN_PARALLEL_NODES, PatternFactoryListener, Recommender
+from .pattern_parsing import CollectingPatternParser
+from .pattern_sharing import SharedPatternFactoryListener, SharedPatternTable
+from .pattern_snapshot import PatternSnapshot
+from .pattern_storage import InMemoryDbContext
+
+# uploaded code of the matching tests
+UPLOADED = 'x = 1\ny = 2\nx = f(a)\nprint(x, y)\n'
+
+# uploaded code with top-level compound statements whose clauses start at the indentation of the statement
+COMPOUND_STATEMENTS = [
+    'try:\n    x = 1\nexcept ValueError:\n    y = 2\nexcept TypeError:\n    pass\nelse:\n    pass\n'
+    '# comment\nfinally:\n    print(x, y)\nx = 1\n',
+    'try:\n    x = 1\nexcept* ValueError:\n    y = 2\nprint(x, y)\n',
+    'if x:\n    y = 2\nelif y:\n    x = 1\nelse:\n    print(x, y)\nfor x in y:\n    pass\nelse:\n    y = 2\n'
+    'while x:\n    pass\nelse:\n    x = f(a)\n',
+]
+
+
+def _pattern(source, pattern_id, wildcard_field=None):
+    original = ast.parse(source)
+    if wildcard_field is not None:
+        setattr(original.body[0], wildcard_field, Wildcard())
+    return Pattern(original, copy.deepcopy(original), EditScript([]), pattern_id)
+
+
+def _matches(parser):
+    return [(matcher.pattern.pattern_id, matcher.start, matcher.end,
+             [ast.dump(node) for node in matcher.wildcard_matches]) for matcher in parser.output]
+
+
+def _recommend(patterns, uploaded_ast, vocabulary=None, processes=1):
+    parser = CollectingPatternParser()
+    recommender = Recommender(parser, uploaded_ast, vocabulary=vocabulary, processes=processes)
+    for pattern in patterns:
+        recommender.subscribe(PatternFactoryListener(pattern, recommender, vocabulary))
+    recommender.get_recommendations()
+    return _matches(parser)
+
+
+def _stream(patterns, source, vocabulary=None):
+    parser = CollectingPatternParser()
+    recommender = Recommender(parser, vocabulary=vocabulary)
+    for pattern in patterns:
+        recommender.subscribe(PatternFactoryListener(pattern, recommender, vocabulary))
+    recommender.stream_recommendations(io.StringIO(source))
+    return _matches(parser)
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    """
+    Uploaded module large enough to be matched in worker processes, patterns cut from it and their matches found
+    without tokens in this process. Some patterns have wildcards, a few of them span two statements and one is a
+    single wildcard.
+    """
+
+    source = inspect.getsource(argparse)
+    uploaded_ast = ast.parse(source)
+    statements = [node for node in preorder(uploaded_ast) if isinstance(node, ast.stmt)]
+    random_state = random.Random(1)
+    patterns = []
+    for pattern_id in range(200):
+        if random_state.random() < 0.1:
+            index = random_state.randrange(len(uploaded_ast.body) - 1)
+            body = copy.deepcopy(uploaded_ast.body[index:index + 2])
+        else:
+            body = [copy.deepcopy(random_state.choice(statements))]
+        original = ast.Module(body=body, type_ignores=[])
+        fields = [(parent, field) for parent in ast.walk(original) for field, value in ast.iter_fields(parent)
+                  if isinstance(value, ast.expr)]
+        if fields and random_state.random() < 0.5:
+            parent, field = random_state.choice(fields)
+            setattr(parent, field, Wildcard())
+        patterns.append(Pattern(original, original, EditScript([]), pattern_id))
+    patterns.append(Pattern(ast.Module(body=[Wildcard()], type_ignores=[]), None, EditScript([]), 200))
+    return source, uploaded_ast, patterns, _recommend(patterns, uploaded_ast)
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_matches(vocabulary):
+    patterns = [_pattern('y = 2', 0), _pattern('x = 1', 1, 'value'), _pattern('print(x)', 2),
+                _pattern('print(x, y)', 3), _pattern('x = 1\ny = 2', 4)]
+
+    assert _recommend(patterns, ast.parse(UPLOADED), vocabulary) == [
+        (1, 1, 4, ['Constant(value=1)']),
+        (4, 1, 8, []),
+        (0, 5, 8, []),
+        (1, 9, 12, ["Call(func=Name(id='f', ctx=Load()), args=[Name(id='a', ctx=Load())], keywords=[])"]),
+        (3, 17, 24, []),
+    ]
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_lists_of_other_length_do_not_match(vocabulary):
+    patterns = [_pattern('print(x)', 0), _pattern('def f(a):\n    pass', 1), _pattern('[x, y]', 2)]
+    uploaded_ast = ast.parse('print(x, y)\ndef f(a, b):\n    pass\n[x, y, z]\n')
+
+    assert _recommend(patterns, uploaded_ast, vocabulary) == []
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_wildcard_pattern_matches_every_node(vocabulary):
+    pattern = Pattern(ast.Module(body=[Wildcard()], type_ignores=[]), None, EditScript([]), 0)
+    uploaded_ast = ast.parse(UPLOADED)
+
+    assert _recommend([pattern], uploaded_ast, vocabulary) == [
+        (0, index, index, [ast.dump(node)]) for index, node in enumerate(preorder(uploaded_ast))]
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_parallel_matching_equals_serial_matching(corpus, vocabulary):
+    _, uploaded_ast, patterns, serial = corpus
+    assert sum(1 for _ in preorder(uploaded_ast)) >= MIN_PARALLEL_NODES
+
+    assert len(serial) > len(patterns)
+    assert _recommend(patterns, uploaded_ast, vocabulary) == serial
+    assert _recommend(patterns, uploaded_ast, vocabulary, processes=3) == serial
+
+
+def test_pattern_set_handle_reloads_new_versions():
+    context = InMemoryDbContext([_pattern('y = 2', None)])
+    handle = PatternSetHandle(PatternFactoryLoader(context))
+    first = handle.current()
+
+    assert not handle.reload() and handle.current() is first
+    context.save_pattern(_pattern('print(x, y)', None))
+    assert handle.reload()
+
+    for pattern_set, expected in ((first, [(0, 5, 8, [])]), (handle.current(), [(0, 5, 8, []), (1, 17, 24, [])])):
+        parser = CollectingPatternParser()
+        pattern_set.create_recommender(parser, ast.parse(UPLOADED)).get_recommendations()
+        assert _matches(parser) == expected
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_streaming_matching_equals_serial_matching(corpus, vocabulary):
+    source, _, patterns, serial = corpus
+
+    # the module node is never built while streaming, so the single wildcard pattern does not match it
+    assert _stream(patterns, source, vocabulary) == [match for match in serial if match[1] != 0]
+
+
+@pytest.mark.parametrize('source', COMPOUND_STATEMENTS, ids=['try', 'try-star', 'if'])
+def test_streaming_keeps_clauses_with_their_statement(source):
+    patterns = [_pattern('y = 2', 0), _pattern('x = 1', 1, 'value'), _pattern('print(x, y)', 2),
+                Pattern(ast.Module(body=[Wildcard()], type_ignores=[]), None, EditScript([]), 3)]
+    serial = _recommend(patterns, ast.parse(source))
+
+    assert len(serial) > len(patterns)
+    assert _stream(patterns, source) == [match for match in serial if match[1] != 0]
+
+
+@pytest.mark.parametrize('vocabulary', [None, TokenVocabulary()], ids=['checks', 'tokens'])
+def test_snapshot_matching_equals_serial_matching(corpus, tmp_path, vocabulary):
+    _, uploaded_ast, patterns, serial = corpus
+    path = str(tmp_path / 'patterns.snapshot')
+    PatternSnapshot(patterns, 1).save(path)
+    parser = CollectingPatternParser()
+    recommender = Recommender(parser, uploaded_ast, vocabulary=vocabulary)
+    for factory in PatternSnapshot.load(path).factories(vocabulary):
+        recommender.subscribe(factory.bind(recommender))
+    recommender.get_recommendations()
+
+    assert _matches(parser) == serial
+
+
+def test_shared_table_matching_equals_serial_matching(corpus):
+    _, uploaded_ast, patterns, serial = corpus
+    table = SharedPatternTable.create(patterns, 1)
+    try:
+        attached = SharedPatternTable.attach(table.name)
+        try:
+            parser = CollectingPatternParser()
+            recommender = Recommender(parser, uploaded_ast)
+            for index in range(len(attached)):
+                recommender.subscribe(SharedPatternFactoryListener(attached, index, recommender))
+            recommender.get_recommendations()
+            matches = _matches(parser)
+        finally:
+            attached.close()
+    finally:
+        table.close()
+        table.unlink()
+
+    assert matches == serial
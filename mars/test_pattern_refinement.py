@@ -0,0 +1,92 @@
+import ast
+import copy
+
+import pytest
+
+from .pattern import EditScript, Pattern, Wildcard
+from .pattern_creation import EditScriptGenerator, TreeDifferencer
+from .pattern_refinement import (ChangeIsolator, EditScriptOptimiser, MatchInserter, ParallelPatternRefiner,
+                                 PatternRefiner)
+from .pattern_storage import InMemoryDbContext
+
+# original code of the refined patterns, only the first and the last one are equal
+SOURCES = ['x = f(1)', 'y = g(2, 3)', 'while True:\n    break', 'import os', 'x = f(1)']
+
+# original and modified code of the generalised patterns, the first three are instances of the same change
+EDITS = [('x = f(1)', 'x = f(2)'), ('y = g(1)', 'y = g(2)'), ('z = h.k(1)', 'z = h.k(2)'), ('x = f(1)', 'x = f(3)'),
+         ('while a:\n    b(1)', 'while a:\n    b(2)')]
+
+
+def _pattern(original_source, modified_source):
+    original, modified = ast.parse(original_source), ast.parse(modified_source)
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(copy.deepcopy(original), modified)
+    return Pattern(original, modified, EditScript(edit_script.materialize()))
+
+
+def _apply(pattern):
+    tree = copy.deepcopy(pattern.original)
+    for change in pattern.edit_script:
+        tree = change.make_change(tree)
+    return tree
+
+
+@pytest.mark.parametrize('refiner', [PatternRefiner, ParallelPatternRefiner])
+def test_refinement_merges_only_equal_patterns(refiner):
+    context = InMemoryDbContext([Pattern(ast.parse(source), ast.parse(source), EditScript([])) for source in SOURCES])
+    refiner(context).refine()
+
+    assert [(ast.unparse(pattern.original), pattern.occurrences) for pattern in context.load_patterns()] == [
+        ('x = f(1)', 2), ('y = g(2, 3)', 1), ('while True:\n    break', 1), ('import os', 1)]
+
+
+@pytest.mark.parametrize('refiner', [PatternRefiner, ParallelPatternRefiner])
+def test_refinement_generalises_instances_of_the_same_change(refiner):
+    context = InMemoryDbContext([_pattern(*edit) for edit in EDITS])
+    refiner(context).refine()
+    patterns = context.load_patterns()
+
+    generalised = Pattern(ast.parse('_ = _(1)'), ast.parse('_ = _(2)'), None)
+    for tree in (generalised.original, generalised.modified):
+        tree.body[0].targets[0] = Wildcard()
+        tree.body[0].value.func = Wildcard()
+    assert [(ast.dump(pattern.original), ast.dump(pattern.modified), pattern.occurrences) for pattern in patterns] == [
+        (ast.dump(generalised.original), ast.dump(generalised.modified), 3),
+        (ast.dump(ast.parse(EDITS[3][0])), ast.dump(ast.parse(EDITS[3][1])), 1),
+        (ast.dump(ast.parse(EDITS[4][0])), ast.dump(ast.parse(EDITS[4][1])), 1)]
+    assert all(ast.dump(_apply(pattern)) == ast.dump(pattern.modified) for pattern in patterns)
+
+
+def test_wildcards_keep_the_touched_nodes():
+    first = _pattern('foo(a, 1)\nbar()', 'foo(a, 1)\nbar(x)')
+    second = _pattern('foo(b.c, 1)\nbaz()', 'foo(b.c, 1)\nbaz(x)')
+    refiner = PatternRefiner(InMemoryDbContext([]))
+    refiner.add_wildcards(first, second)
+    refiner.add_uses(first, second)
+
+    assert refiner.connect_wildcards_and_uses(first, second)
+    assert ast.dump(first.original) == ast.dump(ast.Module(
+        body=[Wildcard(), ast.Expr(value=ast.Call(func=Wildcard(), args=[], keywords=[]))], type_ignores=[]))
+    assert [str(change) for change in first.edit_script] == ['Insert x into 3.args[0]']
+    assert ast.dump(_apply(first)) == ast.dump(first.modified)
+
+
+def test_different_changes_are_not_generalised():
+    first, second = _pattern(*EDITS[0]), _pattern(*EDITS[3])
+    originals = [ast.dump(pattern.original) for pattern in (first, second)]
+    refiner = PatternRefiner(InMemoryDbContext([]))
+    refiner.add_wildcards(first, second)
+    refiner.add_uses(first, second)
+
+    assert not refiner.connect_wildcards_and_uses(first, second)
+    assert [ast.dump(pattern.original) for pattern in (first, second)] == originals
+
+
+def test_optimiser_chain_skips_unchanged_scripts():
+    first, second = _pattern(*EDITS[0]), _pattern(*EDITS[3])
+    matcher = MatchInserter(EditScriptOptimiser())
+    isolator = ChangeIsolator(matcher)
+    for _ in range(3):
+        isolator.optimise(first, second)
+
+    assert (isolator.stats.calls, isolator.stats.changes, isolator.stats.skips) == (3, 0, 2)
+    assert matcher.stats.calls == 1
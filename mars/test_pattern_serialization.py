@@ -0,0 +1,95 @@
+import ast
+import inspect
+import marshal
+import textwrap
+
+import pytest
+
+from . import pattern_serialization
+from .ast_normalization import ASTNormalizer, restore_original
+from .pattern import Delete, EditScript, Insert, Move, Pattern, Update, Wildcard
+from .pattern_creation import EditScriptGenerator, TreeDifferencer
+
+
+def _dump(tree):
+    return ast.dump(tree, include_attributes=True)
+
+
+@pytest.mark.parametrize('source', [
+    'x = 1',
+    'def f(a, *args, b=2, **kwargs):\n    return a[1:2, ...] @ b\n',
+    'async def f():\n    async with a as b:\n        await c\n',
+    'x = 1j + 2.5 - 0x10 + -0.0\ny = b"bytes" if not None else f"{x!r:>10}"\n',
+    'class A(B, metaclass=M):\n    x: int = 1\n',
+    'match x:\n    case [1, *rest] | {"a": 1}:\n        pass\n',
+])
+def test_ast_round_trip(source):
+    tree = ast.parse(source)
+
+    assert _dump(pattern_serialization.loads(pattern_serialization.dumps(tree))) == _dump(tree)
+
+
+def test_module_round_trip():
+    tree = ast.parse(inspect.getsource(textwrap))
+
+    assert _dump(pattern_serialization.loads(pattern_serialization.dumps(tree))) == _dump(tree)
+
+
+def test_deeply_nested_ast_round_trip():
+    tree = ast.parse(' + '.join(['a'] * 1000))
+    loaded = pattern_serialization.loads(pattern_serialization.dumps(tree))
+
+    # ast.dump itself recurses too deep for this AST, so the nodes are compared one by one
+    assert [type(node) for node in ast.walk(loaded)] == [type(node) for node in ast.walk(tree)]
+
+
+def test_pattern_round_trip():
+    original, modified = ast.parse('x = f(1)\ny = 2'), ast.parse('x = g(1)\nz = 3')
+    original.body[1].value = Wildcard()
+    changes = [Insert(2, ast.parse('z = 3').body[0]), Delete(1), Update(3, ast.Name(id='g', ctx=ast.Load())),
+               Move(4, 0, 'body', 1)]
+    pattern = Pattern(original, modified, EditScript(changes), 7, 3)
+    loaded = pattern_serialization.loads(pattern_serialization.dumps({'patterns': [pattern], 'score': 1.5}))
+    loaded_pattern = loaded['patterns'][0]
+
+    assert loaded['score'] == 1.5
+    assert (loaded_pattern.pattern_id, loaded_pattern.occurrences) == (7, 3)
+    assert isinstance(loaded_pattern.original.body[1].value, Wildcard)
+    assert _dump(loaded_pattern.original) == _dump(original) and _dump(loaded_pattern.modified) == _dump(modified)
+    assert [str(change) for change in loaded_pattern.edit_script] == [str(change) for change in changes]
+
+
+def test_lazy_edit_script_round_trip():
+    first_ast, second_ast = ast.parse('a = 1\nb = 2\n'), ast.parse('b = 3\nc = 4\na = 1\n')
+    edit_script = EditScriptGenerator(TreeDifferencer()).generate(first_ast, second_ast)
+    loaded = pattern_serialization.loads(pattern_serialization.dumps(edit_script))
+
+    assert [str(change) for change in loaded] == [str(change) for change in edit_script.materialize()]
+
+
+def test_normalized_ast_round_trip():
+    tree = ast.parse('def f(a):\n    return a + 1\n')
+    loaded = pattern_serialization.loads(pattern_serialization.dumps(ASTNormalizer().normalize(tree)))
+
+    assert _dump(loaded) == _dump(tree)
+    assert ast.unparse(restore_original(loaded)) == 'def f(a):\n    return a + 1'
+
+
+def test_unserializable_objects_are_rejected():
+    with pytest.raises(TypeError):
+        pattern_serialization.dumps([1, object()])
+
+
+@pytest.mark.parametrize('entry', [(2, 'builtins.eval', ()), (0, 'walk', (), ())], ids=['object', 'node'])
+def test_unregistered_classes_are_rejected(entry):
+    data = marshal.dumps((pattern_serialization.FORMAT_VERSION, [entry], [], bytes(4), b''))
+
+    with pytest.raises(ValueError):
+        pattern_serialization.loads(data)
+
+
+@pytest.mark.parametrize('data', [marshal.dumps((pattern_serialization.FORMAT_VERSION + 1, [], [], b'', b'')),
+                                  b'not serialized'], ids=['version', 'garbage'])
+def test_other_formats_are_rejected(data):
+    with pytest.raises(ValueError):
+        pattern_serialization.loads(data)
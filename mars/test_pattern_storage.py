@@ -0,0 +1,209 @@
+import ast
+
+import pytest
+
+from .pattern import Delete, EditScript, Insert, Pattern, canonical_hash, edit_signature
+from .pattern_storage import BatchingDbContext, InMemoryDbContext, SqliteDbContext
+
+
+def _pattern(original, modified, changes=None):
+    return Pattern(ast.parse(original), ast.parse(modified), EditScript(changes if changes is not None else []))
+
+
+def _ids(patterns):
+    return [pattern.pattern_id for pattern in patterns]
+
+
+@pytest.fixture(params=['in_memory', 'sqlite', 'batching_in_memory', 'batching_sqlite'])
+def context(request, tmp_path):
+    """
+    Every DbContext implementation, the batching context flushes only when it is read from or flushed explicitly.
+    """
+
+    if request.param == 'in_memory':
+        yield InMemoryDbContext()
+        return
+    contexts = [InMemoryDbContext() if request.param == 'batching_in_memory' else
+                SqliteDbContext(str(tmp_path / 'patterns.db'))]
+    if request.param.startswith('batching'):
+        contexts.append(BatchingDbContext(contexts[0], batch_size=1000, flush_interval=None))
+    yield contexts[-1]
+    for opened in reversed(contexts):
+        if hasattr(opened, 'close'):
+            opened.close()
+
+
+def test_saved_patterns_get_identifiers_and_are_loaded(context):
+    patterns = [_pattern('x = 1', 'x = 2'), _pattern('f()', 'g()'), _pattern('y = 1', 'y = 1')]
+    context.save_patterns(patterns[:2])
+    context.save_pattern(patterns[2])
+    loaded = context.load_patterns()
+
+    assert None not in _ids(patterns) and len(set(_ids(patterns))) == 3
+    assert _ids(loaded) == sorted(_ids(patterns))
+    assert [ast.dump(pattern.original) for pattern in loaded] == [ast.dump(pattern.original) for pattern in patterns]
+
+
+def test_saving_a_saved_pattern_replaces_it(context):
+    pattern = _pattern('x = 1', 'x = 2')
+    context.save_pattern(pattern)
+    # the batching context assigns identifiers only when the writes are flushed by a read
+    pattern_id = context.load_patterns()[0].pattern_id
+    pattern.occurrences = 5
+    context.save_pattern(pattern)
+    loaded = context.load_patterns()
+
+    assert pattern.pattern_id == pattern_id
+    assert _ids(loaded) == [pattern_id] and loaded[0].occurrences == 5
+
+
+def test_version_changes_with_every_write(context):
+    versions = [context.get_version()]
+    pattern = _pattern('x = 1', 'x = 2')
+    context.save_pattern(pattern)
+    versions.append(context.get_version())
+    context.remove_pattern(pattern)
+    versions.append(context.get_version())
+
+    assert len(set(versions)) == 3
+
+
+def test_patterns_are_filtered(context):
+    assign = _pattern('x = 1', 'x = 2')
+    insert = _pattern('x = 1', 'x = 1\ny = 2', [Insert(1, ast.parse('y = 2').body[0])])
+    call = _pattern('f()', 'g()')
+    context.save_patterns([assign, insert])
+    version = context.get_version()
+    context.save_pattern(call)
+
+    assert _ids(context.iter_patterns(root_type='Assign')) == _ids([assign, insert])
+    assert _ids(context.iter_patterns(signature=edit_signature(insert))) == _ids([insert])
+    assert _ids(context.iter_patterns(root_type='Expr', signature=edit_signature(insert))) == []
+    assert _ids(context.iter_patterns(since_version=version)) == _ids([call])
+
+
+def test_patterns_are_found_by_canonical_hash(context):
+    pattern = _pattern('x = 1', 'x = 2')
+    context.save_pattern(pattern)
+
+    assert context.find_pattern(canonical_hash(pattern)).pattern_id == pattern.pattern_id
+    assert context.find_pattern(canonical_hash(_pattern('x = 1', 'x = 3'))) is None
+    context.remove_pattern(pattern)
+    assert context.find_pattern(canonical_hash(pattern)) is None
+
+
+def test_duplicates_are_merged(context):
+    saved = _pattern('x = 1', 'x = 2', [Delete(1)])
+    context.save_pattern(saved)
+    duplicates = [_pattern('x = 1', 'x = 2', [Delete(1)]), _pattern('f()', 'g()'), _pattern('f()', 'g()')]
+    stored = context.merge_patterns(duplicates)
+    loaded = {pattern.pattern_id: pattern for pattern in context.load_patterns()}
+
+    assert len(loaded) == 2
+    assert stored[0].pattern_id == saved.pattern_id and stored[1].pattern_id == stored[2].pattern_id
+    assert loaded[saved.pattern_id].occurrences == 2 and loaded[stored[1].pattern_id].occurrences == 2
+
+
+def test_removed_patterns_are_not_loaded(context):
+    patterns = [_pattern('x = 1', 'x = 2'), _pattern('f()', 'g()'), _pattern('y = 1', 'y = 1')]
+    context.save_patterns(patterns)
+    context.remove_pattern(patterns[0])
+    context.remove_patterns(patterns[2:])
+
+    assert _ids(context.load_patterns()) == _ids(patterns[1:2])
+
+
+def test_removing_unsaved_pattern_raises_key_error(context):
+    pattern = _pattern('x = 1', 'x = 2')
+    context.save_pattern(pattern)
+    context.remove_pattern(pattern)
+
+    with pytest.raises(KeyError):
+        context.remove_pattern(pattern)
+        # the batching context detects it when the removal is flushed
+        context.get_version()
+
+
+def test_sqlite_patterns_persist(tmp_path):
+    path = str(tmp_path / 'patterns.db')
+    context = SqliteDbContext(path)
+    pattern = _pattern('x = 1', 'x = 2', [Delete(1)])
+    context.save_pattern(pattern)
+    version = context.get_version()
+    context.close()
+
+    reopened = SqliteDbContext(path)
+    loaded, reopened_version = reopened.load_patterns(), reopened.get_version()
+    reopened.close()
+
+    assert reopened_version == version
+    assert _ids(loaded) == [pattern.pattern_id]
+    assert ast.dump(loaded[0].modified) == ast.dump(pattern.modified)
+    assert isinstance(loaded[0].edit_script.get(0), Delete)
+
+
+def test_batching_delays_writes_until_flush():
+    context = InMemoryDbContext()
+    batching = BatchingDbContext(context, batch_size=3, flush_interval=None)
+    patterns = [_pattern('x = {}'.format(value), 'x = 0') for value in range(4)]
+    batching.save_patterns(patterns[:2])
+
+    assert context.load_patterns() == [] and batching.flushes == 0
+    batching.save_pattern(patterns[2])
+    assert len(context.load_patterns()) == 3 and batching.flushes == 1
+    batching.save_pattern(patterns[3])
+    assert len(context.load_patterns()) == 3
+    assert len(batching.load_patterns()) == 4
+    assert _ids(batching.load_patterns(root_type='Assign', signature='')) == _ids(patterns)
+    batching.close()
+
+
+def test_batching_coalesces_writes_of_the_same_pattern():
+    context = InMemoryDbContext()
+    pattern = _pattern('x = 1', 'x = 2')
+    context.save_pattern(pattern)
+    version = context.get_version()
+    batching = BatchingDbContext(context, flush_interval=None)
+    for occurrences in range(2, 6):
+        pattern.occurrences = occurrences
+        batching.save_pattern(pattern)
+    batching.remove_pattern(pattern)
+    batching.flush()
+
+    assert context.load_patterns() == [] and context.get_version() == version + 1
+    batching.close()
+
+
+def test_batching_merges_without_flushing():
+    context = InMemoryDbContext()
+    saved = _pattern('x = 1', 'x = 2')
+    context.save_pattern(saved)
+    batching = BatchingDbContext(context, flush_interval=None)
+    queued = _pattern('f()', 'g()')
+    batching.save_pattern(queued)
+    stored = batching.merge_patterns([_pattern('x = 1', 'x = 2'), _pattern('f()', 'g()'), _pattern('y = 1', 'y = 2')])
+    stored += batching.merge_patterns([_pattern('y = 1', 'y = 2')])
+
+    assert batching.flushes == 0 and _ids(context.load_patterns()) == [saved.pattern_id]
+    assert stored[0] is saved and stored[1] is queued and stored[2] is stored[3]
+    batching.flush()
+    loaded = {pattern.pattern_id: pattern.occurrences for pattern in context.load_patterns()}
+    assert loaded == {saved.pattern_id: 2, queued.pattern_id: 2, stored[2].pattern_id: 2}
+    batching.close()
+
+
+def test_batching_merges_only_into_queued_writes():
+    context = InMemoryDbContext()
+    removed, changed = _pattern('x = 1', 'x = 2'), _pattern('f()', 'g()')
+    context.save_patterns([removed, changed])
+    batching = BatchingDbContext(context, flush_interval=None)
+    batching.remove_pattern(removed)
+    changed.modified = ast.parse('h()')
+    batching.save_pattern(changed)
+    stored = batching.merge_patterns([_pattern('x = 1', 'x = 2'), _pattern('f()', 'g()'), _pattern('f()', 'h()')])
+
+    assert stored[0] is not removed and stored[1] is not changed and stored[2] is changed
+    batching.flush()
+    loaded = {pattern.pattern_id: pattern.occurrences for pattern in context.load_patterns()}
+    assert loaded == {changed.pattern_id: 2, stored[0].pattern_id: 1, stored[1].pattern_id: 1}
+    batching.close()